@@ -0,0 +1,201 @@
+import os, json, time
+
+import numpy as np
+
+
+ANN_META_FILE = "ann.json"
+
+
+def _top_k(scores, k):
+    k = min(k, len(scores))
+    if k == 0:
+        return np.zeros(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+def exact_search(vectors, query, k):
+    """Brute force top k by dot product, the reference for the ANN indexes."""
+    scores = vectors @ query
+    top = _top_k(scores, k)
+    return top, scores[top]
+
+
+class IVFIndex:
+    """Inverted file index over unit normalized vectors.
+
+    The vectors are clustered with spherical k-means, a search only scores
+    the rows of the nprobe clusters whose centroids are closest to the
+    query. Row ids are stored grouped by cluster so every probed cluster is
+    a contiguous slice, all arrays are saved as .npy files and memory mapped.
+    """
+
+    kind = "ivf"
+    files = ("ivf_centroids.npy", "ivf_order.npy", "ivf_offsets.npy")
+
+    def __init__(self, centroids, order, offsets, nprobe=8):
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.nprobe = nprobe
+
+    @classmethod
+    def build(cls, vectors, nlist=None, iters=10, seed=0, nprobe=8, batch_size=8192):
+        """Clusters the vectors into nlist lists (defaults to ~sqrt(n))."""
+        n = len(vectors)
+        nlist = nlist or max(1, int(np.sqrt(n)))
+        nlist = min(nlist, n)
+        rng = np.random.default_rng(seed)
+        centroids = np.array(vectors[rng.choice(n, nlist, replace=False)], dtype=np.float32)
+
+        for _ in range(iters):
+            assign = cls._assign(vectors, centroids, batch_size)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, vectors)
+            counts = np.bincount(assign, minlength=nlist)
+            # re-seed empty lists with random vectors
+            empty = np.flatnonzero(counts == 0)
+            if len(empty):
+                sums[empty] = vectors[rng.choice(n, len(empty), replace=False)]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids = (sums / norms).astype(np.float32)
+
+        assign = cls._assign(vectors, centroids, batch_size)
+        order = np.argsort(assign, kind="stable").astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))]).astype(np.int64)
+        return cls(centroids, order, offsets, nprobe=nprobe)
+
+    @staticmethod
+    def _assign(vectors, centroids, batch_size):
+        # assign in batches to bound the size of the score matrix
+        assign = np.empty(len(vectors), dtype=np.int64)
+        for i in range(0, len(vectors), batch_size):
+            assign[i:i + batch_size] = np.argmax(vectors[i:i + batch_size] @ centroids.T, axis=1)
+        return assign
+
+    def search(self, vectors, query, k, nprobe=None):
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        probes = _top_k(self.centroids @ query, nprobe)
+        # sorted rows read the memory mapped vectors front to back
+        rows = np.sort(np.concatenate([self.order[self.offsets[l]:self.offsets[l + 1]] for l in probes]))
+        scores = vectors[rows] @ query
+        top = _top_k(scores, k)
+        return rows[top], scores[top]
+
+    def save(self, path):
+        for name, array in zip(self.files, (self.centroids, self.order, self.offsets)):
+            np.save(os.path.join(path, name), array)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        arrays = [np.load(os.path.join(path, name), mmap_mode="r") for name in cls.files]
+        return cls(*arrays, **kwargs)
+
+
+class HNSWIndex:
+    """HNSW graph index, built with hnswlib (the library behind chromadb's
+    header.bin/link_lists.bin segments). ef trades recall for latency."""
+
+    kind = "hnsw"
+    files = ("hnsw.bin",)
+
+    def __init__(self, index, ef=64):
+        self.index = index
+        self.ef = ef
+
+    @classmethod
+    def build(cls, vectors, M=16, ef_construction=200, ef=64):
+        import hnswlib
+
+        index = hnswlib.Index(space="ip", dim=vectors.shape[1])
+        index.init_index(max_elements=len(vectors), M=M, ef_construction=ef_construction)
+        index.add_items(np.asarray(vectors), np.arange(len(vectors)))
+        return cls(index, ef=ef)
+
+    def search(self, vectors, query, k, ef=None):
+        k = min(k, self.index.get_current_count())
+        # ef has to be at least k
+        self.index.set_ef(max(ef or self.ef, k))
+        labels, distances = self.index.knn_query(query, k=k)
+        rows = labels[0].astype(np.int64)
+        return rows, vectors[rows] @ query
+
+    def save(self, path):
+        self.index.save_index(os.path.join(path, self.files[0]))
+
+    @classmethod
+    def load(cls, path, dim, **kwargs):
+        import hnswlib
+
+        index = hnswlib.Index(space="ip", dim=dim)
+        index.load_index(os.path.join(path, cls.files[0]))
+        return cls(index, **kwargs)
+
+
+ANN_INDEXES = {"ivf": IVFIndex, "hnsw": HNSWIndex}
+
+
+def save_ann_index(ann, path, count):
+    ann.save(path)
+    with open(os.path.join(path, ANN_META_FILE), "w") as f:
+        json.dump({"kind": ann.kind, "count": count}, f)
+
+
+def load_ann_index(path, vectors, kind, nprobe=8, ef=64):
+    """Loads the ANN index of the given kind saved in path, None if
+    missing or out of date."""
+    meta_path = os.path.join(path, ANN_META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    # another kind of index or built for another version of the vectors
+    if meta["kind"] != kind or meta["count"] != len(vectors):
+        return None
+    if kind == "ivf":
+        return IVFIndex.load(path, nprobe=nprobe)
+    return HNSWIndex.load(path, dim=vectors.shape[1], ef=ef)
+
+
+def remove_ann_index(path):
+    for ann_cls in ANN_INDEXES.values():
+        for name in ann_cls.files:
+            if os.path.exists(os.path.join(path, name)):
+                os.remove(os.path.join(path, name))
+    if os.path.exists(os.path.join(path, ANN_META_FILE)):
+        os.remove(os.path.join(path, ANN_META_FILE))
+
+
+def recall_report(vectors, ann, queries, k=5, settings=(1, 2, 4, 8, 16, 32)):
+    """Measures recall@k and latency of an ANN index against exact search.
+
+    Args:
+        vectors: the indexed unit normalized vectors.
+        ann (IVFIndex or HNSWIndex): the index to evaluate.
+        queries: query vectors, unit normalized.
+        k (int, optional): number of neighbours. Defaults to 5.
+        settings (tuple, optional): nprobe (ivf) or ef (hnsw) values to try.
+
+    Returns:
+        list(dict): one row per setting with recall@k and mean latency in ms
+    """
+    exact = []
+    start = time.perf_counter()
+    for query in queries:
+        exact.append(set(exact_search(vectors, query, k)[0].tolist()))
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    rows = [{"setting": "exact", "recall": 1.0, "latency_ms": exact_ms}]
+    param = "nprobe" if ann.kind == "ivf" else "ef"
+    for value in settings:
+        hits = 0
+        start = time.perf_counter()
+        for query, truth in zip(queries, exact):
+            found, _ = ann.search(vectors, query, k, value)
+            hits += len(truth.intersection(found.tolist()))
+        latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        rows.append({"setting": f"{param}={value}",
+                     "recall": hits / (k * len(queries)),
+                     "latency_ms": latency_ms})
+    return rows
@@ -0,0 +1,264 @@
+import os, time
+import asyncio
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from langchain_core.messages import AIMessageChunk
+from langchain_core.runnables import RunnableGenerator
+from langchain_core.runnables.utils import AddableDict
+
+from .manifest import MANIFEST_NAME
+from . import metrics
+
+
+# answer cache settings, a cached answer is reused for questions whose
+# embedding cosine similarity is at least the threshold
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "1") == "1"
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("ANSWER_CACHE_THRESHOLD", 0.95))
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", 24 * 3600))
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", 2000))
+
+# words (with their trailing whitespace) a cached answer is streamed in
+_STREAM_PIECE_RE = re.compile(r"\S+\s*|\s+")
+
+# course codes (ISM 6251, qmb-6358) & other numbers (years, credits, amounts)
+_COURSE_CODE_RE = re.compile(r"\b([a-z]{2,4})\s?-?(\d{4}[a-z]?)\b", re.I)
+_NUMBER_RE = re.compile(r"\d+(?:\.\d+)?")
+# words which are not a course prefix when followed by a number ("in 2024")
+_NOT_PREFIXES = {"in", "on", "at", "for", "of", "by", "to", "the", "and", "is", "are", "from",
+                 "than", "over", "til", "till", "per", "year", "fall", "term", "page", "room"}
+
+
+def question_identifiers(question):
+    """Course codes & numbers of a question, normalized (ISM6251, 2024).
+
+    Questions about different courses or numbers embed almost identically
+    ("ISM 6251" vs "ISM 6225" is above any usable threshold), so the answer
+    cache only reuses an answer when these match exactly.
+    """
+    identifiers = set()
+    for prefix, number in _COURSE_CODE_RE.findall(question):
+        if prefix.lower() not in _NOT_PREFIXES:
+            identifiers.add(f"{prefix.upper()}{number.upper()}")
+    # numbers outside of the course codes
+    without_codes = _COURSE_CODE_RE.sub(
+        lambda match: " " if match.group(1).lower() not in _NOT_PREFIXES else match.group(0), question)
+    identifiers.update(_NUMBER_RE.findall(without_codes))
+    return frozenset(identifiers)
+
+
+class SemanticAnswerCache:
+    """Process wide cache of answers keyed by the embedding of the question.
+
+    A lookup returns the entry of the most similar cached question if its
+    similarity is above the threshold and it has the same course codes &
+    numbers (question_identifiers) as the question. Entries expire after ttl seconds, the
+    least recently used ones are evicted beyond max_entries and the whole
+    cache is cleared when the ingestion manifest changes, i.e. when the
+    documents answers were built from changed.
+    """
+
+    def __init__(self, embedding, manifest_path=f"data/{MANIFEST_NAME}",
+                 threshold=ANSWER_CACHE_THRESHOLD, ttl=ANSWER_CACHE_TTL,
+                 max_entries=ANSWER_CACHE_MAX_ENTRIES):
+        self.embedding = embedding
+        self.manifest_path = manifest_path
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        # vectors of the entries stacked for search, rebuilt lazily
+        self._matrix = None
+        self._matrix_keys = []
+        self._matrix_identifiers = []
+        self._next_key = 0
+        self._lock = threading.Lock()
+        self._manifest_version = self._current_manifest_version()
+
+    def _current_manifest_version(self):
+        try:
+            stat = os.stat(self.manifest_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self._matrix = None
+
+    def _check_manifest(self):
+        version = self._current_manifest_version()
+        if version != self._manifest_version:
+            # the index changed, answers may be stale
+            self.clear()
+            self._manifest_version = version
+
+    def _embed(self, question, embedding=None):
+        embedding = embedding or self.embedding
+        vector = np.asarray(embedding.embed_query(question), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def bind(self, embedding):
+        """Returns a view of the cache embedding questions with the given
+        model, e.g. the one holding a session's api key."""
+        return BoundAnswerCache(self, embedding)
+
+    def lookup(self, question, embedding=None, vector=None):
+        """Returns (entry, vector), entry is None on a miss. The vector can be
+        passed to store() to avoid embedding the question twice, or given
+        here if the question was already embedded."""
+        self._check_manifest()
+        if vector is None:
+            vector = self._embed(question, embedding)
+        identifiers = question_identifiers(question)
+        now = time.time()
+        with self._lock:
+            # drop expired entries
+            expired = [key for key, entry in self.entries.items() if now - entry["created"] > self.ttl]
+            for key in expired:
+                del self.entries[key]
+            if expired:
+                self._matrix = None
+
+            if self.entries:
+                if self._matrix is None:
+                    self._matrix_keys = list(self.entries)
+                    self._matrix = np.stack([self.entries[key]["vector"] for key in self._matrix_keys])
+                    self._matrix_identifiers = [self.entries[key]["identifiers"] for key in self._matrix_keys]
+                scores = self._matrix @ vector
+                # a similar question about another course / number is not a hit
+                scores = np.where([other == identifiers for other in self._matrix_identifiers],
+                                  scores, -np.inf)
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self.hits += 1
+                    metrics.increment("answer_cache_hit")
+                    key = self._matrix_keys[best]
+                    self.entries.move_to_end(key)
+                    return self.entries[key], vector
+        self.misses += 1
+        metrics.increment("answer_cache_miss")
+        return None, vector
+
+    def store(self, question, answer, docs, vector=None, embedding=None):
+        if vector is None:
+            vector = self._embed(question, embedding)
+        with self._lock:
+            self.entries[self._next_key] = {"question": question, "answer": answer, "docs": docs,
+                                           "vector": vector, "created": time.time(),
+                                           "identifiers": question_identifiers(question)}
+            self._next_key += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self._matrix = None
+
+
+class BoundAnswerCache:
+    """A SemanticAnswerCache sharing its entries, with its own embedding model."""
+
+    def __init__(self, cache, embedding):
+        self.cache = cache
+        self.embedding = embedding
+
+    def lookup(self, question, vector=None):
+        return self.cache.lookup(question, self.embedding, vector)
+
+    def store(self, question, answer, docs, vector=None):
+        self.cache.store(question, answer, docs, vector, self.embedding)
+
+
+def cached_answer_chain(answer_chain, cache, key="standalone_question"):
+    """Puts the semantic answer cache in front of the retrieval + answer steps.
+
+    On a hit the cached answer is streamed word by word as "answer" chunks
+    followed by the cached "docs", like the chain would. On a miss the
+    chain runs and its answer is stored. When keyed on the raw "question"
+    (chains without a standalone question) only first turns are cached,
+    follow ups depend on the chat history.
+
+    Args:
+        answer_chain: runnable producing the "answer" & "docs" chunks.
+        cache (SemanticAnswerCache): the cache, None disables it.
+        key (str, optional): input holding the question to look up.
+
+    Returns:
+        Runnable: the cached chain
+    """
+    if cache is None:
+        return answer_chain
+
+    def _cacheable(inputs):
+        return key != "question" or not inputs.get("chat_history")
+
+    def answer_from_cache(inputs, config):
+        # merge the streamed input chunks
+        final = None
+        for chunk in inputs:
+            final = chunk if final is None else final + chunk
+
+        vector = None
+        if _cacheable(final):
+            entry, vector = cache.lookup(final[key])
+            if entry is not None:
+                for piece in _STREAM_PIECE_RE.findall(entry["answer"]):
+                    yield AddableDict(answer=AIMessageChunk(content=piece))
+                yield AddableDict(docs=entry["docs"])
+                return
+
+        answer, docs = "", []
+        for chunk in answer_chain.stream(final, config):
+            if "answer" in chunk:
+                answer += chunk["answer"].content
+            if "docs" in chunk:
+                docs = chunk["docs"]
+            yield AddableDict(chunk)
+
+        if vector is not None and answer:
+            cache.store(final[key], answer, docs, vector)
+
+    async def aanswer_from_cache(inputs, config):
+        final = None
+        async for chunk in inputs:
+            final = chunk if final is None else final + chunk
+
+        vector = None
+        if _cacheable(final):
+            # the lookup embeds the question, keep it off the event loop
+            entry, vector = await asyncio.to_thread(cache.lookup, final[key])
+            if entry is not None:
+                for piece in _STREAM_PIECE_RE.findall(entry["answer"]):
+                    yield AddableDict(answer=AIMessageChunk(content=piece))
+                yield AddableDict(docs=entry["docs"])
+                return
+
+        answer, docs = "", []
+        async for chunk in answer_chain.astream(final, config):
+            if "answer" in chunk:
+                answer += chunk["answer"].content
+            if "docs" in chunk:
+                docs = chunk["docs"]
+            yield AddableDict(chunk)
+
+        if vector is not None and answer:
+            cache.store(final[key], answer, docs, vector)
+
+    return RunnableGenerator(answer_from_cache, aanswer_from_cache)
+
+
+# process wide answer caches, one per rag type
+_answer_caches = {}
+
+
+def get_answer_cache(embedding, docs_path="data", namespace="default"):
+    """Returns the process wide answer cache of a namespace (rag type) bound
+    to the embedding model, None if disabled."""
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    if namespace not in _answer_caches:
+        _answer_caches[namespace] = SemanticAnswerCache(None, os.path.join(docs_path, MANIFEST_NAME))
+    return _answer_caches[namespace].bind(embedding)
@@ -0,0 +1,406 @@
+import os, ast, json, time
+import asyncio
+import hashlib
+import threading
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, get_buffer_string
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from .rags import base_rag, rag_with_hyde, rag_with_query_aug, rag_with_react
+from .rags import rag_with_extractive_filter
+from .vector_store import LocalVectorStore
+from .retrievers import BM25Index, HybridRetriever, RETRIEVER_K
+from .rerank import RerankingRetriever, get_reranker, RERANK_FETCH_K
+from .session_store import SessionMemory, SessionStore
+from .packing import count_tokens, use_token_estimate
+from .tracing import RagTracer
+from . import metrics
+
+
+# same chains as the app (resources.rag_methods), without its openai clients
+BENCH_CHAINS = {"base": base_rag, "hyde": rag_with_hyde, "query_aug": rag_with_query_aug,
+                "react": rag_with_react, "extractive": rag_with_extractive_filter}
+
+# simulated latencies in seconds, roughly the hosted apis
+LLM_FIRST_TOKEN_LATENCY = 0.3
+LLM_TOKEN_INTERVAL = 0.01
+LLM_RESPONSE_TOKENS = 60
+EMBED_LATENCY = 0.05
+SEARCH_LATENCY = 0.02
+EMBED_DIM = 256
+
+
+class FakeChatModel(BaseChatModel):
+    """Deterministic chat model with simulated latencies.
+
+    The response is made of words of the prompt picked by its hash, so the
+    same prompt always gets the same answer, with a line break every few
+    words (query variants are split by lines).
+    """
+
+    first_token_latency: float = LLM_FIRST_TOKEN_LATENCY
+    token_interval: float = LLM_TOKEN_INTERVAL
+    response_tokens: int = LLM_RESPONSE_TOKENS
+
+    @property
+    def _llm_type(self):
+        return "fake-benchmark"
+
+    def get_num_tokens(self, text):
+        return count_tokens(text)
+
+    def get_num_tokens_from_messages(self, messages):
+        return count_tokens(get_buffer_string(messages))
+
+    def _tokens(self, messages):
+        prompt = get_buffer_string(messages)
+        words = prompt.split() or ["ok"]
+        seed = int(hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:8], 16)
+        rng = np.random.default_rng(seed)
+        picks = rng.integers(0, len(words), self.response_tokens)
+        return [words[i] + ("\n" if (n + 1) % 12 == 0 else " ") for n, i in enumerate(picks)]
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        tokens = self._tokens(messages)
+        time.sleep(self.first_token_latency + self.token_interval * len(tokens))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens)))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        tokens = self._tokens(messages)
+        await asyncio.sleep(self.first_token_latency + self.token_interval * len(tokens))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens)))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.first_token_latency)
+        for token in self._tokens(messages):
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+            time.sleep(self.token_interval)
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.first_token_latency)
+        for token in self._tokens(messages):
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+            await asyncio.sleep(self.token_interval)
+
+
+class FakeEmbeddings(Embeddings):
+    """Deterministic bag of words embeddings (hashed words) with a simulated
+    latency per call, similar texts get similar vectors."""
+
+    def __init__(self, dim=EMBED_DIM, latency=EMBED_LATENCY):
+        self.dim = dim
+        self.latency = latency
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in text.lower().split():
+            vector[int(hashlib.md5(word.encode("utf-8")).hexdigest()[:8], 16) % self.dim] += 1
+        return (vector / (np.linalg.norm(vector) or 1.0)).tolist()
+
+    def embed_documents(self, texts):
+        time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        time.sleep(self.latency)
+        return self._embed(text)
+
+    async def aembed_documents(self, texts):
+        await asyncio.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    async def aembed_query(self, text):
+        await asyncio.sleep(self.latency)
+        return self._embed(text)
+
+
+class SlowVectorStore(LocalVectorStore):
+    """In memory local vector store with a simulated search round trip."""
+
+    def __init__(self, embedding, latency=SEARCH_LATENCY, **kwargs):
+        super().__init__(embedding, **kwargs)
+        self.latency = latency
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, **kwargs):
+        time.sleep(self.latency)
+        return super().similarity_search_with_score_by_vector(embedding, k, **kwargs)
+
+    similarity_search_by_vector_with_score = similarity_search_with_score_by_vector
+
+
+def load_testset(path):
+    """Reads the questions & their context chunks from the ragas testset csv.
+
+    Returns:
+        tuple(list(str), list(Document)): the questions and unique chunks
+    """
+    df = pd.read_csv(path)
+    questions = [q for q in df["question"].dropna().tolist() if q.strip()]
+    chunks, seen = [], set()
+    for contexts in df["contexts"].dropna():
+        for text in ast.literal_eval(contexts):
+            if text.strip() and text not in seen:
+                seen.add(text)
+                chunks.append(Document(page_content=text, metadata={
+                    "source": f"testset/{len(chunks)}", "start_index": 0}))
+    return questions, chunks
+
+
+def build_fake_retriever(chunks, embedding, mode="dense", search_latency=SEARCH_LATENCY):
+    """The retriever over the testset chunks, like resources.RagRegistry
+    builds it (reranker from RERANKER included)."""
+    vector_db = SlowVectorStore(embedding, latency=0.0)
+    vector_db.add_texts([doc.page_content for doc in chunks], [doc.metadata for doc in chunks])
+    vector_db.latency = search_latency
+    reranker = get_reranker()
+    k = RERANK_FETCH_K if reranker is not None else RETRIEVER_K
+    if mode == "hybrid":
+        retriever = HybridRetriever(dense_retriever=vector_db.as_retriever(search_kwargs={"k": k}),
+                                    bm25=BM25Index(chunks), k=k)
+    else:
+        retriever = vector_db.as_retriever(search_kwargs={"k": k})
+    if reranker is not None:
+        retriever = RerankingRetriever(retriever=retriever, reranker=reranker)
+    return retriever
+
+
+def rss_mb():
+    """Current resident memory of the process in MB, None where /proc is
+    not available (macos)."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+class RssSampler:
+    """Samples the resident memory in a thread while a run is going, for
+    the peak & growth of that run only (ru_maxrss is the peak of the whole
+    process, earlier runs included)."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.start_mb = None
+        self.peak_mb = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while True:
+            current = rss_mb()
+            if current is not None:
+                self.peak_mb = max(self.peak_mb or 0.0, current)
+            if self._stop.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self.start_mb = rss_mb()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def _percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99)}
+
+
+async def run_load(chain, memory, questions, sessions, rag_type):
+    """Replays the questions over concurrent sessions, each session asks its
+    share of the questions one after the other, like chatting users.
+
+    Returns:
+        dict: latency & ttft percentiles, throughput and memory peaks
+    """
+    latencies, ttfts, errors = [], [], 0
+
+    async def session(index):
+        nonlocal errors
+        session_id = f"bench-{rag_type}-{sessions}-{index}"
+        for question in questions[index::sessions]:
+            inputs = {"question": question, "session_id": session_id}
+            tracer = RagTracer(rag_type, session_id)
+            start = time.perf_counter()
+            answer = ""
+            try:
+                async for chunk in chain.astream(inputs, tracer.config):
+                    if "answer" in chunk:
+                        if not answer:
+                            tracer.first_token()
+                            ttfts.append(time.perf_counter() - start)
+                        answer += chunk["answer"].content
+            except Exception as e:
+                print(f"{rag_type}: {type(e).__name__}: {e}")
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+            tracer.finish(answer)
+            await memory.asave_context(inputs, {"answer": answer})
+
+    start = time.perf_counter()
+    await asyncio.gather(*(session(i) for i in range(sessions)))
+    wall = time.perf_counter() - start
+
+    return {"rag_type": rag_type, "sessions": sessions, "requests": len(latencies),
+            "errors": errors, "seconds": wall, "throughput": len(latencies) / wall,
+            "latency": _percentiles(latencies), "ttft": _percentiles(ttfts)}
+
+
+def stage_means():
+    """Mean seconds per pipeline stage, from the tracer histograms."""
+    return {dict(labels)["stage"]: h["mean"]
+            for (name, labels), h in metrics.histogram_snapshot().items()
+            if name == "stage_seconds"}
+
+
+def run_benchmark(testset_path, rag_types, concurrency, n_questions, llm_latency=LLM_FIRST_TOKEN_LATENCY,
+                  token_interval=LLM_TOKEN_INTERVAL, embed_latency=EMBED_LATENCY,
+                  search_latency=SEARCH_LATENCY, retriever_mode="dense", trace_memory=False):
+    """Benchmarks the rag chains against the local stand-ins.
+
+    Args:
+        testset_path (str): ragas testset csv (scripts/test_data_gen.py).
+        rag_types (list(str)): chains to run, keys of BENCH_CHAINS.
+        concurrency (list(int)): concurrent session counts to run each chain at.
+        n_questions (int): questions replayed per run.
+        llm_latency (float, optional): seconds to the first llm token.
+        token_interval (float, optional): seconds between llm tokens.
+        embed_latency (float, optional): seconds per embedding call.
+        search_latency (float, optional): seconds per vector search.
+        retriever_mode (str, optional): "dense" or "hybrid".
+        trace_memory (bool, optional): measure the python heap peak per run
+            with tracemalloc, slows everything down.
+
+    Returns:
+        list(dict): one result per (rag type, concurrency)
+    """
+    # offline, tiktoken would try to download its encoding
+    use_token_estimate()
+    questions, chunks = load_testset(testset_path)
+    questions = (questions * (n_questions // len(questions) + 1))[:n_questions]
+    embedding = FakeEmbeddings(latency=embed_latency)
+    retriever = build_fake_retriever(chunks, embedding, retriever_mode, search_latency)
+    print(f"{len(questions)} questions, {len(chunks)} chunks")
+
+    results = []
+    for rag_type in rag_types:
+        for sessions in concurrency:
+            llm = FakeChatModel(first_token_latency=llm_latency, token_interval=token_interval)
+            # fresh in memory sessions & no answer cache, runs stay comparable
+            memory = SessionMemory(llm, SessionStore())
+            chain = BENCH_CHAINS[rag_type](llm, memory, retriever)
+            metrics.reset()
+            if trace_memory:
+                tracemalloc.start()
+            with RssSampler() as rss:
+                result = asyncio.run(run_load(chain, memory, questions, sessions, rag_type))
+            if trace_memory:
+                result["heap_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+                tracemalloc.stop()
+            # this run's peak & how much it grew the process
+            result["rss_peak_mb"] = rss.peak_mb
+            result["rss_growth_mb"] = (rss.peak_mb - rss.start_mb) if rss.peak_mb is not None else None
+            result["stages"] = stage_means()
+            results.append(result)
+            print_result(result)
+    return results
+
+
+def _ms(value):
+    return f"{value * 1000:8.0f}" if value is not None else "       -"
+
+
+def print_result(result):
+    latency, ttft = result["latency"], result["ttft"]
+    heap = f", heap peak {result['heap_peak_mb']:.1f}MB" if "heap_peak_mb" in result else ""
+    rss = (f"rss peak {result['rss_peak_mb']:.0f}MB (+{result['rss_growth_mb']:.0f}MB)"
+           if result.get("rss_peak_mb") is not None else "rss -")
+    print(f"{result['rag_type']:>10} x{result['sessions']:<3} "
+          f"latency ms p50/p95/p99 {_ms(latency['p50'])}{_ms(latency['p95'])}{_ms(latency['p99'])}  "
+          f"ttft ms {_ms(ttft['p50'])}{_ms(ttft['p95'])}{_ms(ttft['p99'])}  "
+          f"{result['throughput']:6.2f} req/s  {rss}{heap}"
+          + (f"  errors {result['errors']}" if result["errors"] else ""))
+    stages = ", ".join(f"{stage} {seconds * 1000:.0f}ms" for stage, seconds in sorted(result["stages"].items()))
+    print(f"{'':>15} stages: {stages}")
+
+
+def compare(results, baseline, tolerance):
+    """Flags the runs slower than the baseline by more than tolerance (p95
+    latency, p95 ttft or throughput).
+
+    Returns:
+        list(str): the regressions
+    """
+    previous = {(r["rag_type"], r["sessions"]): r for r in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get((result["rag_type"], result["sessions"]))
+        if before is None:
+            continue
+        name = f"{result['rag_type']} x{result['sessions']}"
+        for metric in ("latency", "ttft"):
+            old, new = before[metric]["p95"], result[metric]["p95"]
+            if old and new and new > old * (1 + tolerance):
+                regressions.append(f"{name}: p95 {metric} {old * 1000:.0f}ms -> {new * 1000:.0f}ms")
+        if result["throughput"] < before["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {before['throughput']:.2f} -> "
+                               f"{result['throughput']:.2f} req/s")
+    return regressions
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Offline latency/throughput benchmark of the rag chains, "
+                                                 "with a fake llm, embeddings and vector store.")
+    parser.add_argument("--testset", default="scripts/test_data.csv")
+    parser.add_argument("--rag-types", nargs="+", choices=list(BENCH_CHAINS), default=list(BENCH_CHAINS))
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8])
+    parser.add_argument("--questions", type=int, default=32)
+    parser.add_argument("--llm-latency", type=float, default=LLM_FIRST_TOKEN_LATENCY)
+    parser.add_argument("--token-interval", type=float, default=LLM_TOKEN_INTERVAL)
+    parser.add_argument("--embed-latency", type=float, default=EMBED_LATENCY)
+    parser.add_argument("--search-latency", type=float, default=SEARCH_LATENCY)
+    parser.add_argument("--retriever-mode", choices=["dense", "hybrid"], default="dense")
+    parser.add_argument("--trace-memory", action="store_true")
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--baseline", help="compare against the results json of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    args = parser.parse_args()
+
+    results = run_benchmark(args.testset, args.rag_types, args.concurrency, args.questions,
+                            args.llm_latency, args.token_interval, args.embed_latency,
+                            args.search_latency, args.retriever_mode, args.trace_memory)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            raise SystemExit(1)
+        print("no regressions")
@@ -0,0 +1,192 @@
+import os, json, time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .manifest import text_hash
+from .pipeline import EMBED_BATCH_SIZE, batched
+
+
+# concurrent embed + upsert workers
+INDEX_WORKERS = int(os.environ.get("INDEX_WORKERS", 4))
+# max requests per second sent to the embedding api & the vector db
+EMBED_RPS = float(os.environ.get("EMBED_RPS", 5))
+UPSERT_RPS = float(os.environ.get("UPSERT_RPS", 20))
+# vectors per upsert request
+UPSERT_BATCH_SIZE = int(os.environ.get("UPSERT_BATCH_SIZE", 100))
+# committed batches are recorded here so an interrupted build resumes
+# (relative to the docs path)
+INDEX_CHECKPOINT_PATH = os.environ.get("INDEX_CHECKPOINT_PATH", "index_checkpoint.json")
+# metadata field holding the chunk text in pinecone, PineconeVectorStore
+# has to be created with the same text_key to read it back
+PINECONE_TEXT_KEY = "text"
+
+
+class TokenBucket:
+    """Thread safe token bucket, acquire() blocks until a token is available."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def is_retryable(error):
+    """Rate limits (429), server errors and network errors are retried."""
+    status = getattr(error, "status_code", None) or getattr(error, "status", None)
+    if isinstance(status, int):
+        return status == 429 or status >= 500
+    name = type(error).__name__.lower()
+    return (isinstance(error, (ConnectionError, TimeoutError))
+            or any(word in name for word in ("ratelimit", "timeout", "connection")))
+
+
+def with_retry(fn, *args, max_retries=6, base_delay=1.0, max_delay=60.0, **kwargs):
+    """Calls fn, retrying retryable errors with exponential backoff & jitter."""
+    for attempt in range(max_retries + 1):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise
+            delay = min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+            print(f"{type(e).__name__}: {e}, retrying in {delay:.1f}s...")
+            time.sleep(delay)
+
+
+def upsert_embeddings(target, texts, embeddings, metadatas, ids, batch_size=UPSERT_BATCH_SIZE,
+                      text_key=PINECONE_TEXT_KEY):
+    """Writes pre-computed embeddings without re-embedding.
+
+    Args:
+        target: the local vector store or a pinecone Index client.
+    """
+    if hasattr(target, "add_embeddings"):
+        # the local vector store
+        target.add_embeddings(texts, embeddings, metadatas, ids)
+        return
+
+    # pinecone Index client, the text is stored in the metadata where
+    # PineconeVectorStore reads it
+    vectors = [(vector_id, embedding, {**metadata, text_key: text})
+               for vector_id, embedding, metadata, text in zip(ids, embeddings, metadatas, texts)]
+    for batch in batched(vectors, batch_size):
+        target.upsert(vectors=batch)
+
+
+class BulkIndexer:
+    """Embeds & upserts documents in batches with concurrent workers, rate
+    limiting, retries and a checkpoint of the committed batches.
+
+    Batches are keyed by the hash of their vector ids, ids are content
+    derived, so a rerun after a failure skips every batch already written
+    and continues with the remaining ones. The checkpoint is only honored
+    for the index generation it was written for, batches committed to a
+    cleared or recreated index are written again.
+
+    Args:
+        embed_model: Langchain embedding model.
+        vectordb: local vector store or pinecone Index client to write to.
+        batch_size (int, optional): chunks embedded per request.
+        workers (int, optional): concurrent embed + upsert workers.
+        embed_rps (float, optional): max embedding requests per second.
+        upsert_rps (float, optional): max upsert requests per second.
+        checkpoint_path (str, optional): file recording the committed batches.
+        max_retries (int, optional): retries of a failing request.
+        generation (str, optional): index generation (IngestManifest.generation)
+            the checkpoint belongs to.
+    """
+
+    def __init__(self, embed_model, vectordb, batch_size=EMBED_BATCH_SIZE, workers=INDEX_WORKERS,
+                 embed_rps=EMBED_RPS, upsert_rps=UPSERT_RPS,
+                 checkpoint_path=os.path.join("data", INDEX_CHECKPOINT_PATH), max_retries=6,
+                 generation=None):
+        self.embed_model = embed_model
+        self.vectordb = vectordb
+        self.batch_size = batch_size
+        self.workers = workers
+        self.embed_bucket = TokenBucket(embed_rps)
+        self.upsert_bucket = TokenBucket(upsert_rps)
+        self.checkpoint_path = checkpoint_path
+        self.max_retries = max_retries
+        self.generation = generation
+        self._lock = threading.Lock()
+        self.committed = self._load_checkpoint()
+
+    def _load_checkpoint(self):
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as f:
+                data = json.load(f)
+            if data.get("generation") == self.generation:
+                return set(data["committed"])
+            print("index checkpoint of another index generation, ignoring it")
+        return set()
+
+    def _save_checkpoint(self):
+        if not self.checkpoint_path:
+            return
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"generation": self.generation, "committed": sorted(self.committed)}, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def reset(self):
+        """Forgets the committed batches, call once a build completed or
+        when the index is cleared."""
+        self.committed = set()
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    def _index_batch(self, key, batch):
+        texts = [doc.page_content for doc, _ in batch]
+        metadatas = [dict(doc.metadata) for doc, _ in batch]
+        ids = [vector_id for _, vector_id in batch]
+
+        self.embed_bucket.acquire()
+        embeddings = with_retry(self.embed_model.embed_documents, texts,
+                                max_retries=self.max_retries)
+        self.upsert_bucket.acquire()
+        with_retry(upsert_embeddings, self.vectordb, texts, embeddings, metadatas, ids,
+                   max_retries=self.max_retries)
+
+        with self._lock:
+            self.committed.add(key)
+            self._save_checkpoint()
+        return len(batch)
+
+    def index(self, docs, ids):
+        """Embeds & writes the documents under the given vector ids.
+
+        Returns:
+            tuple(int, int): documents written, documents skipped as their
+                batch was already committed
+        """
+        pending, skipped = [], 0
+        for batch in batched(list(zip(docs, ids)), self.batch_size):
+            key = text_hash("\0".join(vector_id for _, vector_id in batch))
+            if key in self.committed:
+                skipped += len(batch)
+            else:
+                pending.append((key, batch))
+
+        if self.workers <= 1 or len(pending) <= 1:
+            return sum(self._index_batch(key, batch) for key, batch in pending), skipped
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self._index_batch, key, batch) for key, batch in pending]
+            # result() re-raises the first failure, committed batches stay checkpointed
+            return sum(future.result() for future in futures), skipped
@@ -2,6 +2,8 @@ from rxconfig import config
 import reflex as rx
 from chat_app import style
 from chat_app.state import State
+from chat_app import metrics
+from fastapi.responses import PlainTextResponse
 filename = f"{config.app_name}/{config.app_name}.py"
 
 
@@ -36,6 +38,9 @@ def chat() -> rx.Component:
     chatbox = rx.box(
         rx.foreach(State.chat_history,
                    lambda messages: qa(messages[0], messages[1]),),
+        # the answer being streamed
+        rx.cond(State.streaming_question != "",
+                qa(State.streaming_question, State.streaming_answer)),
                    width="100%")
 
     return rx.vstack(
@@ -175,4 +180,11 @@ app = rx.App(
     ),
 )
 
-app.add_page(index)
\ No newline at end of file
+app.add_page(index)
+
+
+async def prometheus_metrics():
+    # pipeline stage timings, token counts & cache hit counters
+    return PlainTextResponse(metrics.prometheus_text())
+
+app.api.add_api_route("/metrics", prometheus_metrics)
\ No newline at end of file
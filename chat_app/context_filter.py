@@ -0,0 +1,125 @@
+import os, re
+
+import numpy as np
+
+
+# sentences kept by the extractive filter
+CONTEXT_FILTER_MAX_SENTENCES = int(os.environ.get("CONTEXT_FILTER_MAX_SENTENCES", 12))
+# sentences scoring below this share of the best sentence's similarity are dropped
+CONTEXT_FILTER_MIN_RATIO = float(os.environ.get("CONTEXT_FILTER_MIN_RATIO", 0.75))
+# embed the sentences of the chunks at ingestion, into the embedding cache.
+# About doubles the embedding cost of an ingestion, turn it on when the
+# extractive rag mode is served
+CONTEXT_FILTER_PRECOMPUTE = os.environ.get("CONTEXT_FILTER_PRECOMPUTE", "0") == "1"
+
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+|\n\s*\n|\n(?=\s*[•\-*]\s)")
+# shorter pieces (headings, bullets) are glued to the previous sentence
+_MIN_SENTENCE_CHARS = 25
+
+
+def split_sentences(text):
+    sentences = []
+    for piece in _SENTENCE_RE.split(text):
+        piece = " ".join(piece.split())
+        if not piece:
+            continue
+        if sentences and len(piece) < _MIN_SENTENCE_CHARS:
+            sentences[-1] += " " + piece
+        else:
+            sentences.append(piece)
+    return sentences
+
+
+def chunk_sentences(docs):
+    """The distinct sentences of chunks, in order.
+
+    Each chunk is split on its own, so the sentences are the same at
+    ingestion & query time. Overlapping chunks repeat sentences or hold
+    fragments of their neighbours' sentences, those are dropped.
+
+    Returns:
+        list(tuple(int, str)): (chunk index, sentence)
+    """
+    sentences, seen = [], set()
+    for i, doc in enumerate(docs):
+        for sentence in split_sentences(doc.page_content):
+            if sentence not in seen:
+                seen.add(sentence)
+                sentences.append((i, sentence))
+    return [(i, sentence) for i, sentence in sentences
+            if not any(sentence != other and sentence in other for other in seen)]
+
+
+def precompute_sentence_embeddings(embedding, docs, batch_size=256):
+    """Embeds the sentences of chunks at ingestion, with a CachedEmbeddings
+    the extractive filter then finds them in the cache instead of embedding
+    them on the query path."""
+    if not CONTEXT_FILTER_PRECOMPUTE or not docs:
+        return 0
+    texts = list(dict.fromkeys(sentence for doc in docs
+                               for sentence in split_sentences(doc.page_content)))
+    for i in range(0, len(texts), batch_size):
+        embedding.embed_documents(texts[i:i + batch_size])
+    return len(texts)
+
+
+class ExtractiveContextFilter:
+    """Local replacement of the llm context filtering pass.
+
+    The retrieved context is split into sentences which are ranked by the
+    cosine similarity of their embedding to the question's. The best ones
+    are kept in document order. The sentences of the chunks are embedded
+    into the cache at ingestion (precompute_sentence_embeddings), so with
+    the cached embedding model a question only embeds the question, which
+    the retrieval already did.
+
+    Args:
+        embedding: Langchain embedding model, ideally a CachedEmbeddings.
+        max_sentences (int, optional): sentences kept.
+        min_ratio (float, optional): min similarity relative to the best sentence.
+    """
+
+    def __init__(self, embedding, max_sentences=CONTEXT_FILTER_MAX_SENTENCES,
+                 min_ratio=CONTEXT_FILTER_MIN_RATIO):
+        self.embedding = embedding
+        self.max_sentences = max_sentences
+        self.min_ratio = min_ratio
+
+    def _sentences(self, docs):
+        # per chunk, like at ingestion, so the sentence vectors are cached
+        return chunk_sentences(docs)
+
+    def _select(self, sentences, question_vector, sentence_vectors):
+        question_vector = np.asarray(question_vector, dtype=np.float32)
+        sentence_vectors = np.asarray(sentence_vectors, dtype=np.float32)
+        norms = np.linalg.norm(sentence_vectors, axis=1) * (np.linalg.norm(question_vector) or 1.0)
+        scores = sentence_vectors @ question_vector / np.maximum(norms, 1e-12)
+
+        top = np.argsort(-scores)[:self.max_sentences]
+        # the ratio cutoff only makes sense for a positive best score, it
+        # would be above the best one otherwise
+        if scores[top[0]] > 0:
+            top = [i for i in top if scores[i] >= self.min_ratio * scores[top[0]]]
+        # back to document order, one paragraph per passage
+        paragraphs = {}
+        for i in sorted(top):
+            doc_index, sentence = sentences[i]
+            paragraphs.setdefault(doc_index, []).append(sentence)
+        return "\n\n".join(" ".join(paragraph) for paragraph in paragraphs.values())
+
+    def filter(self, question, docs):
+        """Returns the context text made of the sentences relevant to the question."""
+        sentences = self._sentences(docs)
+        if not sentences:
+            return ""
+        question_vector = self.embedding.embed_query(question)
+        sentence_vectors = self.embedding.embed_documents([sentence for _, sentence in sentences])
+        return self._select(sentences, question_vector, sentence_vectors)
+
+    async def afilter(self, question, docs):
+        sentences = self._sentences(docs)
+        if not sentences:
+            return ""
+        question_vector = await self.embedding.aembed_query(question)
+        sentence_vectors = await self.embedding.aembed_documents([sentence for _, sentence in sentences])
+        return self._select(sentences, question_vector, sentence_vectors)
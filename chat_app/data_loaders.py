@@ -1,6 +1,5 @@
 import os, sys
 import json
-import pandas as pd
 
 
 def load_pdfs(path):
@@ -15,21 +14,15 @@ def load_pdfs(path):
         type: List of Langchain Docment Class
     """    
 
-    from langchain_community.document_loaders import DirectoryLoader
-    from langchain_community.document_loaders import PyPDFLoader
+    import glob
+    from .pipeline import parse_files
 
-
-    # load all pdfs in the directory
-    loader = DirectoryLoader(
-        path, 
-        use_multithreading=True,
-        loader_cls=PyPDFLoader,
-        show_progress=True,
-        recursive=True
-    )
+    # parse all pdfs in the directory across a process pool, pypdf is
+    # pure python so threads would be serialized by the GIL
+    paths = sorted(glob.glob(f"{path}/**/*.pdf", recursive=True))
 
     # returns a list of pages as Document types
-    pdf_docs = loader.load() 
+    pdf_docs = [page for _, pages in parse_files(paths) for page in pages]
     return pdf_docs
 
 
@@ -74,21 +67,14 @@ def load_docx_files(path):
         type: List of Langchain Docment Class
     """    
 
-    from langchain_community.document_loaders import DirectoryLoader
-    from langchain_community.document_loaders import UnstructuredWordDocumentLoader
+    import glob
+    from .pipeline import parse_files
 
-    # load all pdfs in the directory
-    loader = DirectoryLoader(
-        path, glob="./*.docx",
-        use_multithreading=True,
-        loader_cls=UnstructuredWordDocumentLoader,
-        show_progress=True,
-        recursive=True,
-        silent_errors = False
-    )
+    # parse all word docs in the directory across a process pool
+    paths = sorted(glob.glob(f"{path}/**/*.docx", recursive=True))
 
     # returns a list of pages as Document types
-    word_docs = loader.load() 
+    word_docs = [page for _, pages in parse_files(paths) for page in pages]
     return word_docs
 
 
@@ -138,3 +124,42 @@ def load_html_files(path):
     htmls = loader.load() 
     return htmls
 
+
+def list_source_files(docs_path):
+    """Lists the pdf and docx files which are ingested into the vector db.
+
+    Args:
+        docs_path (str): data directory containing the pdfs/ & docx/ sub folders.
+
+    Returns:
+        list(str): sorted file paths
+    """
+    import glob
+
+    pdfs = glob.glob(f"{docs_path}/pdfs/**/*.pdf", recursive=True)
+    word_docs = glob.glob(f"{docs_path}/docx/**/*.docx", recursive=True)
+    return sorted(pdfs + word_docs)
+
+
+def load_file(path):
+    """Loads a single pdf or docx file and return its pages.
+
+    Args:
+        path (str): path of the pdf or docx file.
+
+    Returns:
+        type: List of Langchain Docment Class
+    """
+
+    from langchain_community.document_loaders import PyPDFLoader
+    from langchain_community.document_loaders import UnstructuredWordDocumentLoader
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".pdf":
+        loader = PyPDFLoader(path)
+    elif ext == ".docx":
+        loader = UnstructuredWordDocumentLoader(path)
+    else:
+        raise ValueError(f"Unsupported file type: {path}")
+
+    return loader.load()
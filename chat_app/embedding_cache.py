@@ -0,0 +1,168 @@
+import os, time
+import sqlite3
+import threading
+from array import array
+
+from langchain_core.embeddings import Embeddings
+
+from .manifest import text_hash
+from . import metrics
+
+
+# on-disk embedding cache, stored next to the documents (relative to the docs path)
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite")
+# max vectors kept, least recently used ones are evicted beyond it
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", 200_000))
+# access times of cache hits are written in batches, every this many hits
+# or seconds, so reads don't commit
+EMBEDDING_CACHE_TOUCH_BATCH = int(os.environ.get("EMBEDDING_CACHE_TOUCH_BATCH", 256))
+EMBEDDING_CACHE_TOUCH_INTERVAL = float(os.environ.get("EMBEDDING_CACHE_TOUCH_INTERVAL", 30))
+
+
+def normalize_text(text):
+    # collapse whitespace so re-extracted text with other spacing still hits
+    return " ".join(text.split())
+
+
+class CachedEmbeddings(Embeddings):
+    """Wraps a Langchain embedding model with a persistent sqlite cache.
+
+    Vectors are keyed by the model name plus the hash of the normalized text
+    and stored as packed float32 blobs. The cache is bounded to max_entries,
+    evicting the least recently used vectors. The entry count is kept in
+    memory and the access times of hits are written lazily in batches, a
+    lookup never writes to the database.
+    """
+
+    def __init__(self, embedding, path=os.path.join("data", EMBEDDING_CACHE_PATH),
+                 max_entries=EMBEDDING_CACHE_MAX_ENTRIES, model_name=None):
+        self.embedding = embedding
+        self.model_name = model_name or getattr(embedding, "model", type(embedding).__name__)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+        # counted once, then maintained by the inserts & evictions
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        # key -> last access time of the hits not written yet
+        self._touched = {}
+        self._touched_since = time.monotonic()
+
+    def _key(self, text):
+        return text_hash(f"{self.model_name}\0{normalize_text(text)}")
+
+    def _get_many(self, keys):
+        found = {}
+        with self._lock:
+            # sqlite limits the number of bound parameters, query in slices
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                    batch).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self._touched.update((key, now) for key in found)
+                if (len(self._touched) >= EMBEDDING_CACHE_TOUCH_BATCH or
+                        time.monotonic() - self._touched_since > EMBEDDING_CACHE_TOUCH_INTERVAL):
+                    self._flush_touched()
+                    self._conn.commit()
+        return {key: array("f", blob).tolist() for key, blob in found.items()}
+
+    def _flush_touched(self):
+        # called under the lock, the caller commits
+        if self._touched:
+            self._conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                                   [(now, key) for key, now in self._touched.items()])
+            self._touched = {}
+        self._touched_since = time.monotonic()
+
+    def flush(self):
+        """Writes the pending access times."""
+        with self._lock:
+            self._flush_touched()
+            self._conn.commit()
+
+    def _put_many(self, items):
+        now = time.time()
+        with self._lock:
+            # the vector of a key never changes, existing ones are kept
+            cursor = self._conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, array("f", vector).tobytes(), now) for key, vector in items])
+            self._count += max(cursor.rowcount, 0)
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        if self._count <= self.max_entries:
+            return
+        # recent hits must count before picking the least recently used
+        self._flush_touched()
+        cursor = self._conn.execute(
+            "DELETE FROM embeddings WHERE key IN "
+            "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+            (self._count - self.max_entries,))
+        self._count -= max(cursor.rowcount, 0)
+        if cursor.rowcount <= 0:
+            # other processes share the file, count again
+            self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def embed_documents(self, texts):
+        keys = [self._key(text) for text in texts]
+        cached = self._get_many(list(set(keys)))
+
+        # embed each missing text once, even if repeated in the batch
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        metrics.increment("embedding_cache_hit", len(texts) - len(missing))
+        metrics.increment("embedding_cache_miss", len(missing))
+
+        if missing:
+            start = time.perf_counter()
+            vectors = self.embedding.embed_documents(list(missing.values()))
+            metrics.observe("embedding_seconds", time.perf_counter() - start, call="documents")
+            new_items = list(zip(missing.keys(), vectors))
+            self._put_many(new_items)
+            cached.update(new_items)
+
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text):
+        key = self._key(text)
+        cached = self._get_many([key])
+        if key in cached:
+            self.hits += 1
+            metrics.increment("embedding_cache_hit")
+            return cached[key]
+
+        self.misses += 1
+        metrics.increment("embedding_cache_miss")
+        start = time.perf_counter()
+        vector = self.embedding.embed_query(text)
+        metrics.observe("embedding_seconds", time.perf_counter() - start, call="query")
+        self._put_many([(key, vector)])
+        return vector
+
+
+def get_cached_embeddings(embedding, docs_path="data"):
+    """Returns the embedding model wrapped with the on-disk cache of docs_path."""
+    if isinstance(embedding, CachedEmbeddings):
+        return embedding
+    return CachedEmbeddings(embedding, os.path.join(docs_path, EMBEDDING_CACHE_PATH))
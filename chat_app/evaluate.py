@@ -0,0 +1,288 @@
+import os, json, time
+import asyncio
+from typing import Any, List
+
+import numpy as np
+import pandas as pd
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from .resources import get_registry, rag_methods, DEFAULT_MODEL
+from .retrievers import RETRIEVER_MODE, RETRIEVER_K, HYBRID_FETCH_K
+from .rerank import RERANKER, RERANKER_MODEL, RERANK_TOP_N, RERANK_FETCH_K, RERANK_TIME_BUDGET
+from .utils import VECTOR_STORE_BACKEND
+from .vector_store import LOCAL_INDEX_TYPE, ANN_NPROBE, ANN_EF
+from .manifest import MANIFEST_NAME, file_hash, text_hash
+from .session_store import SessionMemory, SessionStore, SqliteBackend
+from .tracing import RagTracer
+
+
+# retrievals, scores & timings of earlier runs
+EVAL_CACHE_PATH = os.environ.get("EVAL_CACHE_PATH", "data/eval_cache.sqlite")
+# llm generations of earlier runs (langchain llm cache)
+EVAL_LLM_CACHE_PATH = os.environ.get("EVAL_LLM_CACHE_PATH", "data/eval_llm_cache.sqlite")
+# questions answered at once, across all the rag modes
+EVAL_CONCURRENCY = int(os.environ.get("EVAL_CONCURRENCY", 8))
+EVAL_METRICS = ["faithfulness", "answer_relevancy", "context_precision", "context_recall"]
+
+# $ per 1k (prompt, completion) tokens
+MODEL_PRICES = {"gpt-3.5-turbo": (0.0005, 0.0015), "gpt-4-turbo": (0.01, 0.03),
+                "gpt-4o": (0.005, 0.015), "gpt-4": (0.03, 0.06)}
+
+
+def _dumps_docs(docs):
+    return json.dumps([{"page_content": doc.page_content, "metadata": doc.metadata} for doc in docs],
+                      default=float)
+
+
+def _loads_docs(value):
+    return [Document(**doc) for doc in json.loads(value)]
+
+
+class CachedRetriever(BaseRetriever):
+    """Keeps the documents retrieved per query on disk, reruns of an
+    evaluation only search for the queries they did not see.
+
+    The namespace has to change with everything the results depend on
+    (rag mode, retriever settings, ingested documents).
+    """
+
+    retriever: BaseRetriever
+    backend: Any
+    namespace: str
+
+    def _key(self, query):
+        return f"retrieval:{self.namespace}:{text_hash(query)}"
+
+    def _get_relevant_documents(self, query, *, run_manager) -> List[Document]:
+        cached = self.backend.get(self._key(query))
+        if cached is not None:
+            return _loads_docs(cached)
+        docs = self.retriever.invoke(query, {"callbacks": run_manager.get_child()})
+        self.backend.set(self._key(query), _dumps_docs(docs))
+        return docs
+
+    async def _aget_relevant_documents(self, query, *, run_manager) -> List[Document]:
+        # sqlite calls block, keep them off the event loop
+        cached = await asyncio.to_thread(self.backend.get, self._key(query))
+        if cached is not None:
+            return _loads_docs(cached)
+        docs = await self.retriever.ainvoke(query, {"callbacks": run_manager.get_child()})
+        await asyncio.to_thread(self.backend.set, self._key(query), _dumps_docs(docs))
+        return docs
+
+
+def retrieval_fingerprint(docs_path="data", embedding_model=""):
+    """Changes with everything the retrieved documents depend on: the
+    retriever, reranker & vector store settings, the embedding model and
+    the ingested documents."""
+    manifest_path = os.path.join(docs_path, MANIFEST_NAME)
+    manifest = file_hash(manifest_path) if os.path.exists(manifest_path) else ""
+    settings = [RETRIEVER_MODE, RETRIEVER_K, HYBRID_FETCH_K,
+                RERANKER, RERANKER_MODEL, RERANK_TOP_N, RERANK_FETCH_K, RERANK_TIME_BUDGET,
+                VECTOR_STORE_BACKEND, LOCAL_INDEX_TYPE, ANN_NPROBE, ANN_EF,
+                embedding_model, manifest]
+    return text_hash(":".join(str(setting) for setting in settings))[:16]
+
+
+def load_testset(path, limit=None):
+    """Reads the ragas testset csv (scripts/test_data_gen.py).
+
+    Returns:
+        list(dict): {"question", "ground_truth"} records
+    """
+    df = pd.read_csv(path).dropna(subset=["question"])
+    if "ground_truth" not in df:
+        df["ground_truth"] = ""
+    df["ground_truth"] = df["ground_truth"].fillna("")
+    records = df[["question", "ground_truth"]].to_dict("records")
+    return records[:limit] if limit else records
+
+
+def _record_key(record):
+    # the timings & scores belong to an answer & its contexts
+    return "record:" + text_hash(json.dumps([record["mode"], record["question"], record["answer"],
+                                             record["contexts"], record["ground_truth"]]))
+
+
+async def answer_all(chains, testset, backend, concurrency=EVAL_CONCURRENCY, keep_timings=True):
+    """Runs the testset through every chain, concurrency questions at once.
+
+    Each question is a new session. With keep_timings, the timings & token
+    counts of an answer are kept from the run which first produced it, so
+    reruns served from the caches report the original timings.
+
+    Returns:
+        list(dict): one record per (mode, question)
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def answer(mode, chain, i, item):
+        async with semaphore:
+            session_id = f"eval-{mode}-{i}"
+            tracer = RagTracer(mode, session_id)
+            record = {"mode": mode, "question": item["question"], "ground_truth": item["ground_truth"]}
+            try:
+                # invoke, not stream, the llm cache only serves invoked calls
+                output = await chain.ainvoke({"question": item["question"], "session_id": session_id},
+                                             tracer.config)
+            except Exception as e:
+                print(f"{mode}: question {i} failed, {type(e).__name__}: {e}")
+                return {**record, "answer": None, "contexts": [], "error": str(e), "scores": {}}
+            trace = tracer.finish(output["answer"].content)
+
+        record.update(answer=output["answer"].content,
+                      contexts=[doc.page_content for doc in output["docs"]], error=None)
+        key = _record_key(record)
+        stored = backend.get(key)
+        stored = json.loads(stored) if stored is not None else {"scores": {}}
+        if "seconds" not in stored or not keep_timings:
+            stored.update(seconds=trace["seconds"],
+                          prompt_tokens=sum(call["prompt_tokens"] for call in trace["llm_calls"]),
+                          completion_tokens=sum(call["completion_tokens"] for call in trace["llm_calls"]))
+            backend.set(key, json.dumps(stored))
+        return {**record, **stored}
+
+    tasks = [answer(mode, chain, i, item) for mode, chain in chains.items()
+             for i, item in enumerate(testset)]
+    return await asyncio.gather(*tasks)
+
+
+def score_records(records, backend, llm, embedding, metric_names=EVAL_METRICS,
+                  concurrency=EVAL_CONCURRENCY):
+    """Scores the answers with ragas, only the ones without stored scores."""
+    pending = [record for record in records if record["answer"] is not None
+               and any(name not in record["scores"] for name in metric_names)]
+    print(f"scoring {len(pending)} answers, {len(records) - len(pending)} already scored")
+    if not pending:
+        return records
+
+    from datasets import Dataset
+    from ragas import evaluate
+    from ragas import metrics as ragas_metrics
+    from ragas.run_config import RunConfig
+
+    dataset = Dataset.from_dict({key: [record[key] for record in pending]
+                                 for key in ("question", "answer", "contexts", "ground_truth")})
+    result = evaluate(dataset, metrics=[getattr(ragas_metrics, name) for name in metric_names],
+                      llm=llm, embeddings=embedding, run_config=RunConfig(max_workers=concurrency))
+    for record, scores in zip(pending, result.to_pandas()[metric_names].to_dict("records")):
+        record["scores"].update({name: (None if pd.isna(value) else float(value))
+                                 for name, value in scores.items()})
+        stored = {key: record[key] for key in ("seconds", "prompt_tokens", "completion_tokens", "scores")}
+        backend.set(_record_key(record), json.dumps(stored))
+    return records
+
+
+def summarize(records, model=DEFAULT_MODEL, metric_names=EVAL_METRICS):
+    """Quality vs latency & cost per rag mode."""
+    prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    rows = []
+    for mode in dict.fromkeys(record["mode"] for record in records):
+        answered = [record for record in records if record["mode"] == mode and record["answer"] is not None]
+        row = {"mode": mode, "questions": len(answered),
+               "errors": sum(record["mode"] == mode for record in records) - len(answered)}
+        for name in metric_names:
+            scores = [record["scores"].get(name) for record in answered]
+            scores = [score for score in scores if score is not None]
+            row[name] = float(np.mean(scores)) if scores else None
+        seconds = [record["seconds"] for record in answered]
+        row["latency_p50"] = float(np.percentile(seconds, 50)) if seconds else None
+        row["latency_p95"] = float(np.percentile(seconds, 95)) if seconds else None
+        row["tokens"] = (float(np.mean([record["prompt_tokens"] + record["completion_tokens"]
+                                        for record in answered])) if answered else None)
+        costs = [(record["prompt_tokens"] * prompt_price + record["completion_tokens"] * completion_price) / 1000
+                 for record in answered]
+        row["cost_per_question"] = float(np.mean(costs)) if costs else None
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def run_evaluation(testset_path, modes, api_key, model=DEFAULT_MODEL, judge_model=DEFAULT_MODEL,
+                   docs_path="data", limit=None, concurrency=EVAL_CONCURRENCY,
+                   metric_names=EVAL_METRICS, use_cache=True):
+    """Answers the testset with every rag mode & scores the answers.
+
+    Args:
+        testset_path (str): ragas testset csv.
+        modes (list(str)): rag modes, keys of resources.rag_methods.
+        api_key (str): OpenAI api key.
+        model (str, optional): model answering the questions.
+        judge_model (str, optional): model the ragas metrics use.
+        docs_path (str, optional): data directory of the ingested documents.
+        limit (int, optional): only evaluate the first questions.
+        concurrency (int, optional): questions answered / scored at once.
+        metric_names (list(str), optional): ragas metrics.
+        use_cache (bool, optional): reuse the retrievals, generations &
+            timings of earlier runs. Scores of unchanged answers are always reused.
+
+    Returns:
+        tuple(pd.DataFrame, pd.DataFrame): per question results, per mode summary
+    """
+    if use_cache:
+        from langchain.globals import set_llm_cache
+        from langchain_community.cache import SQLiteCache
+
+        # the same prompt to the same model is answered from disk
+        set_llm_cache(SQLiteCache(database_path=EVAL_LLM_CACHE_PATH))
+
+    backend = SqliteBackend(EVAL_CACHE_PATH)
+    registry = get_registry(docs_path)
+    llm = registry.llm(api_key, model)
+    embedding = registry.embedding(api_key)
+    fingerprint = retrieval_fingerprint(docs_path, getattr(embedding, "model_name", type(embedding).__name__))
+
+    chains = {}
+    for mode in modes:
+        retriever = registry.retriever(api_key)
+        if use_cache:
+            retriever = CachedRetriever(retriever=retriever, backend=backend,
+                                        namespace=f"{mode}:{fingerprint}")
+        # single turn sessions kept in memory, no answer cache: every
+        # question goes through the whole chain
+        memory = SessionMemory(llm, SessionStore())
+        chains[mode] = rag_methods[mode](llm, memory, retriever)
+
+    testset = load_testset(testset_path, limit)
+    print(f"answering {len(testset)} questions with {', '.join(modes)}")
+    start = time.perf_counter()
+    records = asyncio.run(answer_all(chains, testset, backend, concurrency, keep_timings=use_cache))
+    print(f"answered in {time.perf_counter() - start:.1f}s")
+
+    records = score_records(records, backend, registry.llm(api_key, judge_model),
+                            embedding, metric_names, concurrency)
+
+    results = pd.DataFrame([{**{key: value for key, value in record.items() if key != "scores"},
+                             **record["scores"]} for record in records])
+    return results, summarize(records, model, metric_names)
+
+
+if __name__ == "__main__":
+
+    import argparse
+    from dotenv import load_dotenv
+
+    load_dotenv(".env")
+
+    parser = argparse.ArgumentParser(description="Answers the ragas testset with the rag modes, "
+                                                 "scores the answers & compares quality, latency and cost.")
+    parser.add_argument("--testset", default="scripts/test_data.csv")
+    parser.add_argument("--modes", nargs="+", choices=list(rag_methods), default=list(rag_methods))
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--judge-model", default=DEFAULT_MODEL)
+    parser.add_argument("--metrics", nargs="+", default=EVAL_METRICS)
+    parser.add_argument("--limit", type=int)
+    parser.add_argument("--concurrency", type=int, default=EVAL_CONCURRENCY)
+    parser.add_argument("--no-cache", action="store_true",
+                        help="recompute the retrievals & generations, e.g. to measure fresh latencies")
+    parser.add_argument("--output", default="eval_results.csv")
+    args = parser.parse_args()
+
+    results, summary = run_evaluation(args.testset, args.modes, os.environ["OPENAI_API_KEY"],
+                                      args.model, args.judge_model, limit=args.limit,
+                                      concurrency=args.concurrency, metric_names=args.metrics,
+                                      use_cache=not args.no_cache)
+
+    results.to_csv(args.output, index=False)
+    summary.to_csv(args.output.replace(".csv", "_summary.csv"), index=False)
+    print(summary.to_string(index=False, float_format=lambda value: f"{value:.4f}"))
@@ -0,0 +1,292 @@
+import os, re, json
+
+import numpy as np
+from langchain_core.documents import Document
+
+from .data_loaders import load_file
+from .answer_cache import question_identifiers
+from . import metrics
+
+
+# precomputed question/answer pairs, stored next to the documents (relative
+# to the docs path)
+FAQ_INDEX_PATH = os.environ.get("FAQ_INDEX_PATH", "faq_index")
+# a question at least this similar to a known one, with the same course
+# codes & numbers, is answered from the index. Like the answer cache, the
+# answer is returned without any llm call, so the same bar applies
+FAQ_THRESHOLD = float(os.environ.get("FAQ_THRESHOLD", 0.95))
+
+# the documents holding question/answer pairs
+_FAQ_SOURCE_RE = re.compile(r"faq|frequently asked|canned responses|mock questions", re.I)
+_MOCK_Q_RE = re.compile(r"^Q\d+:\s*(.+)$")
+_MOCK_A_RE = re.compile(r"^A\d+:\s*(.+)$")
+_CANNED_RE = re.compile(r"^Response \d+:\s*(?:Sent(?: out)?\s+)?(.+)$", re.I)
+_NUMBERING_RE = re.compile(r"^\d+[.)]\s*")
+_MIN_ANSWER_CHARS = 20
+
+
+def is_faq_source(path):
+    return bool(_FAQ_SOURCE_RE.search(os.path.basename(path)))
+
+
+def _clean(text):
+    return " ".join(text.split()).strip('"“” ')
+
+
+def _mock_pairs(lines):
+    # Q01: "question" / A01: "answer" lines
+    pairs, question = [], None
+    for line in lines:
+        if _MOCK_Q_RE.match(line):
+            question = _MOCK_Q_RE.match(line).group(1)
+        elif question and _MOCK_A_RE.match(line):
+            pairs.append((question, _MOCK_A_RE.match(line).group(1)))
+            question = None
+    return pairs
+
+
+def _is_heading(line):
+    return len(line) <= 60 and not line.endswith((".", "?", "!", ":", ")", ","))
+
+
+def _canned_pairs(lines):
+    # "Response 1: Sent out when <situation>." followed by the response
+    pairs, current = [], None
+    for line in lines:
+        match = _CANNED_RE.match(line)
+        if match:
+            if current:
+                pairs.append(current)
+            current = (match.group(1), [])
+        elif current and line:
+            if _is_heading(line) and current[1]:
+                # next section of the document
+                pairs.append(current)
+                current = None
+            else:
+                current[1].append(line)
+    if current:
+        pairs.append(current)
+    return [(situation, " ".join(answer)) for situation, answer in pairs]
+
+
+def _question_at(lines, i):
+    """The question starting at line i (up to 3 lines ending with "?"), and
+    the index of the line after it."""
+    parts = []
+    for j in range(i, min(i + 3, len(lines))):
+        line = lines[j]
+        if not line or (parts and _NUMBERING_RE.match(line)):
+            return None, i
+        parts.append(line)
+        if line.endswith("?"):
+            question = _NUMBERING_RE.sub("", " ".join(parts))
+            if question[:1].isupper() and 10 <= len(question) <= 300:
+                return question, j + 1
+            return None, i
+        if line.endswith("."):
+            return None, i
+    return None, i
+
+
+def _faq_pairs(lines):
+    # question lines, each followed by its answer
+    pairs, current = [], None
+    i = 0
+    while i < len(lines):
+        question, next_i = _question_at(lines, i)
+        shorter, shorter_next = _question_at(lines, i + 1) if question else (None, i)
+        if shorter and shorter_next == next_i:
+            # line i is a heading above the question
+            question = None
+        if question:
+            if current:
+                pairs.append(current)
+            current = (question, [])
+            i = next_i
+            continue
+        if current and lines[i]:
+            current[1].append(lines[i])
+        i += 1
+    if current:
+        pairs.append(current)
+    return [(question, " ".join(answer)) for question, answer in pairs]
+
+
+def _is_answer(text):
+    # answers starting mid sentence or with a page header come from
+    # scrambled page layouts
+    return (len(text) >= _MIN_ANSWER_CHARS and not text[0].islower()
+            and not all(word.isupper() for word in text.split()[:3]))
+
+
+def extract_qa_pairs(path, text):
+    """Extracts the question/answer pairs of an FAQ like document.
+
+    Args:
+        path (str): the document path, picks the format.
+        text (str): the document text.
+
+    Returns:
+        list(dict): {"question", "answer", "source"} records
+    """
+    lines = [line.strip() for line in text.splitlines()]
+    name = os.path.basename(path).lower()
+    if "mock questions" in name:
+        pairs = _mock_pairs(lines)
+    elif "canned responses" in name:
+        pairs = _canned_pairs(lines)
+    else:
+        pairs = _faq_pairs(lines)
+    return [{"question": _clean(question), "answer": _clean(answer), "source": path}
+            for question, answer in pairs if _is_answer(_clean(answer))]
+
+
+class FAQIndex:
+    """Question/answer pairs with the normalized embeddings of the questions."""
+
+    def __init__(self, entries, vectors, sources):
+        self.entries = entries
+        self.vectors = vectors
+        self.sources = sources
+        self.identifiers = [question_identifiers(entry["question"]) for entry in entries]
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, "faq.json"))
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "questions.npy"), self.vectors)
+        with open(os.path.join(path, "faq.json"), "w") as f:
+            json.dump({"sources": self.sources, "entries": self.entries}, f, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "faq.json")) as f:
+            data = json.load(f)
+        vectors = np.load(os.path.join(path, "questions.npy"))
+        return cls(data["entries"], vectors, data["sources"])
+
+    def match(self, vector, identifiers=None):
+        """Returns (entry, similarity) of the closest question, only among the
+        questions with the given course codes & numbers if any are given."""
+        if not len(self.entries):
+            return None, 0.0
+        scores = self.vectors @ vector
+        if identifiers is not None:
+            # a question about another course / number is not a match
+            scores = np.where([other == identifiers for other in self.identifiers], scores, -np.inf)
+        best = int(np.argmax(scores))
+        if not np.isfinite(scores[best]):
+            return None, 0.0
+        return self.entries[best], float(scores[best])
+
+    def bind(self, embedding, threshold=FAQ_THRESHOLD):
+        return BoundFAQIndex(self, embedding, threshold)
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class BoundFAQIndex:
+    """FAQ index lookups with an embedding model, same lookup interface as
+    the answer cache, a match is returned as a cached answer."""
+
+    def __init__(self, index, embedding, threshold=FAQ_THRESHOLD):
+        self.index = index
+        self.embedding = embedding
+        self.threshold = threshold
+
+    def lookup(self, question):
+        vector = _normalize(self.embedding.embed_query(question))
+        entry, score = self.index.match(vector, question_identifiers(question))
+        if entry is None or score < self.threshold:
+            metrics.increment("faq_miss")
+            return None, vector
+        metrics.increment("faq_hit")
+        doc = Document(page_content=f"{entry['question']}\n{entry['answer']}",
+                       metadata={"source": entry["source"], "faq_score": score})
+        return {"answer": entry["answer"], "docs": [doc]}, vector
+
+    def store(self, question, answer, docs, vector=None):
+        # the index only changes at ingestion
+        pass
+
+
+class FAQFirstCache:
+    """Looks questions up in the FAQ index first, then in the answer cache.
+    New answers go to the answer cache."""
+
+    def __init__(self, faq, answer_cache=None):
+        self.faq = faq
+        self.answer_cache = answer_cache
+
+    def lookup(self, question):
+        entry, vector = self.faq.lookup(question)
+        if entry is not None or self.answer_cache is None:
+            # nothing to store on a miss without answer cache
+            return entry, None
+        # same embedding model, the question is not embedded again
+        return self.answer_cache.lookup(question, vector)
+
+    def store(self, question, answer, docs, vector=None):
+        if self.answer_cache is not None:
+            self.answer_cache.store(question, answer, docs, vector)
+
+
+def build_faq_index(docs_path, embed_model, manifest, path=None):
+    """Extracts the question/answer pairs of the FAQ documents & embeds the
+    questions, skipped when the FAQ documents did not change.
+
+    Args:
+        docs_path (str): data directory containing the pdfs/ & docx/ sub folders.
+        embed_model: Langchain embedding model.
+        manifest (IngestManifest): the synced ingestion manifest.
+        path (str, optional): index directory. Defaults to FAQ_INDEX_PATH in docs_path.
+
+    Returns:
+        FAQIndex: the index
+    """
+    path = path or os.path.join(docs_path, FAQ_INDEX_PATH)
+    sources = {source: entry["sha256"] for source, entry in manifest.files.items()
+               if is_faq_source(source)}
+    if FAQIndex.exists(path):
+        index = FAQIndex.load(path)
+        if index.sources == sources:
+            return index
+
+    entries = []
+    for source in sorted(sources):
+        text = "\n".join(page.page_content for page in load_file(manifest.source_path(source)))
+        entries.extend(extract_qa_pairs(source, text))
+
+    vectors = (_normalize(embed_model.embed_documents([entry["question"] for entry in entries]))
+               if entries else np.zeros((0, 0), dtype=np.float32))
+    index = FAQIndex(entries, vectors, sources)
+    index.save(path)
+    print(f"faq index: {len(entries)} question/answer pairs from {len(sources)} documents")
+    return index
+
+
+# loaded index per path & file version
+_faq_indexes = {}
+
+
+def get_faq_index(docs_path="data"):
+    """Returns the FAQ index of docs_path, None if it was not built."""
+    path = os.path.join(docs_path, FAQ_INDEX_PATH)
+    if not FAQIndex.exists(path):
+        return None
+    version = os.stat(os.path.join(path, "faq.json")).st_mtime_ns
+    cached = _faq_indexes.get(path)
+    if cached is None or cached[0] != version:
+        cached = (version, FAQIndex.load(path))
+        _faq_indexes[path] = cached
+    return cached[1]
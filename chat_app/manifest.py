@@ -0,0 +1,162 @@
+import os, json
+import uuid
+import hashlib
+
+
+# manifest file name, stored inside the docs directory
+MANIFEST_NAME = "ingest_manifest.json"
+
+
+def file_hash(path, block_size=1 << 20):
+    """Computes the sha256 hash of a file's content.
+
+    Args:
+        path (str): path of the file to hash.
+        block_size (int, optional): bytes read per iteration. Defaults to 1MB.
+
+    Returns:
+        str: hex digest of the file content
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def text_hash(text):
+    """Returns the sha256 hex digest of a text."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def chunk_records(source, chunks):
+    """Computes the content hash and a stable vector id for every chunk of a file.
+
+    The vector id only depends on the source path and the chunk content, so
+    a chunk which survives an edit of its file keeps its id (and its vector).
+    The chunk text & metadata are kept too, they feed the local keyword index.
+
+    Args:
+        source (str): path of the file the chunks were split from.
+        chunks (list): Langchain Documents of the file.
+
+    Returns:
+        list(dict): one {"id", "sha256", "text", "metadata"} record per chunk,
+                    in chunk order
+    """
+    records = []
+    seen = {}
+    for chunk in chunks:
+        digest = text_hash(chunk.page_content)
+        # the same text can repeat inside a file, number the repeats
+        occurrence = seen.get(digest, 0)
+        seen[digest] = occurrence + 1
+        vector_id = text_hash(f"{source}\0{digest}\0{occurrence}")[:32]
+        records.append({"id": vector_id, "sha256": digest,
+                        "text": chunk.page_content, "metadata": chunk.metadata})
+    return records
+
+
+class IngestManifest:
+    """Records what has been ingested into the vector db: a content hash
+    per source file and the ids & hashes of the chunks embedded for it.
+
+    The generation identifies the index the manifest describes, a new one
+    is started whenever the index is cleared or created.
+
+    Files are keyed by their path relative to the manifest's directory (the
+    docs path), so "data" and "/app/data" find the same entries. The
+    methods take the paths as found on disk.
+    """
+
+    def __init__(self, path, files=None, generation=None):
+        self.path = path
+        self.root = os.path.dirname(path)
+        self.files = files or {}
+        self.generation = generation or uuid.uuid4().hex
+
+    def key(self, path):
+        """The manifest key of a file path."""
+        return os.path.relpath(path, self.root or ".").replace(os.sep, "/")
+
+    def source_path(self, key):
+        """The file path of a manifest key."""
+        return os.path.join(self.root, *key.split("/"))
+
+    @classmethod
+    def load(cls, path):
+        """Loads the manifest from disk, an empty manifest if not found."""
+        if not os.path.exists(path):
+            return cls(path)
+        with open(path) as f:
+            data = json.load(f)
+        manifest = cls(path, data.get("files", {}), data.get("generation"))
+        if data.get("keys") != "relative":
+            # older manifests were keyed by the docs_path joined paths
+            manifest.files = {manifest.key(source): entry for source, entry in manifest.files.items()}
+        return manifest
+
+    @property
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def save(self):
+        # write to a temp file first so an interrupted save never corrupts it
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"generation": self.generation, "keys": "relative", "files": self.files},
+                      f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def diff(self, sources):
+        """Compares the source files on disk against the manifest.
+
+        The content hash decides if a file changed, size & mtime are only
+        used to skip re-hashing files which were not touched.
+
+        Args:
+            sources (list): paths of the source files currently on disk.
+
+        Returns:
+            tuple: (changed, removed) where changed is a list of (path, sha256)
+                   for new or modified files and removed a list of paths
+        """
+        changed = []
+        for path in sources:
+            stat = os.stat(path)
+            entry = self.files.get(self.key(path))
+            if (entry is not None and entry["size"] == stat.st_size
+                    and entry["mtime"] == stat.st_mtime):
+                continue
+            digest = file_hash(path)
+            if entry is not None and entry["sha256"] == digest:
+                # touched but same content, only refresh the stat info
+                entry["size"], entry["mtime"] = stat.st_size, stat.st_mtime
+                continue
+            changed.append((path, digest))
+
+        current = {self.key(path) for path in sources}
+        removed = [self.source_path(key) for key in self.files if key not in current]
+        return changed, removed
+
+    def chunks(self):
+        """Yields the chunk records of all the ingested files."""
+        for path in sorted(self.files):
+            yield from self.files[path].get("chunks", [])
+
+    def chunk_ids(self, path):
+        """Returns the vector ids of the chunks ingested for a file."""
+        entry = self.files.get(self.key(path), {})
+        return [chunk["id"] for chunk in entry.get("chunks", [])]
+
+    def update(self, path, digest, chunks):
+        stat = os.stat(path)
+        self.files[self.key(path)] = {
+            "sha256": digest,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "chunks": chunks,
+        }
+
+    def remove(self, path):
+        self.files.pop(self.key(path), None)
@@ -0,0 +1,115 @@
+import os, json
+import threading
+from bisect import bisect_left
+from collections import Counter
+
+
+# process wide counters
+_counters = Counter()
+# histograms keyed by (name, labels), e.g. ("stage_seconds", (("stage", "retrieve"),))
+_histograms = {}
+_lock = threading.Lock()
+
+# prometheus metric names are prefixed with it
+METRICS_PREFIX = "bullbuddy"
+# request traces are appended to this jsonl file, disabled when empty
+TRACE_PATH = os.environ.get("TRACE_PATH", "")
+
+# histogram bucket upper bounds
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+TOKENS_BUCKETS = (16, 64, 128, 256, 512, 1024, 2048, 4096)
+RATE_BUCKETS = (5, 10, 20, 40, 80, 160)
+
+
+def increment(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def get(name):
+    return _counters[name]
+
+
+def ratio(name, other):
+    """Share of name in name + other, e.g. a hit rate from hits & misses."""
+    total = _counters[name] + _counters[other]
+    return _counters[name] / total if total else 0.0
+
+
+def _buckets_for(name):
+    if name.endswith("_seconds"):
+        return SECONDS_BUCKETS
+    if name.endswith("_tokens"):
+        return TOKENS_BUCKETS
+    return RATE_BUCKETS
+
+
+def observe(name, value, **labels):
+    """Records a value in a histogram, the buckets follow the name suffix
+    (_seconds, _tokens, else rates)."""
+    with _lock:
+        key = (name, tuple(sorted(labels.items())))
+        if key not in _histograms:
+            buckets = _buckets_for(name)
+            _histograms[key] = {"buckets": buckets, "counts": [0] * (len(buckets) + 1),
+                                "sum": 0.0, "count": 0}
+        histogram = _histograms[key]
+        histogram["counts"][bisect_left(histogram["buckets"], value)] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+
+def snapshot():
+    with _lock:
+        return dict(_counters)
+
+
+def histogram_snapshot():
+    """Returns {(name, labels): {"count", "sum", "mean"}}."""
+    with _lock:
+        return {key: {"count": h["count"], "sum": h["sum"],
+                      "mean": h["sum"] / h["count"] if h["count"] else 0.0}
+                for key, h in _histograms.items()}
+
+
+def prometheus_text():
+    """Renders the counters & histograms in the prometheus text format."""
+    lines = []
+    with _lock:
+        for name in sorted(_counters):
+            metric = f"{METRICS_PREFIX}_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {_counters[name]}")
+
+        typed = set()
+        for (name, labels), h in sorted(_histograms.items()):
+            metric = f"{METRICS_PREFIX}_{name}"
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} histogram")
+                typed.add(metric)
+            pairs = [f'{key}="{value}"' for key, value in labels]
+            cumulative = 0
+            for bound, count in zip([*h["buckets"], "+Inf"], h["counts"]):
+                cumulative += count
+                bucket_labels = ",".join(pairs + [f'le="{bound}"'])
+                lines.append(f"{metric}_bucket{{{bucket_labels}}} {cumulative}")
+            suffix = "{" + ",".join(pairs) + "}" if pairs else ""
+            lines.append(f"{metric}_sum{suffix} {h['sum']}")
+            lines.append(f"{metric}_count{suffix} {h['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def write_trace(trace, path=None):
+    """Appends a request trace to the jsonl trace file, if enabled."""
+    path = path or TRACE_PATH
+    if not path:
+        return
+    with _lock:
+        with open(path, "a") as f:
+            f.write(json.dumps(trace) + "\n")
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
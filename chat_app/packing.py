@@ -0,0 +1,161 @@
+import os, re
+
+from langchain_core.documents import Document
+
+
+# max tokens of retrieved context put in a prompt
+CONTEXT_MAX_TOKENS = int(os.environ.get("CONTEXT_MAX_TOKENS", 1500))
+# passages sharing this share of their word shingles are near duplicates
+NEAR_DUPLICATE_THRESHOLD = float(os.environ.get("NEAR_DUPLICATE_THRESHOLD", 0.8))
+# chunks of a page whose texts overlap by this many characters are merged
+MIN_MERGE_OVERLAP = 20
+
+# metadata scores set by the retrievers / rerankers, higher is better
+_SCORE_KEYS = ("rerank_score", "rrf_score", "score")
+_WORD_RE = re.compile(r"\w+")
+
+_encoding = None
+
+
+def use_token_estimate():
+    """Counts tokens with the ~4 characters per token estimate from now on,
+    e.g. offline where tiktoken would try to download its encoding."""
+    global _encoding
+    _encoding = False
+
+
+def count_tokens(text):
+    """Counts tokens with the local tiktoken encoding of the chat models,
+    falls back to ~4 characters per token if it cannot be loaded."""
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            print(f"tiktoken unavailable ({type(e).__name__}), estimating tokens")
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+
+def _truncate(text, max_tokens):
+    if _encoding:
+        return _encoding.decode(_encoding.encode(text, disallowed_special=())[:max_tokens])
+    return text[:max_tokens * 4]
+
+
+def _score(doc, rank):
+    # retrievers return the best documents first, the rank breaks ties
+    for key in _SCORE_KEYS:
+        if key in doc.metadata:
+            return (float(doc.metadata[key]), -rank)
+    return (0.0, -rank)
+
+
+def _text_overlap(text, other):
+    """Length of the longest suffix of text which is a prefix of other."""
+    for length in range(min(len(text), len(other)), MIN_MERGE_OVERLAP - 1, -1):
+        if text.endswith(other[:length]):
+            return length
+    return 0
+
+
+def _merge_page(passages):
+    """Merges the overlapping or adjacent chunks of one page."""
+    if all("start_index" in p["metadata"] for p in passages):
+        # chunk offsets are known, merge overlapping & touching ranges
+        passages = sorted(passages, key=lambda p: p["metadata"]["start_index"])
+        merged = [passages[0]]
+        for passage in passages[1:]:
+            last = merged[-1]
+            last_end = last["start"] + len(last["text"])
+            start = passage["metadata"]["start_index"]
+            if start <= last_end + 2:
+                end = start + len(passage["text"])
+                if end > last_end:
+                    tail = passage["text"][max(0, last_end - start):]
+                    last["text"] += tail if start < last_end else " " + tail
+                last["score"] = max(last["score"], passage["score"])
+            else:
+                merged.append(passage)
+        return merged
+
+    # else look for the chunk overlap in the texts
+    merged = list(passages)
+    changed = True
+    while changed:
+        changed = False
+        for a in merged:
+            for b in merged:
+                if a is b:
+                    continue
+                if b["text"] in a["text"]:
+                    overlap = len(b["text"])
+                    text = a["text"]
+                else:
+                    overlap = _text_overlap(a["text"], b["text"])
+                    text = a["text"] + b["text"][overlap:]
+                if overlap:
+                    a["text"] = text
+                    a["score"] = max(a["score"], b["score"])
+                    merged.remove(b)
+                    changed = True
+                    break
+            if changed:
+                break
+    return merged
+
+
+def _shingles(text, size=5):
+    words = _WORD_RE.findall(text.lower())
+    return {" ".join(words[i:i + size]) for i in range(max(1, len(words) - size + 1))}
+
+
+def pack_documents(docs, max_tokens=CONTEXT_MAX_TOKENS):
+    """Packs retrieved documents into a token budgeted context.
+
+    Overlapping or adjacent chunks of the same source & page are merged,
+    near duplicate passages are dropped, then the passages are added best
+    score first while they fit in max_tokens.
+
+    Args:
+        docs (list): retrieved Langchain Documents, best first.
+        max_tokens (int, optional): token budget. Defaults to CONTEXT_MAX_TOKENS.
+
+    Returns:
+        list: packed Documents, best first
+    """
+    pages = {}
+    for rank, doc in enumerate(docs):
+        key = (doc.metadata.get("source"), doc.metadata.get("page"))
+        passage = {"text": doc.page_content, "metadata": doc.metadata,
+                   "start": doc.metadata.get("start_index", 0), "score": _score(doc, rank)}
+        # documents without a source can't be adjacent to anything
+        if key == (None, None):
+            key = ("", rank)
+        pages.setdefault(key, []).append(passage)
+
+    passages = [p for page in pages.values() for p in _merge_page(page)]
+    passages.sort(key=lambda p: p["score"], reverse=True)
+
+    packed, kept_shingles, used = [], [], 0
+    for passage in passages:
+        shingles = _shingles(passage["text"])
+        if any(len(shingles & other) / len(shingles | other) >= NEAR_DUPLICATE_THRESHOLD
+               for other in kept_shingles):
+            continue
+        text = passage["text"]
+        tokens = count_tokens(text)
+        if used + tokens > max_tokens:
+            if packed:
+                # a smaller passage further down may still fit
+                continue
+            text = _truncate(text, max_tokens)
+            tokens = max_tokens
+        packed.append(Document(page_content=text, metadata=passage["metadata"]))
+        kept_shingles.append(shingles)
+        used += tokens
+    return packed
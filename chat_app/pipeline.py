@@ -0,0 +1,87 @@
+import os, time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from .data_loaders import load_file
+
+
+# number of parser processes, defaults to one per core
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", os.cpu_count() or 1))
+# max chunks embedded & upserted per call
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", 256))
+
+
+class PipelineStats:
+    """Collects the item counts and busy time of each ingestion stage."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+
+    def add(self, stage, items, seconds):
+        count, busy = self.stages.get(stage, (0, 0.0))
+        self.stages[stage] = (count + items, busy + seconds)
+
+    def report(self):
+        wall = time.perf_counter() - self.start
+        print(f"ingestion finished in {wall:.1f}s")
+        for stage, (count, busy) in self.stages.items():
+            rate = count / busy if busy else 0.0
+            print(f"  {stage:>6}: {count} items, {busy:.1f}s busy, {rate:.1f} items/s")
+
+
+def _parse_file(path):
+    # runs inside a worker process
+    start = time.perf_counter()
+    pages = load_file(path)
+    return path, pages, time.perf_counter() - start
+
+
+def parse_files(paths, workers=INGEST_WORKERS, stats=None):
+    """Parses files across a process pool and yields them as they complete.
+
+    At most 2 files per worker are in flight, so parsed pages never pile up
+    in memory faster than the consumer splits & embeds them.
+
+    Args:
+        paths (list): pdf/docx file paths to parse.
+        workers (int, optional): number of processes. Defaults to INGEST_WORKERS.
+        stats (PipelineStats, optional): collects the parse stage timings.
+
+    Yields:
+        tuple: (path, pages) where pages is a list of Langchain Documents
+    """
+    paths = list(paths)
+    if workers <= 1 or len(paths) <= 1:
+        # no need for a pool, parse in this process
+        for path in paths:
+            path, pages, seconds = _parse_file(path)
+            if stats is not None:
+                stats.add("parse", 1, seconds)
+            yield path, pages
+        return
+
+    pending = iter(paths)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = set()
+        for path in pending:
+            in_flight.add(executor.submit(_parse_file, path))
+            if len(in_flight) >= 2 * workers:
+                break
+
+        while in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, pages, seconds = future.result()
+                if stats is not None:
+                    stats.add("parse", 1, seconds)
+                # refill the pool before handing the pages over
+                next_path = next(pending, None)
+                if next_path is not None:
+                    in_flight.add(executor.submit(_parse_file, next_path))
+                yield path, pages
+
+
+def batched(items, batch_size=EMBED_BATCH_SIZE):
+    """Splits a list into lists of at most batch_size items."""
+    for i in range(0, len(items), batch_size):
+        yield items[i:i + batch_size]
@@ -1,14 +1,18 @@
 import os, sys
 
 from langchain_core.prompts import ChatPromptTemplate
-from langchain.prompts.prompt import PromptTemplate
+from langchain_core.prompts import PromptTemplate
 from langchain_core.prompts import format_document
 
+from .packing import pack_documents, CONTEXT_MAX_TOKENS
+
 
 # basic template for page content
 DEFAULT_DOCUMENT_PROMPT = PromptTemplate.from_template(template="{page_content}")
 
-def _combine_documents(docs, sep="\n\n"):
+def _combine_documents(docs, sep="\n\n", max_tokens=CONTEXT_MAX_TOKENS):
+    # merge overlapping chunks, drop duplicates & fit the token budget
+    docs = pack_documents(docs, max_tokens)
     doc_strings = [format_document(doc, DEFAULT_DOCUMENT_PROMPT) for doc in docs]
     return sep.join(doc_strings)
 
@@ -61,6 +65,19 @@ QUERY_AUG_PROMPT = ChatPromptTemplate.from_messages(
     ]
 )
 
+# the multi query retriever prompt of langchain, one variant per line
+# (importing it from langchain.retrievers loads all the retrievers)
+QUERY_VARIANTS_PROMPT = PromptTemplate(
+    input_variables=["question"],
+    template="""You are an AI language model assistant. Your task is 
+    to generate 3 different versions of the given user 
+    question to retrieve relevant documents from a vector  database. 
+    By generating multiple perspectives on the user question, 
+    your goal is to help the user overcome some of the limitations 
+    of distance-based similarity search. Provide these alternative 
+    questions separated by newlines. Original question: {question}""",
+)
+
 # HYDE Prompt
 system = """You are an expert at assisting students regarding University of South Florida's Masters in Business Analytics and 
 Information System program.\
@@ -1,34 +1,34 @@
 import os, sys
+import math
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from operator import itemgetter
 import logging 
 
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
-
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_community.vectorstores import Chroma
-from langchain_openai import ChatOpenAI, OpenAI, OpenAIEmbeddings
 from langchain_core.runnables import RunnableLambda, RunnablePassthrough
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.messages import AIMessage, HumanMessage, get_buffer_string
-from langchain_core.prompts import format_document
+from langchain_core.messages import get_buffer_string
+from langchain_core.prompts import PromptTemplate
 from langchain_core.runnables import RunnableParallel
 
-from langchain_core.prompts import ChatPromptTemplate
-from langchain.prompts.prompt import PromptTemplate
-
-from langchain.output_parsers import PydanticToolsParser
-from langchain.retrievers.multi_query import MultiQueryRetriever
-
-from langchain.memory import ConversationSummaryBufferMemory
-from langchain_community.tools import DuckDuckGoSearchResults
-
 
-from .prompts import ANSWER_PROMPT, QUERY_AUG_PROMPT, HYDE_PROMPT, CONDENSE_QUESTION_PROMPT
+from .prompts import ANSWER_PROMPT, HYDE_PROMPT, CONDENSE_QUESTION_PROMPT, QUERY_VARIANTS_PROMPT
 from .prompts import _combine_documents
+from .answer_cache import cached_answer_chain
+from .context_filter import ExtractiveContextFilter
+from .retrievers import FanOutRetriever, retriever_embeddings
+from .routing import needs_condense, token_overlap
+from . import metrics
 
 logging.basicConfig()
+
+# retrieve on the raw follow up question while it is being condensed
+SPECULATIVE_RETRIEVAL = os.environ.get("SPECULATIVE_RETRIEVAL", "1") == "1"
+# the speculative documents are kept when the condensed question is this
+# close to the raw one by word overlap, or else by embedding similarity
+SPECULATIVE_MIN_OVERLAP = float(os.environ.get("SPECULATIVE_MIN_OVERLAP", 0.6))
+SPECULATIVE_MIN_SIMILARITY = float(os.environ.get("SPECULATIVE_MIN_SIMILARITY", 0.9))
 # logging.getLogger("langchain.retrievers.multi_query").setLevel(logging.INFO)
 
 # load_dotenv('.env')
@@ -39,27 +39,131 @@ logging.basicConfig()
 # intialize the LLM
 # llm = ChatOpenAI(model_name="gpt-3.5-turbo", temperature=0)
 
-def base_rag(llm, memory, retriever):
-
-    # First we add a step to load memory
-    # This adds a "memory" key to the input object
-    loaded_memory = RunnablePassthrough.assign(
-        chat_history=RunnableLambda(memory.load_memory_variables) | itemgetter("history"),
-    )
+def condense_question(llm):
+    """Rephrases a follow up question into a standalone question.
 
-    # Now we calculate the standalone question
-    standalone_question = {
-        "standalone_question": {
+    The condense llm call is bypassed when there is no chat history or the
+    question is already self-contained, the question is then used as is.
+    """
+    condense_chain = (
+        {
             "question": lambda x: x["question"],
             "chat_history": lambda x: get_buffer_string(x["chat_history"]),
         }
         | CONDENSE_QUESTION_PROMPT
         | llm
-        | StrOutputParser(),
+        | StrOutputParser()
+    ).with_config(run_name="condense")
+
+    def route(x):
+        if needs_condense(x["question"], x["chat_history"]):
+            metrics.increment("condense_called")
+            return condense_chain
+        metrics.increment("condense_bypassed")
+        return x["question"]
+
+    async def aroute(x):
+        # no io, avoids the thread pool hop of a sync function
+        return route(x)
+
+    return RunnableLambda(route, afunc=aroute)
+
+
+def _cosine(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a) * sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+def speculative_condense(llm, retriever):
+    """Condenses the question like condense_question, when the condense llm
+    call is needed the raw question is retrieved for at the same time.
+
+    The speculative "docs" are kept if the standalone question is close to
+    the raw one (word overlap, then embedding similarity), otherwise the
+    standalone question is retrieved for. Without the condense call no
+    "docs" are returned, retrieval happens after the answer cache lookup.
+
+    Returns:
+        Runnable: outputs {"standalone_question"} or {"standalone_question", "docs"}
+    """
+    condense = condense_question(llm)
+
+    def overlaps(question, standalone):
+        # decides most follow ups without embedding anything
+        return token_overlap(question, standalone) >= SPECULATIVE_MIN_OVERLAP
+
+    def keep_or_retrieve(close):
+        metrics.increment("speculative_kept" if close else "speculative_discarded")
+        return close
+
+    def speculate(x, config):
+        if not needs_condense(x["question"], x["chat_history"]):
+            return {"standalone_question": condense.invoke(x, config)}
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            speculative = executor.submit(retriever.invoke, x["question"], config)
+            standalone = condense.invoke(x, config)
+            docs = speculative.result()
+        close = overlaps(x["question"], standalone)
+        if not close:
+            # the raw question's vector is in the embedding cache by now
+            vectors = retriever_embeddings(retriever).embed_documents([x["question"], standalone])
+            close = _cosine(*vectors) >= SPECULATIVE_MIN_SIMILARITY
+        if not keep_or_retrieve(close):
+            docs = retriever.invoke(standalone, config)
+        return {"standalone_question": standalone, "docs": docs}
+
+    async def aspeculate(x, config):
+        if not needs_condense(x["question"], x["chat_history"]):
+            return {"standalone_question": await condense.ainvoke(x, config)}
+        docs, standalone = await asyncio.gather(retriever.ainvoke(x["question"], config),
+                                                condense.ainvoke(x, config))
+        close = overlaps(x["question"], standalone)
+        if not close:
+            vectors = await retriever_embeddings(retriever).aembed_documents([x["question"], standalone])
+            close = _cosine(*vectors) >= SPECULATIVE_MIN_SIMILARITY
+        if not keep_or_retrieve(close):
+            docs = await retriever.ainvoke(standalone, config)
+        return {"standalone_question": standalone, "docs": docs}
+
+    return RunnableLambda(speculate, afunc=aspeculate)
+
+
+def standalone_retrieval(retriever):
+    """Retrieves for the standalone question, unless speculative_condense
+    already did."""
+
+    def route(x):
+        if x.get("docs") is not None:
+            return x["docs"]
+        return itemgetter("standalone_question") | retriever
+
+    async def aroute(x):
+        return route(x)
+
+    return RunnableLambda(route, afunc=aroute)
+
+
+def base_rag(llm, memory, retriever, answer_cache=None):
+
+    # First we add a step to load memory
+    # This adds a "memory" key to the input object
+    loaded_memory = RunnablePassthrough.assign(
+        chat_history=RunnableLambda(memory.load_memory_variables,
+                                    afunc=memory.aload_memory_variables) | itemgetter("history"),
+    ).with_config(run_name="load_memory")
+
+    # Now we calculate the standalone question, the llm is skipped
+    # on first turns and for self-contained questions
+    standalone_question = {
+        "standalone_question": condense_question(llm),
     }
+    if SPECULATIVE_RETRIEVAL:
+        # follow ups are retrieved for while they are condensed
+        standalone_question = speculative_condense(llm, retriever)
     # Now we retrieve the documents
     retrieved_documents = {
-        "docs": itemgetter("standalone_question") | retriever,
+        "docs": standalone_retrieval(retriever),
         "question": lambda x: x["standalone_question"],
     }
 
@@ -71,35 +175,40 @@ def base_rag(llm, memory, retriever):
 
     # And finally, we do the part that returns the answers
     answer = {
-        "answer": final_inputs | ANSWER_PROMPT | llm,
+        "answer": final_inputs | (ANSWER_PROMPT | llm).with_config(run_name="generate"),
         "docs": itemgetter("docs"),
     }
 
 
+    # answers of similar standalone questions are served from the cache
+    cached_answer = cached_answer_chain(RunnableParallel(retrieved_documents) | answer,
+                                        answer_cache, key="standalone_question")
+
     # And now we put it all together!
-    rag_chain = loaded_memory | standalone_question | retrieved_documents | answer
+    rag_chain = loaded_memory | standalone_question | cached_answer
 
 
     return rag_chain
 
 
-def rag_with_hyde(llm, memory, retriever):
+def rag_with_hyde(llm, memory, retriever, answer_cache=None):
 
     # First we add a step to load memory
     # This adds a "memory" key to the input object
     loaded_memory = RunnablePassthrough.assign(
-        chat_history=RunnableLambda(memory.load_memory_variables) | itemgetter("history"),
-    )
+        chat_history=RunnableLambda(memory.load_memory_variables,
+                                    afunc=memory.aload_memory_variables) | itemgetter("history"),
+    ).with_config(run_name="load_memory")
 
     # Now we get a hypothethical document embedding
     hyde_doc = {
-        "hyde_document": {
+        "hyde_document": ({
             "question": lambda x: x["question"],
             "chat_history": lambda x: get_buffer_string(x["chat_history"]),
         }
         | HYDE_PROMPT
         | llm
-        | StrOutputParser(),
+        | StrOutputParser()).with_config(run_name="hyde"),
     }
 
     # Now we retrieve the documents
@@ -116,31 +225,39 @@ def rag_with_hyde(llm, memory, retriever):
 
     # And finally, we do the part that returns the answers
     answer = {
-        "answer": final_inputs | ANSWER_PROMPT | llm,
+        "answer": final_inputs | (ANSWER_PROMPT | llm).with_config(run_name="generate"),
         "docs": itemgetter("docs"),
     }
 
+    # first turn answers are served from the cache, hyde call included
+    cached_answer = cached_answer_chain(RunnableParallel(hyde_doc) | retrieved_documents | answer,
+                                        answer_cache, key="question")
+
     # And now we put it all together!
-    rag_chain = loaded_memory | hyde_doc | retrieved_documents | answer
+    rag_chain = loaded_memory | cached_answer
 
     # return the chain
     return rag_chain
 
 
-def rag_with_query_aug(llm, memory, retriever):
+def rag_with_query_aug(llm, memory, retriever, answer_cache=None):
     
     # First we add a step to load memory
     # This adds a "memory" key to the input object
     loaded_memory = RunnablePassthrough.assign(
-        chat_history=RunnableLambda(memory.load_memory_variables) | itemgetter("history"),
-    )
+        chat_history=RunnableLambda(memory.load_memory_variables,
+                                    afunc=memory.aload_memory_variables) | itemgetter("history"),
+    ).with_config(run_name="load_memory")
 
-    # intilaize multi query retriever
-    multi_retriever = MultiQueryRetriever.from_llm(retriever=retriever, llm=llm)
+    # the llm writes variants of the question, one per line
+    query_variants = (QUERY_VARIANTS_PROMPT | llm | StrOutputParser()
+                      | (lambda text: text.split("\n"))).with_config(run_name="query_variants")
+    # the question & its variants are embedded in one call & searched concurrently
+    multi_retriever = FanOutRetriever.from_retriever(retriever, query_variants)
 
     # Now we retrieve the documents
-    multi_retrieval_docs = {"question": RunnablePassthrough(), 
-                        "docs": multi_retriever}
+    multi_retrieval_docs = {"question": itemgetter("question"),
+                        "docs": itemgetter("question") | multi_retriever}
 
     # Now we construct the inputs for the final prompt
     final_inputs = {
@@ -150,39 +267,42 @@ def rag_with_query_aug(llm, memory, retriever):
 
     # And finally, we do the part that returns the answers
     answer = {
-        "answer": final_inputs | ANSWER_PROMPT | llm,
+        "answer": final_inputs | (ANSWER_PROMPT | llm).with_config(run_name="generate"),
         "docs": itemgetter("docs"),
     }
 
+    # first turn answers are served from the cache
+    cached_answer = cached_answer_chain(RunnableParallel(multi_retrieval_docs) | answer,
+                                        answer_cache, key="question")
+
     # And now we put it all together!
-    rag_chain = loaded_memory | multi_retrieval_docs | answer
+    rag_chain = loaded_memory | cached_answer
 
     # return the chain
     return rag_chain
 
 
-def rag_with_react(llm, memory, retriever):
+def rag_with_react(llm, memory, retriever, answer_cache=None):
 
     # First we add a step to load memory
     # This adds a "memory" key to the input object
     loaded_memory = RunnablePassthrough.assign(
-        chat_history=RunnableLambda(memory.load_memory_variables) | itemgetter("history"),
-    )
+        chat_history=RunnableLambda(memory.load_memory_variables,
+                                    afunc=memory.aload_memory_variables) | itemgetter("history"),
+    ).with_config(run_name="load_memory")
 
-    # Now we calculate the standalone question
+    # Now we calculate the standalone question, the llm is skipped
+    # on first turns and for self-contained questions
     standalone_question = {
-        "standalone_question": {
-            "question": lambda x: x["question"],
-            "chat_history": lambda x: get_buffer_string(x["chat_history"]),
-        }
-        | CONDENSE_QUESTION_PROMPT
-        | llm
-        | StrOutputParser(),
+        "standalone_question": condense_question(llm),
     }
+    if SPECULATIVE_RETRIEVAL:
+        # follow ups are retrieved for while they are condensed
+        standalone_question = speculative_condense(llm, retriever)
 
     # Now we retrieve the documents
     retrieved_documents = {
-        "docs": itemgetter("standalone_question") | retriever,
+        "docs": standalone_retrieval(retriever),
         "question": lambda x: x["standalone_question"],
     }
 
@@ -204,21 +324,81 @@ def rag_with_react(llm, memory, retriever):
     REASON_CONTEXT_PROMPT = PromptTemplate.from_template(_template)
 
     # Now we reason to minimize the relevant contexts to the question
-    final_inputs = { "context": reasoning_inputs
+    final_inputs = { "context": (reasoning_inputs
         | REASON_CONTEXT_PROMPT
         | llm
-        | StrOutputParser(),
+        | StrOutputParser()).with_config(run_name="reason_context"),
 
         "question": itemgetter("question") 
     }
 
     # And finally, we do the part that returns the answers
     answer = {
-        "answer": final_inputs | ANSWER_PROMPT | llm,
+        "answer": final_inputs | (ANSWER_PROMPT | llm).with_config(run_name="generate"),
+        "docs": itemgetter("docs"),
+    }
+
+    # answers of similar standalone questions are served from the cache
+    cached_answer = cached_answer_chain(RunnableParallel(retrieved_documents) | answer,
+                                        answer_cache, key="standalone_question")
+
+    # And now we put it all together!
+    rag_chain = loaded_memory | standalone_question | cached_answer
+
+    return rag_chain
+
+
+def rag_with_extractive_filter(llm, memory, retriever, answer_cache=None):
+    """Like rag_with_react, the retrieved context is filtered to the
+    sentences relevant to the question, locally by embedding similarity
+    instead of with an llm call."""
+
+    # First we add a step to load memory
+    # This adds a "memory" key to the input object
+    loaded_memory = RunnablePassthrough.assign(
+        chat_history=RunnableLambda(memory.load_memory_variables,
+                                    afunc=memory.aload_memory_variables) | itemgetter("history"),
+    ).with_config(run_name="load_memory")
+
+    # Now we calculate the standalone question, the llm is skipped
+    # on first turns and for self-contained questions
+    standalone_question = {
+        "standalone_question": condense_question(llm),
+    }
+    if SPECULATIVE_RETRIEVAL:
+        # follow ups are retrieved for while they are condensed
+        standalone_question = speculative_condense(llm, retriever)
+
+    # Now we retrieve the documents
+    retrieved_documents = {
+        "docs": standalone_retrieval(retriever),
+        "question": lambda x: x["standalone_question"],
+    }
+
+    # sentence embeddings come from the same cached embedding model
+    context_filter = ExtractiveContextFilter(retriever_embeddings(retriever))
+
+    async def afilter_context(x):
+        return await context_filter.afilter(x["question"], x["docs"])
+
+    # Now we keep the relevant sentences of the contexts, on the cpu
+    final_inputs = {
+        "context": RunnableLambda(lambda x: context_filter.filter(x["question"], x["docs"]),
+                                  afunc=afilter_context).with_config(run_name="context_filter"),
+        "question": itemgetter("question"),
+    }
+
+    # And finally, we do the part that returns the answers
+    answer = {
+        "answer": final_inputs | (ANSWER_PROMPT | llm).with_config(run_name="generate"),
         "docs": itemgetter("docs"),
     }
 
+    # answers of similar standalone questions are served from the cache
+    cached_answer = cached_answer_chain(RunnableParallel(retrieved_documents) | answer,
+                                        answer_cache, key="standalone_question")
+
     # And now we put it all together!
-    rag_chain = loaded_memory | standalone_question | retrieved_documents | answer
+    rag_chain = loaded_memory | standalone_question | cached_answer
 
-    return rag_chain
\ No newline at end of file
+    return rag_chain
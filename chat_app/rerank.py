@@ -0,0 +1,156 @@
+import os, time
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import Any, List
+
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from .manifest import text_hash
+from .retrievers import BM25Index
+from . import metrics
+
+
+# "none", "lexical" or "cross-encoder" (needs sentence-transformers)
+RERANKER = os.environ.get("RERANKER", "none")
+RERANKER_MODEL = os.environ.get("RERANKER_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+# candidates retrieved for the reranker & documents it keeps
+RERANK_FETCH_K = int(os.environ.get("RERANK_FETCH_K", 30))
+RERANK_TOP_N = int(os.environ.get("RERANK_TOP_N", 5))
+# scoring stops after this many seconds, the rest keep the retrieval order
+RERANK_TIME_BUDGET = float(os.environ.get("RERANK_TIME_BUDGET", 0.3))
+RERANK_BATCH_SIZE = int(os.environ.get("RERANK_BATCH_SIZE", 16))
+# (query, chunk) scores kept in memory
+RERANK_CACHE_SIZE = int(os.environ.get("RERANK_CACHE_SIZE", 50_000))
+
+
+class Reranker:
+    """Scores (query, chunk) pairs locally, subclasses implement _score_batch.
+
+    Candidates are scored in batches in retrieval order until the time
+    budget runs out, the ones left unscored are ranked after the scored
+    ones in retrieval order. Scores are cached per (query, chunk), unless
+    the scorer is not cacheable (a score depending on the other candidates).
+    """
+
+    cacheable = True
+
+    def __init__(self, batch_size=RERANK_BATCH_SIZE, time_budget=RERANK_TIME_BUDGET,
+                 cache_size=RERANK_CACHE_SIZE):
+        self.batch_size = batch_size
+        self.time_budget = time_budget
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _score_batch(self, query, texts, candidates):
+        raise NotImplementedError
+
+    def _cached(self, keys):
+        with self._lock:
+            scores = {}
+            for key in keys:
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    scores[key] = self._cache[key]
+            return scores
+
+    def _store(self, items):
+        with self._lock:
+            self._cache.update(items)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def rerank(self, query, docs, top_n=RERANK_TOP_N):
+        """Returns the top_n documents by reranker score, with a "rerank_score"."""
+        query_hash = text_hash(query)
+        keys = [(query_hash, text_hash(doc.page_content)) for doc in docs]
+        scores = self._cached(keys) if self.cacheable else {}
+
+        start = time.monotonic()
+        deadline = start + self.time_budget
+        pending = [i for i, key in enumerate(keys) if key not in scores]
+        texts = [doc.page_content for doc in docs]
+        for offset in range(0, len(pending), self.batch_size):
+            if time.monotonic() > deadline:
+                print(f"rerank time budget spent, {len(pending) - offset} candidates unscored")
+                break
+            batch = pending[offset:offset + self.batch_size]
+            batch_scores = self._score_batch(query, [texts[i] for i in batch], texts)
+            new = {keys[i]: float(score) for i, score in zip(batch, batch_scores)}
+            if self.cacheable:
+                self._store(new)
+            scores.update(new)
+
+        scored = sorted((i for i, key in enumerate(keys) if key in scores),
+                        key=lambda i: scores[keys[i]], reverse=True)
+        unscored = [i for i, key in enumerate(keys) if key not in scores]
+        metrics.observe("stage_seconds", time.monotonic() - start, stage="rerank")
+        return [Document(page_content=docs[i].page_content,
+                         metadata={**docs[i].metadata, "rerank_score": scores.get(keys[i], float("-inf"))})
+                for i in (scored + unscored)[:top_n]]
+
+
+class LexicalReranker(Reranker):
+    """Dependency free reranker, BM25 of the query over the candidates.
+
+    The idf comes from the candidates, so terms shared by all of them (the
+    ones the vector search matched on anyway) count less than the ones
+    setting a candidate apart. A chunk's score depends on the other
+    candidates then, so the scores are not cached (BM25 is cheap anyway).
+    """
+
+    cacheable = False
+
+    def _score_batch(self, query, texts, candidates):
+        index = BM25Index([Document(page_content=text) for text in candidates])
+        scores = {text_hash(doc.page_content): score for doc, score in index.search(query, len(candidates))}
+        return [scores.get(text_hash(text), 0.0) for text in texts]
+
+
+class CrossEncoderReranker(Reranker):
+    """Cross encoder reranker (sentence-transformers), runs on the cpu."""
+
+    def __init__(self, model_name=RERANKER_MODEL, **kwargs):
+        super().__init__(**kwargs)
+        from sentence_transformers import CrossEncoder
+
+        self.model = CrossEncoder(model_name, device="cpu")
+
+    def _score_batch(self, query, texts, candidates):
+        return self.model.predict([(query, text) for text in texts], batch_size=len(texts))
+
+
+class RerankingRetriever(BaseRetriever):
+    """Reranks the candidates of a retriever and keeps the top_n."""
+
+    retriever: BaseRetriever
+    reranker: Any
+    top_n: int = RERANK_TOP_N
+
+    def _get_relevant_documents(self, query, *, run_manager) -> List[Document]:
+        docs = self.retriever.invoke(query, {"callbacks": run_manager.get_child()})
+        return self.reranker.rerank(query, docs, self.top_n)
+
+    async def _aget_relevant_documents(self, query, *, run_manager) -> List[Document]:
+        docs = await self.retriever.ainvoke(query, {"callbacks": run_manager.get_child()})
+        # cpu bound, keep it off the event loop
+        return await asyncio.to_thread(self.reranker.rerank, query, docs, self.top_n)
+
+
+_rerankers = {}
+
+
+def get_reranker(kind=RERANKER):
+    """Returns the process wide reranker of a kind, None for "none"."""
+    if kind == "none":
+        return None
+    if kind not in _rerankers:
+        if kind == "lexical":
+            _rerankers[kind] = LexicalReranker()
+        elif kind == "cross-encoder":
+            _rerankers[kind] = CrossEncoderReranker()
+        else:
+            raise ValueError(f"Unknown reranker: {kind}")
+    return _rerankers[kind]
@@ -0,0 +1,192 @@
+import os, copy
+import hashlib
+import threading
+from collections import OrderedDict
+
+from .rags import base_rag, rag_with_hyde, rag_with_query_aug, rag_with_react
+from .rags import rag_with_extractive_filter
+from .utils import get_vector_db
+from .embedding_cache import get_cached_embeddings
+from .retrievers import build_retriever
+from .rerank import RerankingRetriever, get_reranker, RERANK_FETCH_K
+from .answer_cache import get_answer_cache
+from .faq import FAQFirstCache, get_faq_index, FAQ_INDEX_PATH
+from .manifest import MANIFEST_NAME
+from .session_store import SessionMemory, get_session_store
+
+
+# all rag methods
+rag_methods = {"base": base_rag, "hyde": rag_with_hyde,
+               "query_aug":rag_with_query_aug, "react": rag_with_react,
+               "extractive": rag_with_extractive_filter}
+
+DEFAULT_MODEL = "gpt-3.5-turbo"
+# entries kept per kind (llms, retrievers, chains...), the least recently
+# used ones, e.g. of api keys not seen for a while, are dropped beyond it
+REGISTRY_MAX_ENTRIES = int(os.environ.get("REGISTRY_MAX_ENTRIES", 256))
+
+
+def key_fingerprint(api_key):
+    # never keep raw api keys in registry keys or logs
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+
+
+class RagResources:
+    """What a session needs to answer: the shared chain & its memories."""
+
+    def __init__(self, chain, memory):
+        self.chain = chain
+        self.memory = memory
+
+
+class RagRegistry:
+    """Process wide pool of the llms, embedding models, retrievers and
+    compiled rag chains.
+
+    Clients are keyed by the api key fingerprint (and model), chains by
+    (rag type, model, api key fingerprint), so all the sessions using the
+    same key share HTTP connection pools, caches and chains and a session
+    only needs its rag type & key to find them. Each kind keeps at most
+    max_entries, least recently used first out.
+
+    Retrievers & chains hold the vector db, BM25 & FAQ indexes loaded when
+    they were built, they are rebuilt once the ingestion manifest or the
+    FAQ index change on disk.
+    """
+
+    def __init__(self, docs_path="data", max_entries=REGISTRY_MAX_ENTRIES):
+        self.docs_path = docs_path
+        self.max_entries = max_entries
+        self._vector_db = None
+        self._index_version = self._current_index_version()
+        self._llms = OrderedDict()
+        self._embeddings = OrderedDict()
+        self._retrievers = OrderedDict()
+        self._memories = OrderedDict()
+        self._chains = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _current_index_version(self):
+        version = []
+        for path in (os.path.join(self.docs_path, MANIFEST_NAME),
+                     os.path.join(self.docs_path, FAQ_INDEX_PATH, "faq.json")):
+            try:
+                stat = os.stat(path)
+                version.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                version.append(None)
+        return tuple(version)
+
+    def _check_index_version(self):
+        # called under the lock
+        version = self._current_index_version()
+        if version != self._index_version:
+            print("documents were re-ingested, reloading the indexes...")
+            self._vector_db = None
+            self._retrievers.clear()
+            self._chains.clear()
+            self._index_version = version
+
+    def _cached(self, entries, key):
+        """The entry of key (None if missing), marked as recently used."""
+        if key not in entries:
+            return None
+        entries.move_to_end(key)
+        return entries[key]
+
+    def _add(self, entries, key, value):
+        entries[key] = value
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+        return value
+
+    def llm(self, api_key, model=DEFAULT_MODEL):
+        key = (model, key_fingerprint(api_key))
+        with self._lock:
+            llm = self._cached(self._llms, key)
+            if llm is None:
+                from langchain_openai import ChatOpenAI
+
+                llm = self._add(self._llms, key,
+                                ChatOpenAI(model_name=model, temperature=0.1, api_key=api_key))
+            return llm
+
+    def embedding(self, api_key):
+        key = key_fingerprint(api_key)
+        with self._lock:
+            embedding = self._cached(self._embeddings, key)
+            if embedding is None:
+                from langchain_openai import OpenAIEmbeddings
+
+                # repeated questions are embedded from the local cache
+                embedding = self._add(self._embeddings, key, get_cached_embeddings(
+                    OpenAIEmbeddings(api_key=api_key), self.docs_path))
+            return embedding
+
+    def retriever(self, api_key):
+        key = key_fingerprint(api_key)
+        with self._lock:
+            self._check_index_version()
+            retriever = self._cached(self._retrievers, key)
+            if retriever is None:
+                embedding = self.embedding(api_key)
+                # the vector db (pinecone client or local index) is loaded
+                # once, each key gets a shallow copy using its embedding model
+                if self._vector_db is None:
+                    self._vector_db = get_vector_db(embedding, self.docs_path)
+                vector_db = copy.copy(self._vector_db)
+                vector_db._embedding = embedding
+                reranker = get_reranker()
+                if reranker is None:
+                    retriever = build_retriever(vector_db, self.docs_path)
+                else:
+                    # more candidates, the reranker keeps the best ones
+                    retriever = RerankingRetriever(
+                        retriever=build_retriever(vector_db, self.docs_path, k=RERANK_FETCH_K),
+                        reranker=reranker)
+                self._add(self._retrievers, key, retriever)
+            return retriever
+
+    def memory(self, api_key, model=DEFAULT_MODEL):
+        key = (model, key_fingerprint(api_key))
+        with self._lock:
+            memory = self._cached(self._memories, key)
+            if memory is None:
+                # the llm summarizes the conversations once they get long,
+                # the conversations themselves are in the session store
+                memory = self._add(self._memories, key,
+                                   SessionMemory(self.llm(api_key, model), get_session_store()))
+            return memory
+
+    def get(self, rag_type, api_key, model=DEFAULT_MODEL):
+        """Returns the RagResources of a rag type, built on first use."""
+        key = (rag_type, model, key_fingerprint(api_key))
+        with self._lock:
+            self._check_index_version()
+            resources = self._cached(self._chains, key)
+            if resources is None:
+                print(f"Initialzing llm & {rag_type} rag...")
+                llm = self.llm(api_key, model)
+                memory = self.memory(api_key, model)
+                # answers are shared across sessions through the semantic cache
+                answer_cache = get_answer_cache(self.embedding(api_key), self.docs_path,
+                                                namespace=rag_type)
+                faq = get_faq_index(self.docs_path)
+                if faq is not None:
+                    # known questions are answered straight from the faq index
+                    answer_cache = FAQFirstCache(faq.bind(self.embedding(api_key)), answer_cache)
+                chain = rag_methods[rag_type](llm, memory, self.retriever(api_key),
+                                              answer_cache=answer_cache)
+                resources = self._add(self._chains, key, RagResources(chain, memory))
+            return resources
+
+
+_registry = None
+
+
+def get_registry(docs_path="data"):
+    """Returns the process wide registry."""
+    global _registry
+    if _registry is None:
+        _registry = RagRegistry(docs_path)
+    return _registry
@@ -0,0 +1,275 @@
+import os, re
+import asyncio
+import math
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from .manifest import IngestManifest, MANIFEST_NAME, text_hash
+
+
+# "dense" (vector search only) or "hybrid" (bm25 + vector search fused with rrf)
+RETRIEVER_MODE = os.environ.get("RETRIEVER_MODE", "dense")
+# documents passed to the prompt
+RETRIEVER_K = int(os.environ.get("RETRIEVER_K", 5))
+# candidates fetched from each side before fusion in hybrid mode
+HYBRID_FETCH_K = int(os.environ.get("HYBRID_FETCH_K", 20))
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+# course codes are written "ISM 6251", "ISM6251" or "ism-6251"
+_COURSE_CODE_RE = re.compile(r"\b([a-z]{3})[\s\-]?(\d{4})\b")
+
+
+def tokenize(text):
+    """Lower cased alphanumeric tokens, course codes are also kept joined."""
+    text = text.lower()
+    tokens = _TOKEN_RE.findall(text)
+    tokens.extend(prefix + number for prefix, number in _COURSE_CODE_RE.findall(text))
+    return tokens
+
+
+class BM25Index:
+    """Okapi BM25 over an in-memory inverted index.
+
+    Postings are stored as numpy arrays (doc positions & term frequencies)
+    so a query only touches the postings of its terms.
+    """
+
+    def __init__(self, docs, k1=1.5, b=0.75):
+        self.docs = docs
+        self.k1 = k1
+        self.b = b
+
+        postings = defaultdict(lambda: ([], []))
+        doc_lens = np.zeros(len(docs), dtype=np.float32)
+        for i, doc in enumerate(docs):
+            counts = Counter(tokenize(doc.page_content))
+            doc_lens[i] = sum(counts.values())
+            for term, tf in counts.items():
+                postings[term][0].append(i)
+                postings[term][1].append(tf)
+
+        avg_len = doc_lens.mean() if len(docs) else 1.0
+        # length normalization part of the bm25 denominator, per doc
+        self._norm = k1 * (1 - b + b * doc_lens / max(avg_len, 1e-6))
+        self.postings = {}
+        for term, (positions, tfs) in postings.items():
+            idf = math.log(1 + (len(docs) - len(positions) + 0.5) / (len(positions) + 0.5))
+            self.postings[term] = (np.array(positions, dtype=np.int64),
+                                   np.array(tfs, dtype=np.float32), idf)
+
+    def __len__(self):
+        return len(self.docs)
+
+    @classmethod
+    def from_manifest(cls, docs_path, **kwargs):
+        """Builds the index over the chunks recorded in the ingestion manifest."""
+        manifest = IngestManifest.load(os.path.join(docs_path, MANIFEST_NAME))
+        docs = [Document(page_content=chunk["text"], metadata=chunk.get("metadata", {}))
+                for chunk in manifest.chunks() if "text" in chunk]
+        return cls(docs, **kwargs)
+
+    def search(self, query, k=5):
+        """Returns the top k (document, score) pairs for the query."""
+        scores = np.zeros(len(self.docs), dtype=np.float32)
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            positions, tfs, idf = self.postings[term]
+            scores[positions] += idf * tfs * (self.k1 + 1) / (tfs + self._norm[positions])
+
+        matched = np.flatnonzero(scores)
+        if not len(matched):
+            return []
+        k = min(k, len(matched))
+        top = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        top = top[np.argsort(-scores[top])]
+        return [(self.docs[i], float(scores[i])) for i in top]
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Fuses ranked document lists, a document scores sum(1 / (k + rank)).
+
+    Args:
+        rankings (list): lists of Documents, each ordered best first.
+        k (int, optional): rrf constant damping the top ranks. Defaults to 60.
+
+    Returns:
+        list(tuple): (document, score) pairs ordered by fused score
+    """
+    scores = {}
+    docs = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            key = text_hash(doc.page_content)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+            docs.setdefault(key, doc)
+    order = sorted(scores, key=scores.get, reverse=True)
+    return [(docs[key], scores[key]) for key in order]
+
+
+class HybridRetriever(BaseRetriever):
+    """Runs the BM25 keyword search alongside the dense vector search and
+    fuses both rankings with reciprocal rank fusion."""
+
+    dense_retriever: BaseRetriever
+    bm25: Any
+    k: int = RETRIEVER_K
+    fetch_k: int = HYBRID_FETCH_K
+    rrf_k: int = 60
+
+    def _fuse(self, dense_docs, keyword_docs):
+        fused = reciprocal_rank_fusion([dense_docs, keyword_docs], self.rrf_k)
+        return [Document(page_content=doc.page_content,
+                         metadata={**doc.metadata, "rrf_score": score})
+                for doc, score in fused[:self.k]]
+
+    def _get_relevant_documents(self, query, *, run_manager) -> List[Document]:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # the dense search is a network call, do the keyword search meanwhile
+            dense = executor.submit(self.dense_retriever.invoke, query,
+                                    {"callbacks": run_manager.get_child()})
+            keyword_docs = [doc for doc, _ in self.bm25.search(query, self.fetch_k)]
+            dense_docs = dense.result()
+        return self._fuse(dense_docs, keyword_docs)
+
+    async def _aget_relevant_documents(self, query, *, run_manager) -> List[Document]:
+        # the keyword search is cpu bound, in a thread while the dense search runs
+        keyword_results, dense_docs = await asyncio.gather(
+            asyncio.to_thread(self.bm25.search, query, self.fetch_k),
+            self.dense_retriever.ainvoke(query, {"callbacks": run_manager.get_child()}))
+        return self._fuse(dense_docs, [doc for doc, _ in keyword_results])
+
+
+class FanOutRetriever(BaseRetriever):
+    """Retrieves for a question and llm generated variants of it.
+
+    All the queries are embedded with one batched call and searched
+    concurrently. The results are deduplicated by content keeping the best
+    score, so a chunk found by several variants counts once, and only the
+    top k are returned. With a BM25 index (hybrid mode) the dense & keyword
+    rankings of every query are fused with reciprocal rank fusion instead.
+    """
+
+    vector_db: Any
+    query_chain: Any
+    bm25: Any = None
+    k: int = RETRIEVER_K
+    fetch_k: int = RETRIEVER_K
+    rrf_k: int = 60
+
+    @classmethod
+    def from_retriever(cls, retriever, query_chain):
+        """Builds it over the vector db (and BM25 index) of a built retriever,
+        returning as many documents."""
+        if hasattr(retriever, "retriever"):
+            # fan out the candidates, a reranker still picks the top ones,
+            # a cache still caches them
+            return retriever.copy(update={"retriever": cls.from_retriever(retriever.retriever, query_chain)})
+        if isinstance(retriever, HybridRetriever):
+            return cls(vector_db=retriever.dense_retriever.vectorstore, query_chain=query_chain,
+                       bm25=retriever.bm25, k=retriever.k, fetch_k=retriever.fetch_k)
+        k = retriever.search_kwargs.get("k", RETRIEVER_K)
+        return cls(vector_db=retriever.vectorstore, query_chain=query_chain, k=k, fetch_k=k)
+
+    @staticmethod
+    def _queries(question, variants):
+        queries = []
+        for query in [question, *variants]:
+            query = query.strip()
+            if query and query not in queries:
+                queries.append(query)
+        return queries
+
+    def _search(self, vector):
+        return self.vector_db.similarity_search_by_vector_with_score(vector, k=self.fetch_k)
+
+    def _merge(self, queries, results):
+        if self.bm25 is not None:
+            rankings = [[doc for doc, _ in result] for result in results]
+            rankings += [[doc for doc, _ in self.bm25.search(query, self.fetch_k)] for query in queries]
+            fused = reciprocal_rank_fusion(rankings, self.rrf_k)
+            return [Document(page_content=doc.page_content,
+                             metadata={**doc.metadata, "rrf_score": score})
+                    for doc, score in fused[:self.k]]
+
+        best = {}
+        for result in results:
+            for doc, score in result:
+                key = text_hash(doc.page_content)
+                if key not in best or score > best[key][1]:
+                    best[key] = (doc, score)
+        ranked = sorted(best.values(), key=lambda pair: pair[1], reverse=True)
+        return [Document(page_content=doc.page_content, metadata={**doc.metadata, "score": score})
+                for doc, score in ranked[:self.k]]
+
+    def _get_relevant_documents(self, query, *, run_manager) -> List[Document]:
+        variants = self.query_chain.invoke(query, {"callbacks": run_manager.get_child()})
+        queries = self._queries(query, variants)
+        if not queries:
+            # blank question & no variants, nothing to search
+            return []
+        vectors = self.vector_db.embeddings.embed_documents(queries)
+        with ThreadPoolExecutor(max_workers=len(vectors)) as executor:
+            results = list(executor.map(self._search, vectors))
+        return self._merge(queries, results)
+
+    async def _aget_relevant_documents(self, query, *, run_manager) -> List[Document]:
+        variants = await self.query_chain.ainvoke(query, {"callbacks": run_manager.get_child()})
+        queries = self._queries(query, variants)
+        if not queries:
+            return []
+        vectors = await self.vector_db.embeddings.aembed_documents(queries)
+        results = await asyncio.gather(*(asyncio.to_thread(self._search, vector) for vector in vectors))
+        return self._merge(queries, results)
+
+
+def retriever_embeddings(retriever):
+    """The embedding model of a retriever built by build_retriever."""
+    while hasattr(retriever, "retriever"):
+        # rerank / cache wrappers
+        retriever = retriever.retriever
+    if isinstance(retriever, HybridRetriever):
+        retriever = retriever.dense_retriever
+    return retriever.vectorstore.embeddings
+
+
+# keyword indexes built per docs path & manifest version
+_bm25_indexes = {}
+
+
+def get_bm25_index(docs_path="data"):
+    """Returns the BM25 index of the ingested chunks, shared by all the
+    retrievers until the manifest changes."""
+    manifest_path = os.path.join(docs_path, MANIFEST_NAME)
+    version = os.stat(manifest_path).st_mtime_ns if os.path.exists(manifest_path) else None
+    cached = _bm25_indexes.get(docs_path)
+    if cached is None or cached[0] != version:
+        cached = (version, BM25Index.from_manifest(docs_path))
+        _bm25_indexes[docs_path] = cached
+    return cached[1]
+
+
+def build_retriever(vector_db, docs_path="data", mode=RETRIEVER_MODE, k=RETRIEVER_K):
+    """Builds the retriever used by the rag chains.
+
+    Args:
+        vector_db: Pinecone or local vector store.
+        docs_path (str, optional): data directory holding the ingestion manifest.
+        mode (str, optional): "dense" or "hybrid". Defaults to RETRIEVER_MODE.
+        k (int, optional): documents returned. Defaults to RETRIEVER_K.
+
+    Returns:
+        BaseRetriever: the retriever
+    """
+    if mode == "dense":
+        return vector_db.as_retriever(search_kwargs={'k': k})
+    if mode == "hybrid":
+        bm25 = get_bm25_index(docs_path)
+        dense_retriever = vector_db.as_retriever(search_kwargs={'k': HYBRID_FETCH_K})
+        return HybridRetriever(dense_retriever=dense_retriever, bm25=bm25, k=k)
+    raise ValueError(f"Unknown retriever mode: {mode}")
@@ -0,0 +1,53 @@
+import re
+
+
+# words which refer back to earlier turns of the conversation
+_REFERENCE_WORDS = {
+    "it", "its", "they", "them", "their", "theirs", "this", "that", "these", "those",
+    "he", "him", "his", "she", "her", "hers", "there", "former", "latter", "above",
+    "same", "again", "else", "previous", "earlier", "one", "ones",
+}
+# follow up openers, e.g. "and for OPT?", "what about the spring term?"
+_FOLLOW_UP_RE = re.compile(r"^(and|but|also|so|then|or|what about|how about|why|why not|"
+                           r"ok|okay|same|more|another)\b")
+_WORD_RE = re.compile(r"[a-z0-9']+")
+
+# with chat history, questions shorter than this are condensed: short follow
+# ups ("is it online?", "what are the deadlines?") lean on the earlier turns
+MIN_STANDALONE_WORDS = 6
+
+
+def is_standalone(question):
+    """Cheap local check whether a question can be understood without the
+    chat history: long enough, not a follow up opener and no words that
+    refer back to the conversation.
+
+    The check leans towards condensing: a follow up wrongly taken as
+    standalone is retrieved & answered without its context (a wrong
+    answer), while a standalone question wrongly condensed only costs the
+    condense call.
+    """
+    text = question.strip().lower()
+    words = _WORD_RE.findall(text)
+    if len(words) < MIN_STANDALONE_WORDS:
+        return False
+    if _FOLLOW_UP_RE.match(text):
+        return False
+    return not _REFERENCE_WORDS.intersection(words)
+
+
+def needs_condense(question, chat_history):
+    """The condense question llm call is only needed for follow ups."""
+    if not chat_history:
+        return False
+    return not is_standalone(question)
+
+
+def token_overlap(question, other):
+    """Jaccard overlap of the words of two questions, reference words
+    excluded, e.g. a follow up and its condensed standalone question."""
+    words = set(_WORD_RE.findall(question.lower())) - _REFERENCE_WORDS
+    other_words = set(_WORD_RE.findall(other.lower())) - _REFERENCE_WORDS
+    if not words or not other_words:
+        return 0.0
+    return len(words & other_words) / len(words | other_words)
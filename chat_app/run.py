@@ -1,18 +1,17 @@
 import os
 from dotenv import load_dotenv
 from operator import itemgetter
-from langchain_openai import ChatOpenAI, OpenAI
-from langchain.memory import ConversationSummaryBufferMemory
 
+from .resources import get_registry
 from .utils import load_and_embed
-from .rags import base_rag, rag_with_hyde, rag_with_query_aug, rag_with_react
+from .tracing import RagTracer
 
 
 if __name__ == "__main__":
 
     from simple_term_menu import TerminalMenu
     
-    options = ["base", "query_aug", "hyde", "ReAct"]
+    options = ["base", "query_aug", "hyde", "ReAct", "extractive"]
     terminal_menu = TerminalMenu(options)
     idx = terminal_menu.show()
     print(f"Building {options[idx]} RAG...")
@@ -20,31 +19,15 @@ if __name__ == "__main__":
     # get the rag type
     rag_type = options[idx]
 
-    # intialize the LLM
-    llm = ChatOpenAI(model_name="gpt-3.5-turbo", temperature=0)
+    registry = get_registry("data")
+    api_key = os.environ["OPENAI_API_KEY"]
+    # sync the index with the documents, only new or changed files are embedded
+    load_and_embed("data", registry.embedding(api_key))
 
-    # Intialize memory
-    memory = ConversationSummaryBufferMemory(llm=llm, max_token_limit=2000,
-                                                    return_messages=True, 
-                                                    output_key="answer", 
-                                                    input_key="question")
-    
-    # load data and embed
-    retriever = load_and_embed("data")
-
-    # get the rag chain
-    if rag_type == "base":
-        rag_chain = base_rag(memory, retriever)
-
-    if rag_type == "query_aug":
-        rag_chain = rag_with_query_aug(memory, retriever)
-
-    if rag_type == "hyde":
-        rag_chain = rag_with_hyde(memory, retriever)
-
-    if rag_type.lower() == "react":
-        rag_chain = rag_with_react(memory, retriever)
-        
+    # the llm, retriever, chain & memory, like the web app builds them
+    rag = registry.get(rag_type.lower(), api_key)
+    rag_chain = rag.chain
+    memory = rag.memory
 
     # while True:
     #     question_input = input("\nUser: ")
@@ -72,11 +55,12 @@ if __name__ == "__main__":
         if question_input == "exit":
             break
 
-        inputs = {"question": question_input}
+        inputs = {"question": question_input, "session_id": "cli"}
         output = {}
         curr_key = None
         print("\nanswer:")
-        for chunk in rag_chain.stream(inputs):
+        tracer = RagTracer(rag_type.lower(), "cli")
+        for chunk in rag_chain.stream(inputs, tracer.config):
             # print(chunk)
             for key in chunk:
                 if key not in output:
@@ -84,7 +68,15 @@ if __name__ == "__main__":
                 else:
                     output[key] += chunk[key]
                 if key == "answer":
+                    tracer.first_token()
                     print(f"{chunk[key].content}", end="", flush=True)
                 # else:
                 #     print(chunk[key], end="", flush=True)
                 # curr_key = key
+
+        trace = tracer.finish(output["answer"].content if "answer" in output else "")
+        print(f"\n[{trace['seconds']:.2f}s, first token {trace['ttft'] or 0:.2f}s]")
+
+        # summarization of long conversations happens in the background
+        if "answer" in output:
+            memory.save_context(inputs, {"answer": output["answer"].content})
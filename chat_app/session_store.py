@@ -0,0 +1,293 @@
+import os, json, time
+import asyncio
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, get_buffer_string
+from langchain_core.output_parsers import StrOutputParser
+
+
+# "memory" (in process only), "sqlite" or "redis"
+SESSION_STORE_BACKEND = os.environ.get("SESSION_STORE_BACKEND", "memory")
+# sqlite file or redis url of the backend
+SESSION_STORE_PATH = os.environ.get("SESSION_STORE_PATH", "data/sessions.sqlite")
+SESSION_STORE_URL = os.environ.get("SESSION_STORE_URL", "redis://localhost:6379/0")
+# sessions kept in process, least recently used ones are evicted beyond it
+SESSION_MAX_SESSIONS = int(os.environ.get("SESSION_MAX_SESSIONS", 10_000))
+# sessions idle for longer are dropped
+SESSION_IDLE_TTL = int(os.environ.get("SESSION_IDLE_TTL", 24 * 3600))
+# tokens of recent messages kept verbatim, older ones are summarized
+SESSION_WINDOW_TOKENS = int(os.environ.get("SESSION_WINDOW_TOKENS", 2000))
+# sessions are locked by stripes, turns of different sessions rarely wait
+SESSION_LOCK_STRIPES = int(os.environ.get("SESSION_LOCK_STRIPES", 64))
+
+_ROLES = {"human": HumanMessage, "ai": AIMessage}
+
+
+class SqliteBackend:
+    """Key value backend persisting the sessions in sqlite.
+
+    It has the get / set(ex=) / delete interface of a redis client, so
+    either can back a SessionStore.
+    """
+
+    def __init__(self, path=SESSION_STORE_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL)")
+        self._conn.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires FROM sessions WHERE key = ?",
+                                     (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        return row[0]
+
+    def set(self, key, value, ex=None):
+        expires = time.time() + ex if ex else None
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO sessions (key, value, expires) VALUES (?, ?, ?)",
+                               (key, value, expires))
+            self._conn.commit()
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def expire(self):
+        """Deletes the expired sessions."""
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE expires < ?", (time.time(),))
+            self._conn.commit()
+
+
+class SessionStore:
+    """Compact store of the per session conversation state.
+
+    A session is a small dict: the rolling "summary" of the old turns and
+    the window of recent "messages" as [role, content, tokens] lists. Sessions
+    live in an in process LRU, bounded to max_sessions and dropped after
+    idle_ttl seconds without use. With a backend (sqlite or redis) every save
+    is written through, so evicted sessions are reloaded on their next turn.
+    """
+
+    def __init__(self, backend=None, max_sessions=SESSION_MAX_SESSIONS, idle_ttl=SESSION_IDLE_TTL):
+        self.backend = backend
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_sweep = time.time()
+
+    @staticmethod
+    def _empty():
+        return {"summary": "", "messages": [], "updated": time.time()}
+
+    def _key(self, session_id):
+        return f"session:{session_id}"
+
+    def evict_idle(self):
+        """Drops the sessions idle for longer than idle_ttl from the process."""
+        cutoff = time.time() - self.idle_ttl
+        with self._lock:
+            idle = [session_id for session_id, session in self.sessions.items()
+                    if session["updated"] < cutoff]
+            for session_id in idle:
+                del self.sessions[session_id]
+            self._last_sweep = time.time()
+        if hasattr(self.backend, "expire"):
+            self.backend.expire()
+
+    def get(self, session_id):
+        """Returns a copy of the session's state, an empty one for new sessions."""
+        with self._lock:
+            session = self.sessions.get(session_id)
+            if session is not None:
+                self.sessions.move_to_end(session_id)
+        if session is None and self.backend is not None:
+            value = self.backend.get(self._key(session_id))
+            if value is not None:
+                session = json.loads(value)
+        if session is None or time.time() - session["updated"] > self.idle_ttl:
+            return self._empty()
+        return {"summary": session["summary"], "messages": list(session["messages"]),
+                "updated": session["updated"]}
+
+    def save(self, session_id, session):
+        session["updated"] = time.time()
+        with self._lock:
+            self.sessions[session_id] = session
+            self.sessions.move_to_end(session_id)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        if self.backend is not None:
+            self.backend.set(self._key(session_id), json.dumps(session), ex=self.idle_ttl)
+        # sweep the idle sessions about once a minute
+        if time.time() - self._last_sweep > 60:
+            self.evict_idle()
+
+    def clear(self, session_id):
+        with self._lock:
+            self.sessions.pop(session_id, None)
+        if self.backend is not None:
+            self.backend.delete(self._key(session_id))
+
+
+class SessionMemory:
+    """Conversation memory of all the sessions behind the langchain memory
+    interface, the session is picked by the "session_id" of the inputs.
+
+    Like ConversationSummaryBufferMemory the history is the summary of the
+    old turns followed by the recent messages, which are kept under
+    max_token_limit tokens. Token counts are computed once per message and
+    stored with it.
+
+    Unlike it the summarization never runs inside save_context: a background
+    worker compacts the window between turns and until it is done the next
+    turn sees the last completed summary followed by the whole raw tail.
+
+    Updates of a session are serialized by a striped lock, so concurrent
+    sessions don't wait on each other's backend I/O.
+    """
+
+    def __init__(self, llm, store, max_token_limit=SESSION_WINDOW_TOKENS,
+                 lock_stripes=SESSION_LOCK_STRIPES):
+        self.llm = llm
+        self.store = store
+        self.max_token_limit = max_token_limit
+        # sessions with a summarization in flight
+        self._compacting = set()
+        self._lock = threading.Lock()
+        self._session_locks = [threading.Lock() for _ in range(max(1, lock_stripes))]
+
+    def _session_lock(self, session_id):
+        return self._session_locks[hash(session_id) % len(self._session_locks)]
+
+    def clear(self, session_id):
+        self.store.clear(session_id)
+
+    def _history(self, session):
+        messages = [_ROLES[role](content=content) for role, content, _ in session["messages"]]
+        if session["summary"]:
+            messages.insert(0, SystemMessage(content=session["summary"]))
+        return {"history": messages}
+
+    def load_memory_variables(self, inputs):
+        return self._history(self.store.get(inputs["session_id"]))
+
+    async def aload_memory_variables(self, inputs):
+        # sqlite / redis reads block, keep them off the event loop
+        return await asyncio.to_thread(self.load_memory_variables, inputs)
+
+    def _messages(self, inputs, outputs):
+        return [[role, content, self.llm.get_num_tokens_from_messages([_ROLES[role](content=content)])]
+                for role, content in (("human", inputs["question"]), ("ai", outputs["answer"]))]
+
+    def _overflow(self, session):
+        """Number of oldest messages to summarize to get under the token limit."""
+        total = sum(tokens for _, _, tokens in session["messages"])
+        count = 0
+        while count < len(session["messages"]) and total > self.max_token_limit:
+            total -= session["messages"][count][2]
+            count += 1
+        return count
+
+    def save_context(self, inputs, outputs):
+        """Appends the turn, the summarization of an overflowing window is
+        scheduled in the background, nobody waits for it."""
+        session_id = inputs["session_id"]
+        # token counting needs no lock
+        messages = self._messages(inputs, outputs)
+        with self._session_lock(session_id):
+            session = self.store.get(session_id)
+            session["messages"].extend(messages)
+            self.store.save(session_id, session)
+            overflow = self._overflow(session)
+        if not overflow:
+            return
+        with self._lock:
+            if session_id in self._compacting:
+                return
+            self._compacting.add(session_id)
+        get_summary_executor().submit(self._compact, session_id)
+
+    async def asave_context(self, inputs, outputs):
+        # token counting & the backend write block, run them in a thread
+        await asyncio.to_thread(self.save_context, inputs, outputs)
+
+    def _compact(self, session_id):
+        """Folds the oldest messages into the summary, runs between turns.
+
+        The llm call runs without the lock, the new summary is only applied
+        if the summarized messages are still the oldest ones (the session
+        was not cleared meanwhile), messages added meanwhile are kept.
+        """
+        try:
+            with self._session_lock(session_id):
+                session = self.store.get(session_id)
+                count = self._overflow(session)
+                summarized = session["messages"][:count]
+                summary = session["summary"]
+            if not count:
+                return
+            # langchain.memory loads all of langchain.chains, only needed here
+            from langchain.memory.prompt import SUMMARY_PROMPT
+
+            pruned = [_ROLES[role](content=content) for role, content, _ in summarized]
+            new_summary = (SUMMARY_PROMPT | self.llm | StrOutputParser()).invoke(
+                {"summary": summary, "new_lines": get_buffer_string(pruned)})
+            with self._session_lock(session_id):
+                session = self.store.get(session_id)
+                if session["summary"] == summary and session["messages"][:count] == summarized:
+                    session["summary"] = new_summary
+                    session["messages"] = session["messages"][count:]
+                    self.store.save(session_id, session)
+        except Exception as e:
+            # the raw messages are kept, the next turn retries
+            print(f"summarization of session failed: {e}")
+        finally:
+            with self._lock:
+                self._compacting.discard(session_id)
+
+
+# summaries are written by background workers, off the answer path
+SUMMARY_WORKERS = int(os.environ.get("SUMMARY_WORKERS", 2))
+_summary_executor = None
+
+
+def get_summary_executor():
+    global _summary_executor
+    if _summary_executor is None:
+        _summary_executor = ThreadPoolExecutor(max_workers=SUMMARY_WORKERS,
+                                               thread_name_prefix="summarizer")
+    return _summary_executor
+
+
+_session_store = None
+
+
+def get_session_store():
+    """Returns the process wide session store of the configured backend."""
+    global _session_store
+    if _session_store is None:
+        backend = None
+        if SESSION_STORE_BACKEND == "sqlite":
+            backend = SqliteBackend(SESSION_STORE_PATH)
+        elif SESSION_STORE_BACKEND == "redis":
+            import redis
+
+            backend = redis.Redis.from_url(SESSION_STORE_URL)
+        elif SESSION_STORE_BACKEND != "memory":
+            raise ValueError(f"Unknown session store backend: {SESSION_STORE_BACKEND}")
+        _session_store = SessionStore(backend)
+    return _session_store
@@ -0,0 +1,151 @@
+import os, re, sys, json
+import importlib.util
+import subprocess
+import statistics
+
+
+# seconds a cold import of a module may take, the app & cli entry points
+# and the modules the worker processes import
+IMPORT_BUDGETS = {
+    "chat_app.state": 2.0,
+    "chat_app.run": 0.6,
+    "chat_app.resources": 0.6,
+    "chat_app.rags": 0.6,
+    "chat_app.utils": 0.4,
+}
+STARTUP_RUNS = 5
+
+_MISSING_MODULE_RE = re.compile(r"ModuleNotFoundError: No module named '([^']+)'")
+
+# imports a module in a fresh interpreter with the network cut off, an
+# import reaching for it (clients created at import time) fails
+_PROBE = """
+import socket, sys, time, json
+
+def offline(*args, **kwargs):
+    raise OSError("network access while importing")
+
+socket.socket.connect = offline
+socket.create_connection = offline
+socket.getaddrinfo = offline
+
+start = time.perf_counter()
+import {module}
+print(json.dumps({{"seconds": time.perf_counter() - start}}))
+"""
+
+
+def _run_probe(module, importtime=False):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")]))}
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + \
+              ["-c", _PROBE.format(module=module)]
+    return subprocess.run(command, cwd=root, env=env, capture_output=True, text=True)
+
+
+def heaviest_imports(module, top=5):
+    """The dependencies taking the longest to import, from python -X importtime.
+
+    Returns:
+        list(tuple(str, float)): (module, cumulative seconds)
+    """
+    result = _run_probe(module, importtime=True)
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        name = name.strip()
+        if not name.startswith("chat_app"):
+            timings.append((name, int(cumulative) / 1e6))
+    return sorted(timings, key=lambda timing: timing[1], reverse=True)[:top]
+
+
+def measure_import(module, runs=STARTUP_RUNS):
+    """Cold import time of a module, the median over fresh interpreters.
+
+    Returns:
+        dict: {"module", "seconds", "error"}
+    """
+    times = []
+    for _ in range(runs):
+        result = _run_probe(module)
+        if result.returncode != 0:
+            error = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "failed"
+            return {"module": module, "seconds": None, "error": error}
+        times.append(json.loads(result.stdout.strip().splitlines()[-1])["seconds"])
+    return {"module": module, "seconds": statistics.median(times), "error": None}
+
+
+def missing_dependency(error):
+    """The third party package an import error is about, if it is really
+    not installed here. None for anything else, e.g. a broken import inside
+    the app or a module that exists but failed to import."""
+    match = _MISSING_MODULE_RE.search(error or "")
+    if match is None:
+        return None
+    package = match.group(1).split(".")[0]
+    if package == "chat_app" or importlib.util.find_spec(package) is not None:
+        return None
+    return package
+
+
+def check_budgets(budgets=IMPORT_BUDGETS, runs=STARTUP_RUNS):
+    """Measures the modules against their import time budgets.
+
+    Modules needing a third party package which is not installed are
+    skipped, any other import error, imports needing the network or over
+    budget fail.
+
+    Returns:
+        tuple(list(dict), list(str)): the measures & the failures
+    """
+    results, failures = [], []
+    for module, budget in budgets.items():
+        result = measure_import(module, runs)
+        result["budget"] = budget
+        results.append(result)
+        if result["error"] is not None:
+            if missing_dependency(result["error"]) is not None:
+                print(f"{module:<22} skipped, {result['error']}")
+                continue
+            print(f"{module:<22} FAILED, {result['error']}")
+            failures.append(f"{module}: {result['error']}")
+            continue
+
+        over = result["seconds"] > budget
+        print(f"{module:<22} {result['seconds'] * 1000:7.0f}ms  budget {budget * 1000:5.0f}ms"
+              + ("  OVER BUDGET" if over else ""))
+        if over:
+            failures.append(f"{module}: {result['seconds']:.2f}s over its {budget:.2f}s budget")
+            for name, seconds in heaviest_imports(module):
+                print(f"{'':>24}{name} {seconds * 1000:.0f}ms")
+    return results, failures
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Measures the cold import time of the app modules "
+                                                 "against their budgets, with the network cut off.")
+    parser.add_argument("--runs", type=int, default=STARTUP_RUNS)
+    parser.add_argument("--modules", nargs="+", help="only these modules of IMPORT_BUDGETS")
+    parser.add_argument("--profile", help="print the heaviest imports of a module")
+    parser.add_argument("--output", help="write the measures to this json file")
+    args = parser.parse_args()
+
+    if args.profile:
+        for name, seconds in heaviest_imports(args.profile, top=15):
+            print(f"{name:<60} {seconds * 1000:7.0f}ms")
+        sys.exit(0)
+
+    budgets = {module: budget for module, budget in IMPORT_BUDGETS.items()
+               if not args.modules or module in args.modules}
+    results, failures = check_budgets(budgets, args.runs)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+    if failures:
+        sys.exit(1)
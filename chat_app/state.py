@@ -1,12 +1,12 @@
 import reflex as rx
-import os, sys, openai
+import os, sys
+import asyncio
 from dotenv import load_dotenv
 from operator import itemgetter
-from langchain_openai import ChatOpenAI, OpenAI, OpenAIEmbeddings
-from langchain.memory import ConversationSummaryBufferMemory
 
-from .rags import base_rag, rag_with_hyde, rag_with_query_aug, rag_with_react
-from .utils import load_and_embed, get_pinecone_db
+from .resources import get_registry
+from .streaming import coalesce_tokens
+from .tracing import RagTracer
 print()
 
 # load env variables
@@ -18,14 +18,18 @@ print()
 
 # use rag or directly use openai_api
 use_rag_mode = True
-# all rag methods
-rag_methods = {"base": base_rag, "hyde": rag_with_hyde, 
-               "query_aug":rag_with_query_aug, "react": rag_with_react}
 
 # load data and embed
 # webui dir
 dir_path = os.getcwd() # f"{os.path.abspath(__file__)}"
 
+# max answers generated concurrently by this backend process
+RAG_MAX_CONCURRENCY = int(os.environ.get("RAG_MAX_CONCURRENCY", 64))
+answer_semaphore = asyncio.Semaphore(RAG_MAX_CONCURRENCY)
+# turns kept in the state for display, the conversation memory itself is
+# in the session store so the state sent to the frontend stays small
+CHAT_TAIL_TURNS = int(os.environ.get("CHAT_TAIL_TURNS", 20))
+
 # to load and embed documents into vector db
 # embedding_model = OpenAIEmbeddings()
 # vector_db = load_and_embed(f"{dir_path}/data", embedding_model)
@@ -37,12 +41,13 @@ class State(rx.State):
     question: str
     # Keep track of the chat history as a list of (question, answer) tuples.
     chat_history: list[tuple[str, str]] = []
+    # the question being answered & its answer so far
+    streaming_question: str = ""
+    streaming_answer: str = ""
     # openai key
     openai_api_key: str
-    # to track rag initialization
-    rag_init = False
     # possible rag values
-    rag_values: list[str] = ["base", "query_aug", "hyde", "react"]
+    rag_values: list[str] = ["base", "query_aug", "hyde", "react", "extractive"]
     # rag type
     rag_type: str = rag_values[0]
     # track rag_val changes
@@ -50,49 +55,34 @@ class State(rx.State):
 
 
     def initialize_rag(self, rag_type):
+        """Gets the rag resources of this session from the process wide pool,
+        they are only built by the first session using this rag type & key."""
+        return get_registry(f"{dir_path}/data").get(rag_type, self.openai_api_key)
 
-        print(f"Initialzing llm & {rag_type} rag...")
-        # get open api key if provided
-
-        openai.api_key = self.openai_api_key
-
-        # intialize the LLM
-        self.llm = ChatOpenAI(model_name="gpt-3.5-turbo", temperature=0.1, 
-                              api_key=self.openai_api_key)
-        embedding_model = OpenAIEmbeddings(api_key=self.openai_api_key)
-
-        # initialize retriever client
-        vector_db = get_pinecone_db(embedding_model)
-        # create retriver based on vectordb
-        # search_type="mmr"
-        self.retriever = vector_db.as_retriever(search_kwargs={'k': 5})
 
-        # Intialize memory
-        self.memory = ConversationSummaryBufferMemory(llm=self.llm, max_token_limit=2000,
-                                                        return_messages=True, 
-                                                        output_key="answer", 
-                                                        input_key="question")
-        # get the rag_chain
-        # self.rag_chain = rag_with_query_aug(self.memory, retriever)
-        self.rag_chain = rag_methods[rag_type](self.llm, self.memory, self.retriever)
+    async def ainitialize_rag(self, rag_type):
+        """initialize_rag in a thread, building the resources blocks (index
+        loading, pinecone calls) and must not stall the other sessions."""
+        return await asyncio.to_thread(self.initialize_rag, rag_type)
 
 
-    def change_rag_type(self):
+    async def change_rag_type(self):
         """Change the select value var."""
+        # the new rag starts a new conversation, the memory only depends on
+        # the key (& model), no need to build the old rag's chain for it
+        memory = get_registry(f"{dir_path}/data").memory(self.openai_api_key)
+        await asyncio.to_thread(memory.clear, self.router.session.client_token)
         self.rag_type = self.current_rag_val
-        self.initialize_rag(self.rag_type)
+        await self.ainitialize_rag(self.rag_type)
         self.chat_history = []
 
 
-    def answer(self):
+    async def answer(self):
         #
         # Our chatbot brain!
-        if (use_rag_mode) and (not self.rag_init):
-            # intialize the rag for first time
-            self.initialize_rag(self.rag_type)
-
-            # change the variable
-            self.rag_init = True
+        if use_rag_mode:
+            # shared chain & memories, only this session's handle is in the state
+            rag = await self.ainitialize_rag(self.rag_type)
 
         # define a empty response
         session = {}
@@ -106,52 +96,66 @@ class State(rx.State):
         if self.question == "":
             return
 
-        if len(self.question):
+        # Add to the answer as the chatbot responds.
+        answer = ""
+        question = self.question
+        # the in-flight message is kept out of chat_history, so a streamed
+        # delta carries only this message and not the whole history
+        self.streaming_question = question
+        self.streaming_answer = ""
+
+        # Clear the question input.
+        self.question = ""
+        # Yield here to clear the frontend input before continuing.
+        yield
+
+        # the worker is free to serve other chats while waiting on the llm,
+        # the semaphore bounds how many answers are generated at once
+        async with answer_semaphore:
             if use_rag_mode:
-                inputs = {"question": self.question}
-                session = self.rag_chain.stream(inputs)
+                inputs = {"question": question, "session_id": self.router.session.client_token}
+                # per stage timings, token counts & the request trace
+                tracer = RagTracer(self.rag_type, inputs["session_id"])
+
+                async def tokens():
+                    async for chunk in rag.chain.astream(inputs, tracer.config):
+                        if "answer" in chunk:
+                            yield chunk["answer"].content
+
             else:
                 print("directly using chatgpt api...")
-                msg = [{"role": "user", "content": self.question}]
-                session = openai.OpenAI(
+                import openai
+
+                msg = [{"role": "user", "content": question}]
+                session = await openai.AsyncOpenAI(
                     api_key=self.openai_api_key).chat.completions.create(
                     model="gpt-3.5-turbo",
                     messages=system_msg + msg,
                     stop=None,
                     temperature=0.9,
                     stream=True)
-        
-        # Add to the answer as the chatbot responds.
-        answer = ""
-        self.chat_history.append((self.question, answer))
 
-        if use_rag_mode:
-            # save the memory for rag
-            self.memory.save_context(inputs, {"answer": answer})
+                async def tokens():
+                    async for item in session:
+                        if item.choices[0].delta.content:
+                            yield item.choices[0].delta.content
 
-        # Clear the question input.
-        self.question = ""
-        # Yield here to clear the frontend input before continuing.
-        yield
+            # tokens are sent in pieces, coalesced over a short time window
+            async for piece in coalesce_tokens(tokens()):
+                if use_rag_mode and not answer:
+                    tracer.first_token()
+                answer += piece
+                self.streaming_answer = answer
+                yield
 
-        if use_rag_mode:
-            for chunk in session:
-                # print(chunk)
-                for key in chunk:
-                    if key == "answer":
-                        answer += chunk[key].content
-                        self.chat_history[-1] = (
-                        self.chat_history[-1][0],
-                        answer,)
-                        yield
-                    # print(f"{chunk[key].content}", end="", flush=True)
-        
-        else:
-            for item in session:
-                if item.choices[0].delta.content:
-                    answer += item.choices[0].delta.content
-                    self.chat_history[-1] = (
-                        self.chat_history[-1][0],
-                        answer,
-                    )
-                    yield
\ No newline at end of file
+            if use_rag_mode:
+                tracer.finish(answer)
+                # save the memory for rag, once the full answer is known
+                await rag.memory.asave_context(inputs, {"answer": answer})
+
+        # the finished message moves to the history
+        self.chat_history.append((question, answer))
+        if len(self.chat_history) > CHAT_TAIL_TURNS:
+            self.chat_history = self.chat_history[-CHAT_TAIL_TURNS:]
+        self.streaming_question = ""
+        self.streaming_answer = ""
@@ -0,0 +1,37 @@
+import os, time
+
+
+# streamed tokens are sent to the frontend at most every interval seconds,
+# or earlier once this many characters are pending
+STREAM_FLUSH_INTERVAL = float(os.environ.get("STREAM_FLUSH_INTERVAL", 0.1))
+STREAM_FLUSH_CHARS = int(os.environ.get("STREAM_FLUSH_CHARS", 200))
+
+
+async def coalesce_tokens(tokens, interval=STREAM_FLUSH_INTERVAL, max_chars=STREAM_FLUSH_CHARS):
+    """Groups streamed tokens into larger pieces.
+
+    The first token is emitted as is, then a piece is emitted when interval
+    seconds passed since the last one or when max_chars characters are
+    pending, the rest is emitted at the end.
+    An interval of 0 emits every token.
+
+    Args:
+        tokens: async iterator of text tokens.
+        interval (float, optional): max seconds between two pieces.
+        max_chars (int, optional): max characters held back.
+
+    Yields:
+        str: the text appended since the previous piece
+    """
+    pending = ""
+    # the first token goes out right away
+    last_flush = float("-inf")
+    async for token in tokens:
+        pending += token
+        now = time.monotonic()
+        if pending and (now - last_flush >= interval or len(pending) >= max_chars):
+            yield pending
+            pending = ""
+            last_flush = now
+    if pending:
+        yield pending
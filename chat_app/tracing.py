@@ -0,0 +1,177 @@
+import time
+import threading
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import get_buffer_string
+
+from .packing import count_tokens
+from . import metrics
+
+
+# chain steps named with run_name in rags.py, timed as pipeline stages
+STAGES = {"load_memory", "condense", "hyde", "query_variants", "reason_context",
+          "context_filter", "generate"}
+
+
+class RagTracer(BaseCallbackHandler):
+    """Times the stages of one rag request from the langchain callbacks.
+
+    Named chain steps (STAGES) and the outermost retriever run ("retrieve")
+    are timed, every llm call gets its prompt & completion token counts,
+    time to first token and tokens/sec, attributed to the stage it runs in.
+    finish() records the histograms and writes the jsonl trace.
+
+    When streaming, a step starts as soon as the first chunk of its input
+    arrives, e.g. "generate" gets the question while "reason_context" is
+    still running. Stages calling an llm are therefore timed from the start
+    of their first llm call, so they don't include the upstream time.
+
+    Usage:
+        tracer = RagTracer("base")
+        async for chunk in chain.astream(inputs, tracer.config):
+            ...first answer chunk: tracer.first_token()
+        tracer.finish(answer)
+    """
+
+    # called on the event loop thread, no executor hop per callback
+    run_inline = True
+
+    def __init__(self, rag_type, session_id=None):
+        self.rag_type = rag_type
+        self.session_id = session_id
+        self.start = time.perf_counter()
+        self.ttft = None
+        self.stages = []
+        self.llm_calls = []
+        self._runs = {}
+        self._lock = threading.Lock()
+
+    @property
+    def config(self):
+        return {"callbacks": [self], "run_name": self.rag_type}
+
+    def _stage_run(self, run_id):
+        # the closest named ancestor
+        while run_id in self._runs:
+            run = self._runs[run_id]
+            if run["stage"]:
+                return run
+            run_id = run["parent"]
+        return None
+
+    def _stage_of(self, run_id):
+        run = self._stage_run(run_id)
+        return run["stage"] if run is not None else None
+
+    def _start(self, run_id, parent_run_id, stage, **extra):
+        with self._lock:
+            self._runs[run_id] = {"parent": parent_run_id, "stage": stage,
+                                  "start": time.perf_counter(), **extra}
+
+    def _end(self, run_id):
+        with self._lock:
+            run = self._runs.get(run_id)
+            if run is None or not run["stage"]:
+                return
+            seconds = time.perf_counter() - run.get("llm_start", run["start"])
+            self.stages.append({"stage": run["stage"], "seconds": seconds})
+        metrics.observe("stage_seconds", seconds, stage=run["stage"])
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs):
+        name = kwargs.get("name")
+        # the root run is named after the rag type, e.g. "hyde", not a stage
+        stage = name if name in STAGES and parent_run_id is not None else None
+        self._start(run_id, parent_run_id, stage)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_retriever_start(self, serialized, query, *, run_id, parent_run_id=None, **kwargs):
+        with self._lock:
+            # rerank / hybrid retrievers wrap other retrievers, time the outer one
+            inner = False
+            ancestor = parent_run_id
+            while ancestor in self._runs:
+                if self._runs[ancestor].get("retriever"):
+                    inner = True
+                    break
+                ancestor = self._runs[ancestor]["parent"]
+        self._start(run_id, parent_run_id, None if inner else "retrieve", retriever=True)
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, **kwargs):
+        prompt_tokens = sum(count_tokens(get_buffer_string(batch)) for batch in messages)
+        self._start(run_id, parent_run_id, None, llm=True, prompt_tokens=prompt_tokens,
+                    first_token=None, text="")
+        with self._lock:
+            stage = self._stage_run(parent_run_id)
+            if stage is not None and "llm_start" not in stage:
+                # the stage's own work starts with its llm call
+                stage["llm_start"] = self._runs[run_id]["start"]
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        with self._lock:
+            run = self._runs.get(run_id)
+            if run is not None:
+                if run["first_token"] is None:
+                    run["first_token"] = time.perf_counter()
+                run["text"] += token
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        with self._lock:
+            run = self._runs.get(run_id)
+            if run is None or not run.get("llm"):
+                return
+        end = time.perf_counter()
+        text = run["text"] or "".join(generation.text for generations in response.generations
+                                      for generation in generations)
+        completion_tokens = count_tokens(text)
+        stage = self._stage_of(run["parent"]) or "llm"
+        call = {"stage": stage, "seconds": end - run["start"],
+                "prompt_tokens": run["prompt_tokens"], "completion_tokens": completion_tokens}
+        if run["first_token"] is not None:
+            call["ttft"] = run["first_token"] - run["start"]
+            streaming = end - run["first_token"]
+            if streaming > 0:
+                call["tokens_per_second"] = completion_tokens / streaming
+        with self._lock:
+            self.llm_calls.append(call)
+
+        metrics.observe("llm_seconds", call["seconds"], stage=stage)
+        metrics.observe("prompt_tokens", call["prompt_tokens"], stage=stage)
+        metrics.observe("completion_tokens", completion_tokens, stage=stage)
+        metrics.increment("llm_prompt_tokens", call["prompt_tokens"])
+        metrics.increment("llm_completion_tokens", completion_tokens)
+        if "ttft" in call:
+            metrics.observe("llm_ttft_seconds", call["ttft"], stage=stage)
+        if "tokens_per_second" in call:
+            metrics.observe("tokens_per_second", call["tokens_per_second"], stage=stage)
+
+    def first_token(self):
+        """Marks the first answer token reaching the user."""
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - self.start
+            metrics.observe("ttft_seconds", self.ttft, rag_type=self.rag_type)
+
+    def finish(self, answer=""):
+        """Records the request totals & writes its trace.
+
+        Returns:
+            dict: the trace
+        """
+        total = time.perf_counter() - self.start
+        metrics.increment("requests")
+        metrics.observe("request_seconds", total, rag_type=self.rag_type)
+        trace = {"time": time.time(), "rag_type": self.rag_type, "session_id": self.session_id,
+                 "seconds": total, "ttft": self.ttft, "answer_tokens": count_tokens(answer),
+                 "stages": self.stages, "llm_calls": self.llm_calls}
+        metrics.write_trace(trace)
+        return trace
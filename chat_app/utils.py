@@ -1,21 +1,42 @@
-import os, sys
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import Chroma
-from langchain_openai import ChatOpenAI, OpenAI, OpenAIEmbeddings
-from .data_loaders import load_pdfs, load_docx_files, load_text_files, load_json_file
-import logging, time
-from pinecone import Pinecone, ServerlessSpec
-from langchain_pinecone import PineconeVectorStore
-
-PINECONE_API_KEY = os.environ["PINECONE_API_KEY"]
+import os, time
+from .data_loaders import list_source_files
+from .pipeline import PipelineStats, parse_files
+from .bulk_index import BulkIndexer, INDEX_CHECKPOINT_PATH, PINECONE_TEXT_KEY
+from .manifest import IngestManifest, MANIFEST_NAME, chunk_records
+from .embedding_cache import get_cached_embeddings
+from .vector_store import LocalVectorStore
+from .faq import build_faq_index
+from .context_filter import precompute_sentence_embeddings
+
 PINECONE_INDEX_NAME="bull-buddy-index"
 
-# declare and configure pincone client  
-pc = Pinecone(api_key=PINECONE_API_KEY)
-spec = ServerlessSpec(cloud='aws', region='us-east-1')  
+# vector db backend, "pinecone" or "local"
+VECTOR_STORE_BACKEND = os.environ.get("VECTOR_STORE_BACKEND", "pinecone")
+# the local backend is persisted next to the documents (relative to the docs path)
+LOCAL_INDEX_PATH = os.environ.get("LOCAL_INDEX_PATH", "local_index")
+# seconds between saves of the local index & the manifest during ingestion,
+# a crash redoes at most this much work
+INGEST_SAVE_INTERVAL = float(os.environ.get("INGEST_SAVE_INTERVAL", 60))
+
+# pincone client, created on first use so the local backend works offline,
+# the pinecone packages are only imported then too
+pc = None
+
+
+def get_pinecone_client():
+    # declare and configure pincone client  
+    global pc
+    if pc is None:
+        from pinecone import Pinecone
+
+        pc = Pinecone(api_key=os.environ["PINECONE_API_KEY"])
+    return pc
+
 
 def get_pinecone_db(embedding):
-    
+    from langchain_pinecone import PineconeVectorStore
+
+    pc = get_pinecone_client()
     # check for and delete index if already exists  
     if PINECONE_INDEX_NAME in pc.list_indexes().names():
         print("loading existing pincone index....")
@@ -23,62 +44,206 @@ def get_pinecone_db(embedding):
             print("Waiting...Index Not Ready...")
             time.sleep(1)    
         # initialize the vector-db
-        vectordb = PineconeVectorStore(index_name=PINECONE_INDEX_NAME, embedding=embedding)
+        vectordb = PineconeVectorStore(index_name=PINECONE_INDEX_NAME, embedding=embedding,
+                                       text_key=PINECONE_TEXT_KEY)
         return vectordb
     else:
         raise Exception("Index Not Found...")
 
 
+def create_pinecone_db(embedding):
+    from pinecone import ServerlessSpec
+    from langchain_pinecone import PineconeVectorStore
+
+    pc = get_pinecone_client()
+    # create a new index  
+    pc.create_index(  
+        PINECONE_INDEX_NAME,  
+        dimension=1536,  # dimensionality of text-embedding-ada-002  
+        metric='dotproduct',  
+        spec=ServerlessSpec(cloud='aws', region='us-east-1')
+    )
+
+    # wait for index to be initialized  
+    while not pc.describe_index(PINECONE_INDEX_NAME).status['ready']:
+        print("Waiting...Index Not Ready...")
+        time.sleep(1)
+
+    return PineconeVectorStore(index_name=PINECONE_INDEX_NAME, embedding=embedding,
+                               text_key=PINECONE_TEXT_KEY)
+
+
+def get_local_db(embedding, docs_path="data"):
+
+    path = os.path.join(docs_path, LOCAL_INDEX_PATH)
+    if not LocalVectorStore.exists(path):
+        raise Exception("Index Not Found...")
+    print("loading local index from disk: ", path)
+    return LocalVectorStore(embedding, path)
+
+
+def get_vector_db(embedding, docs_path="data"):
+    """Returns the vector db of the configured VECTOR_STORE_BACKEND."""
+    if VECTOR_STORE_BACKEND == "local":
+        return get_local_db(embedding, docs_path)
+    return get_pinecone_db(embedding)
+
+
+def create_vector_db(embedding, docs_path="data"):
+    if VECTOR_STORE_BACKEND == "local":
+        return LocalVectorStore(embedding, os.path.join(docs_path, LOCAL_INDEX_PATH))
+    return create_pinecone_db(embedding)
+
+
+def clear_vector_db(vectordb):
+    if isinstance(vectordb, LocalVectorStore):
+        vectordb.clear()
+    else:
+        get_pinecone_client().Index(PINECONE_INDEX_NAME).delete(delete_all=True)
+
+
+def print_vector_db_stats(vectordb):
+    # print index info
+    if isinstance(vectordb, LocalVectorStore):
+        print(f"local index: {len(vectordb)} vectors")
+    else:
+        index = get_pinecone_client().Index(PINECONE_INDEX_NAME) 
+        print(index.describe_index_stats())
+
+
+def get_text_splitter():
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    # split the data into chunks
+    return RecursiveCharacterTextSplitter(
+        chunk_size = 400,
+        chunk_overlap = 100,
+        # chunk offsets, lets the context packer merge adjacent chunks
+        add_start_index = True
+    )
+
+
 def load_and_embed(docs_path, embed_model):
+    """Incrementally syncs the documents in docs_path with the vector db.
+
+    Only new or changed files are parsed, split and embedded. Inside a changed
+    file, chunks whose content did not change keep their vectors. Vectors of
+    removed files are deleted. What is in the index is tracked by the
+    ingestion manifest stored in docs_path.
+
+    Args:
+        docs_path (str): data directory containing the pdfs/ & docx/ sub folders.
+        embed_model: Langchain embedding model.
+
+    Returns:
+        VectorStore: the synced vector db
+    """
 
-    # we create our vectorDB inside the ./data directory
+    # re-embedding a rebuilt index or boilerplate chunks hits the local cache
+    embed_model = get_cached_embeddings(embed_model, docs_path)
+    manifest = IngestManifest.load(os.path.join(docs_path, MANIFEST_NAME))
 
+    rebuilt = False
     try:
-        retriever = get_pinecone_db(embed_model)
+        vectordb = get_vector_db(embed_model, docs_path)
+        if not manifest.exists:
+            # index built before the manifest existed, we do not know
+            # the ids of its vectors so clear it and ingest everything
+            print("index has no ingestion manifest, rebuilding it...")
+            clear_vector_db(vectordb)
+            rebuilt = True
     except Exception as e:
-        # load the documents
-        documents = []
-        word_docs = load_docx_files(f"{docs_path}/docx")
-        pdfs = load_pdfs(f"{docs_path}/pdfs")
-        # json_docs = load_json_file(f"{docs_path}/json/jira-conversations-faqs.json",
-        #                         jq_schema='.[].faq[]',
-        #                         text_content=False)
-
-        documents = pdfs + word_docs # + json_docs
-        print("total pages found: ", len(documents))
-        # print(documents[0])
-
-        # split the data into chunks
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size = 400,
-            chunk_overlap = 100
-        )
-
-        # store the splits to vector db
-        splits = text_splitter.split_documents(documents)
-
-        # create a new index  
-        pc.create_index(  
-            PINECONE_INDEX_NAME,  
-            dimension=1536,  # dimensionality of text-embedding-ada-002  
-            metric='dotproduct',  
-            spec=spec  
-        )
-
-        # wait for index to be initialized  
-        while not pc.describe_index(PINECONE_INDEX_NAME).status['ready']:
-            print("Waiting...Index Not Ready...")
-            time.sleep(1)
+        vectordb = create_vector_db(embed_model, docs_path)
+        rebuilt = True
+    if rebuilt:
+        # a new index generation, saved right away so an interrupted build
+        # resumes with the batch checkpoint of this generation
+        manifest = IngestManifest(manifest.path)
+        manifest.save()
 
-        # vector store
-        vectordb = PineconeVectorStore.from_documents(splits, embed_model, 
-                                                      index_name=PINECONE_INDEX_NAME)
+    # find what changed since the last run
+    sources = list_source_files(docs_path)
+    changed, removed = manifest.diff(sources)
+    print(f"files: {len(sources)} total, {len(changed)} new/changed, {len(removed)} removed")
 
-    # print index info
-    index = pc.Index(PINECONE_INDEX_NAME) 
-    print(index.describe_index_stats())
+    # drop the vectors of deleted files
+    for path in removed:
+        ids = manifest.chunk_ids(path)
+        if ids:
+            vectordb.delete(ids=ids)
+        manifest.remove(path)
+
+    text_splitter = get_text_splitter()
+    # rate limited, retried & checkpointed embedding + upserts, the local
+    # store is only persisted per file so its batches are not checkpointed
+    checkpoint_path = (None if isinstance(vectordb, LocalVectorStore)
+                       else os.path.join(docs_path, INDEX_CHECKPOINT_PATH))
+    # pinecone is written through its public Index client
+    target = (vectordb if isinstance(vectordb, LocalVectorStore)
+              else get_pinecone_client().Index(PINECONE_INDEX_NAME))
+    indexer = BulkIndexer(embed_model, target, checkpoint_path=checkpoint_path,
+                          generation=manifest.generation)
+    if rebuilt:
+        # batches committed to the previous index are gone with it
+        indexer.reset()
+    digests = dict(changed)
+    stats = PipelineStats()
+    last_save = time.monotonic()
+    # files are parsed in a process pool and streamed here as they complete
+    for path, pages in parse_files(digests, stats=stats):
+        # split the document
+        start = time.perf_counter()
+        splits = text_splitter.split_documents(pages)
+        # ids derive from the path relative to docs_path, like the manifest keys
+        chunks = chunk_records(manifest.key(path), splits)
+        stats.add("split", len(splits), time.perf_counter() - start)
+
+        # only embed the chunks which are not in the index yet
+        old_ids = set(manifest.chunk_ids(path))
+        new_ids = [chunk["id"] for chunk in chunks]
+        new_splits = [(split, chunk["id"]) for split, chunk in zip(splits, chunks)
+                      if chunk["id"] not in old_ids]
+        start = time.perf_counter()
+        embedded, skipped = indexer.index([split for split, _ in new_splits],
+                                          [vector_id for _, vector_id in new_splits])
+        stats.add("embed", embedded, time.perf_counter() - start)
+
+        # warm the embedding cache with the sentences the extractive filter scores
+        start = time.perf_counter()
+        sentences = precompute_sentence_embeddings(embed_model, [split for split, _ in new_splits])
+        stats.add("sentences", sentences, time.perf_counter() - start)
+
+        stale_ids = list(old_ids.difference(new_ids))
+        if stale_ids:
+            vectordb.delete(ids=stale_ids)
+        print(f"{path}: {len(splits)} chunks, {embedded} embedded, {skipped} already indexed, "
+              f"{len(stale_ids)} deleted")
+
+        manifest.update(path, digests[path], chunks)
+        # saving rewrites the whole local index & manifest, only do it every
+        # INGEST_SAVE_INTERVAL seconds, an interrupted run redoes the files since
+        if time.monotonic() - last_save > INGEST_SAVE_INTERVAL:
+            if isinstance(vectordb, LocalVectorStore):
+                vectordb.save()
+            manifest.save()
+            last_save = time.monotonic()
+
+    # manifest may hold refreshed stat info of untouched files
+    if isinstance(vectordb, LocalVectorStore):
+        vectordb.save()
+        if changed or removed:
+            vectordb.build_ann_index()
+    manifest.save()
+    # every file is in the manifest now, the batch checkpoint is not needed
+    indexer.reset()
+    stats.report()
+
+    # question/answer pairs of the faq documents, for the fast path
+    build_faq_index(docs_path, embed_model, manifest)
+
+    print_vector_db_stats(vectordb)
 
-    # return the retriever
+    # return the vector db
     return vectordb
 
 
@@ -0,0 +1,256 @@
+import os, json
+import threading
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+from .ann import ANN_INDEXES, exact_search, recall_report
+from .ann import load_ann_index, save_ann_index, remove_ann_index
+
+
+VECTORS_FILE = "vectors.npy"
+DOCS_FILE = "docs.json"
+
+# "flat" (exact search), "ivf" or "hnsw" (approximate search)
+LOCAL_INDEX_TYPE = os.environ.get("LOCAL_INDEX_TYPE", "flat")
+# ivf lists probed / hnsw candidate list size per query, higher is
+# better recall but slower
+ANN_NPROBE = int(os.environ.get("ANN_NPROBE", 8))
+ANN_EF = int(os.environ.get("ANN_EF", 64))
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class LocalVectorStore(VectorStore):
+    """In-process vector store keeping all the chunk embeddings in a float32 matrix.
+
+    Search is a single matrix-vector dot product over the unit normalized
+    vectors (cosine similarity) followed by a partial sort for the top k.
+    The matrix is persisted as a .npy file and memory mapped on load, the
+    chunk texts & metadata are stored next to it in a json file.
+
+    With index_type "ivf" or "hnsw" an approximate nearest neighbour index
+    is built by build_ann_index() and used for search instead of the scan.
+    """
+
+    def __init__(self, embedding, path=None, index_type=LOCAL_INDEX_TYPE,
+                 nprobe=ANN_NPROBE, ef=ANN_EF):
+        self._embedding = embedding
+        self.path = path
+        self.index_type = index_type
+        self.nprobe = nprobe
+        self.ef = ef
+        self.ann = None
+        self._ann_stale = False
+        self.ids = []
+        self.texts = []
+        self.metadatas = []
+        self.vectors = None
+        self._positions = {}
+        # writes may come from concurrent indexing workers
+        self._lock = threading.RLock()
+
+        if path is not None and os.path.exists(os.path.join(path, DOCS_FILE)):
+            self._load()
+
+    @property
+    def embeddings(self):
+        return self._embedding
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def exists(cls, path):
+        return os.path.exists(os.path.join(path, DOCS_FILE))
+
+    def _load(self):
+        with open(os.path.join(self.path, DOCS_FILE)) as f:
+            data = json.load(f)
+        self.ids = data["ids"]
+        self.texts = data["texts"]
+        self.metadatas = data["metadatas"]
+        # memory map the vectors, pages are only read when searched
+        self.vectors = np.load(os.path.join(self.path, VECTORS_FILE), mmap_mode="r")
+        self._positions = {vector_id: i for i, vector_id in enumerate(self.ids)}
+        if self.index_type != "flat":
+            self.ann = load_ann_index(self.path, self.vectors, self.index_type,
+                                      nprobe=self.nprobe, ef=self.ef)
+
+    def save(self):
+        """Persists the index to its directory."""
+        if self.path is None:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        vectors = self.vectors if self.vectors is not None else np.zeros((0, 0), np.float32)
+        # write to temp files first so a crash never leaves a half written index
+        vectors_path = os.path.join(self.path, VECTORS_FILE)
+        with open(f"{vectors_path}.tmp", "wb") as f:
+            np.save(f, np.ascontiguousarray(vectors))
+        docs_path = os.path.join(self.path, DOCS_FILE)
+        with open(f"{docs_path}.tmp", "w") as f:
+            json.dump({"ids": self.ids, "texts": self.texts, "metadatas": self.metadatas}, f)
+        os.replace(f"{vectors_path}.tmp", vectors_path)
+        os.replace(f"{docs_path}.tmp", docs_path)
+        if self._ann_stale:
+            remove_ann_index(self.path)
+            self._ann_stale = False
+
+    def build_ann_index(self):
+        """Builds the approximate index of index_type over the current vectors
+        and persists it, a no-op for the flat index type."""
+        if self.index_type == "flat" or not len(self.ids):
+            return
+        ann_cls = ANN_INDEXES[self.index_type]
+        if self.index_type == "ivf":
+            self.ann = ann_cls.build(self.vectors, nprobe=self.nprobe)
+        else:
+            self.ann = ann_cls.build(self.vectors, ef=self.ef)
+        self.save()
+        if self.path is not None:
+            save_ann_index(self.ann, self.path, len(self.ids))
+
+    def recall_report(self, queries=None, k=5, n_queries=100, settings=(1, 2, 4, 8, 16, 32)):
+        """Compares the approximate index against exact search, by default
+        on a sample of the indexed vectors used as queries."""
+        if self.ann is None:
+            raise ValueError("No ANN index built, set index_type and call build_ann_index()")
+        if queries is None:
+            rng = np.random.default_rng(0)
+            queries = self.vectors[rng.choice(len(self.ids), min(n_queries, len(self.ids)), replace=False)]
+        return recall_report(self.vectors, self.ann, _normalize(queries), k, settings)
+
+    def _mutated(self):
+        # the ann index points at rows which changed, fall back to the scan
+        if self.index_type != "flat":
+            self.ann = None
+            self._ann_stale = True
+
+    def add_embeddings(self, texts, embeddings, metadatas=None, ids=None):
+        """Adds pre-computed embeddings, existing ids are replaced."""
+        with self._lock:
+            return self._add_embeddings(texts, embeddings, metadatas, ids)
+
+    def _add_embeddings(self, texts, embeddings, metadatas, ids):
+        texts = list(texts)
+        metadatas = list(metadatas) if metadatas is not None else [{} for _ in texts]
+        ids = list(ids) if ids is not None else [os.urandom(16).hex() for _ in texts]
+        vectors = _normalize(embeddings)
+
+        replaced = [vector_id for vector_id in ids if vector_id in self._positions]
+        if replaced:
+            self.delete(replaced)
+
+        if self.vectors is None or len(self.vectors) == 0:
+            self.vectors = vectors
+        else:
+            # np.concatenate also copies a read-only memory map into memory
+            self.vectors = np.concatenate([self.vectors, vectors])
+        for text, metadata, vector_id in zip(texts, metadatas, ids):
+            self._positions[vector_id] = len(self.ids)
+            self.ids.append(vector_id)
+            self.texts.append(text)
+            self.metadatas.append(metadata)
+        self._mutated()
+        return ids
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        embeddings = self._embedding.embed_documents(texts)
+        return self.add_embeddings(texts, embeddings, metadatas, ids)
+
+    def delete(self, ids=None, **kwargs):
+        if not ids:
+            return False
+        with self._lock:
+            return self._delete(ids)
+
+    def _delete(self, ids):
+        drop = {self._positions[vector_id] for vector_id in ids if vector_id in self._positions}
+        if not drop:
+            return False
+        keep = [i for i in range(len(self.ids)) if i not in drop]
+        self.vectors = self.vectors[keep]
+        self.ids = [self.ids[i] for i in keep]
+        self.texts = [self.texts[i] for i in keep]
+        self.metadatas = [self.metadatas[i] for i in keep]
+        self._positions = {vector_id: i for i, vector_id in enumerate(self.ids)}
+        self._mutated()
+        return True
+
+    def clear(self):
+        self.ids, self.texts, self.metadatas = [], [], []
+        self.vectors = None
+        self._positions = {}
+        self._mutated()
+
+    def _document(self, i):
+        return Document(page_content=self.texts[i], metadata=dict(self.metadatas[i]))
+
+    def _top_k(self, query_vector, k):
+        if self.vectors is None or len(self.ids) == 0:
+            return [], []
+        query_vector = _normalize(query_vector)
+        if self.ann is not None:
+            return self.ann.search(self.vectors, query_vector, k)
+        return exact_search(self.vectors, query_vector, k)
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, **kwargs):
+        top, scores = self._top_k(embedding, k)
+        return [(self._document(i), float(score)) for i, score in zip(top, scores)]
+
+    # the name PineconeVectorStore uses
+    similarity_search_by_vector_with_score = similarity_search_with_score_by_vector
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k)]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        embedding = self._embedding.embed_query(query)
+        return self.similarity_search_with_score_by_vector(embedding, k)
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    def _select_relevance_score_fn(self):
+        # scores are cosine similarities already (higher is better), not
+        # distances, only clip the negative ones to keep them in [0, 1]
+        return lambda similarity: max(0.0, similarity)
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, path=None, **kwargs):
+        vectordb = cls(embedding, path)
+        vectordb.add_texts(texts, metadatas, ids)
+        vectordb.save()
+        vectordb.build_ann_index()
+        return vectordb
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build an ANN index for the local vector store "
+                                                 "and report its recall@k against exact search.")
+    parser.add_argument("--path", default=os.path.join("data", os.environ.get("LOCAL_INDEX_PATH", "local_index")))
+    parser.add_argument("--index-type", choices=list(ANN_INDEXES), default="ivf")
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--settings", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64])
+    args = parser.parse_args()
+
+    # queries are sampled from the stored vectors, no embedding model needed
+    vectordb = LocalVectorStore(None, args.path, index_type=args.index_type)
+    if vectordb.ann is None:
+        print(f"building {args.index_type} index over {len(vectordb)} vectors...")
+        vectordb.build_ann_index()
+
+    print(f"{'setting':>12} {'recall@' + str(args.k):>10} {'latency':>12}")
+    for row in vectordb.recall_report(k=args.k, n_queries=args.queries, settings=args.settings):
+        print(f"{row['setting']:>12} {row['recall']:>10.3f} {row['latency_ms']:>10.3f}ms")
@@ -1,48 +1,228 @@
 import os, sys
-from dotenv import load_dotenv
-from ragas.testset.generator import TestsetGenerator
-from ragas.testset.evolutions import simple, reasoning, multi_context
+import json, math, random
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
-from utils import load_docx_files, load_pdfs
+import pandas as pd
+from dotenv import load_dotenv
 
+# run from the repo root: python scripts/test_data_gen.py
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from chat_app.data_loaders import list_source_files, load_file
 
 
 load_dotenv('.env')
 
-
-documents = []
-docs_path = "data"
-word_docs = load_docx_files(f"{docs_path}/docx")
-pdfs = load_pdfs(f"{docs_path}/pdfs")
-documents = pdfs + word_docs
-
-
-for document in documents:
-    # print(document.metadata)
-    document.metadata['filename'] = document.metadata['source']
-
-    # if document.metadata["source"].endswith("docx"):
-    #     print(document)
-
-
-
-# generator with openai models
-generator_llm = ChatOpenAI(model="gpt-3.5-turbo-16k")
-critic_llm = ChatOpenAI(model="gpt-3.5-turbo")
-embeddings = OpenAIEmbeddings()
-
-generator = TestsetGenerator.from_langchain(
-    generator_llm,
-    critic_llm,
-    embeddings
-)
-
-# generate testset
-testset = generator.generate_with_langchain_docs(documents, test_size=100, 
-                                                 distributions={simple: 0.5, reasoning: 0.25, 
-                                                                multi_context: 0.25})
-
-
-test_df = testset.to_pandas()
-test_df.to_csv("test_data.csv", index=False)
\ No newline at end of file
+# an OpenAI compatible server (ollama, vllm, llama.cpp) for --backend local
+LOCAL_LLM_BASE_URL = os.environ.get("LOCAL_LLM_BASE_URL", "http://localhost:11434/v1")
+LOCAL_LLM_MODEL = os.environ.get("LOCAL_LLM_MODEL", "llama3")
+LOCAL_EMBED_MODEL = os.environ.get("LOCAL_EMBED_MODEL", "nomic-embed-text")
+
+DISTRIBUTIONS = {"simple": 0.5, "reasoning": 0.25, "multi_context": 0.25}
+
+
+def make_generator(backend, seed=0):
+    """Returns the testset generator of a backend & its evolution distributions.
+
+    Args:
+        backend (str): "openai", "local" (OpenAI compatible server) or
+            "fake" (offline stand-in, no llm calls).
+        seed (int, optional): seed of the fake generator.
+    """
+    if backend == "fake":
+        return FakeTestsetGenerator(seed), DISTRIBUTIONS
+
+    from ragas.testset.generator import TestsetGenerator
+    from ragas.testset.evolutions import simple, reasoning, multi_context
+    from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+
+    if backend == "openai":
+        # generator with openai models
+        generator_llm = ChatOpenAI(model="gpt-3.5-turbo-16k")
+        critic_llm = ChatOpenAI(model="gpt-3.5-turbo")
+        embeddings = OpenAIEmbeddings()
+    elif backend == "local":
+        generator_llm = ChatOpenAI(model=LOCAL_LLM_MODEL, base_url=LOCAL_LLM_BASE_URL, api_key="local")
+        critic_llm = generator_llm
+        embeddings = OpenAIEmbeddings(model=LOCAL_EMBED_MODEL, base_url=LOCAL_LLM_BASE_URL,
+                                      api_key="local", check_embedding_ctx_length=False)
+    else:
+        raise ValueError(f"Unknown backend: {backend}")
+
+    generator = TestsetGenerator.from_langchain(generator_llm, critic_llm, embeddings)
+    evolutions = {"simple": simple, "reasoning": reasoning, "multi_context": multi_context}
+    return generator, {evolutions[name]: share for name, share in DISTRIBUTIONS.items()}
+
+
+class FakeTestset:
+
+    def __init__(self, df):
+        self.df = df
+
+    def to_pandas(self):
+        return self.df
+
+
+class FakeTestsetGenerator:
+    """Offline stand-in of the ragas generator, for trying the sharding &
+    checkpointing: questions are made of random sentences of the documents,
+    with the columns of a ragas testset."""
+
+    def __init__(self, seed=0):
+        self.seed = seed
+
+    def generate_with_langchain_docs(self, documents, test_size, distributions, **kwargs):
+        rng = random.Random(self.seed)
+        sentences = [(doc, sentence.strip()) for doc in documents
+                     for sentence in doc.page_content.split(".") if len(sentence.split()) >= 6]
+        names = list(distributions)
+        rows = []
+        for _ in range(min(test_size, len(sentences))):
+            doc, sentence = rng.choice(sentences)
+            name = rng.choices(names, weights=list(distributions.values()))[0]
+            rows.append({"question": f"What does the document say about {' '.join(sentence.split()[:6])}?",
+                         "contexts": [doc.page_content], "ground_truth": sentence,
+                         "evolution_type": getattr(name, "__name__", name),
+                         "metadata": [doc.metadata], "episode_done": True})
+        return FakeTestset(pd.DataFrame(rows))
+
+
+def plan_shards(sources, test_size, batch_size, n_groups=None):
+    """Splits the documents into groups of about the same size & the testset
+    into batches of at most batch_size questions per group, questions are
+    spread over the groups by their size.
+
+    Returns:
+        list(dict): {"id", "sources", "test_size"} shards, none without
+            documents or questions
+    """
+    if not sources or test_size <= 0:
+        return []
+    sizes = {source: os.path.getsize(source) for source in sources}
+    # every group gets at least one document
+    n_groups = max(1, min(len(sources), n_groups or math.ceil(test_size / batch_size)))
+    groups = [{"sources": [], "bytes": 0} for _ in range(n_groups)]
+    # biggest files first, each to the smallest group
+    for source in sorted(sources, key=sizes.get, reverse=True):
+        group = min(groups, key=lambda group: (group["bytes"], len(group["sources"])))
+        group["sources"].append(source)
+        group["bytes"] += sizes[source]
+
+    total = sum(sizes.values())
+    shards = []
+    remaining = test_size
+    for i, group in enumerate(groups):
+        # empty files only, spread the questions evenly
+        share = group["bytes"] / total if total else 1 / len(groups)
+        questions = remaining if i == len(groups) - 1 else round(test_size * share)
+        questions = min(questions, remaining)
+        remaining -= questions
+        for start in range(0, questions, batch_size):
+            shards.append({"id": len(shards), "sources": sorted(group["sources"]),
+                           "test_size": min(batch_size, questions - start)})
+    return shards
+
+
+def _shard_path(out_dir, shard):
+    return os.path.join(out_dir, f"shard_{shard['id']:04d}.csv")
+
+
+def generate_shard(shard, out_dir, backend, retries=2):
+    """Generates the questions of a shard & checkpoints them to disk."""
+    documents = []
+    for source in shard["sources"]:
+        documents.extend(load_file(source))
+    for document in documents:
+        document.metadata['filename'] = document.metadata['source']
+
+    for attempt in range(retries + 1):
+        try:
+            generator, distributions = make_generator(backend, seed=shard["id"])
+            testset = generator.generate_with_langchain_docs(documents, test_size=shard["test_size"],
+                                                             distributions=distributions)
+            break
+        except Exception as e:
+            if attempt == retries:
+                raise
+            print(f"shard {shard['id']} failed ({type(e).__name__}: {e}), retrying")
+
+    # written to a temp file first, a crash never leaves a half written shard
+    path = _shard_path(out_dir, shard)
+    testset.to_pandas().to_csv(f"{path}.tmp", index=False)
+    os.replace(f"{path}.tmp", path)
+    return path
+
+
+def generate_testset(docs_path, out_dir, output, test_size=100, batch_size=20, workers=4,
+                     backend="openai", n_groups=None):
+    """Generates the testset in shards over document subsets, run concurrently.
+
+    Finished shards are kept in out_dir, a rerun with the same settings only
+    generates the missing ones. The shards are merged into output at the end.
+
+    Returns:
+        list(int): ids of the shards that failed
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    plan_path = os.path.join(out_dir, "plan.json")
+    shards = plan_shards(list_source_files(docs_path), test_size, batch_size, n_groups)
+    if not shards:
+        raise SystemExit(f"no documents in {docs_path} or no questions asked, nothing to generate")
+    if os.path.exists(plan_path):
+        with open(plan_path) as f:
+            if json.load(f) != shards:
+                raise SystemExit(f"{out_dir} holds shards of other settings, use another --shards-dir "
+                                 f"or delete it")
+    with open(plan_path, "w") as f:
+        json.dump(shards, f, indent=1)
+
+    pending = [shard for shard in shards if not os.path.exists(_shard_path(out_dir, shard))]
+    print(f"{len(shards)} shards, {len(shards) - len(pending)} already done")
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(generate_shard, shard, out_dir, backend): shard for shard in pending}
+        for future in as_completed(futures):
+            shard = futures[future]
+            try:
+                print(f"shard {shard['id']} done: {future.result()}")
+            except Exception as e:
+                print(f"shard {shard['id']} failed: {type(e).__name__}: {e}")
+                failed.append(shard["id"])
+
+    # merge what we have, failed shards are generated on the next run
+    frames = [pd.read_csv(_shard_path(out_dir, shard)) for shard in shards
+              if os.path.exists(_shard_path(out_dir, shard))]
+    test_df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    if len(test_df):
+        test_df = test_df.drop_duplicates(subset="question", ignore_index=True)
+    test_df.to_csv(output, index=False)
+    print(f"{len(test_df)} questions written to {output}")
+    return sorted(failed)
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generates the ragas testset in concurrent, "
+                                                 "checkpointed shards over document subsets.")
+    parser.add_argument("--docs-path", default="data")
+    parser.add_argument("--test-size", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=20, help="questions per shard")
+    parser.add_argument("--groups", type=int, help="document subsets, defaults to one per batch")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--backend", choices=["openai", "local", "fake"], default="openai")
+    parser.add_argument("--shards-dir", default="scripts/test_data_shards")
+    # not scripts/test_data.csv, the checked-in testset the evaluation uses
+    parser.add_argument("--output", default="scripts/test_data_generated.csv")
+    parser.add_argument("--overwrite", action="store_true", help="replace an existing --output file")
+    args = parser.parse_args()
+
+    if os.path.exists(args.output) and not args.overwrite:
+        raise SystemExit(f"{args.output} exists, pass --overwrite to replace it")
+
+    failed = generate_testset(args.docs_path, args.shards_dir, args.output, args.test_size,
+                              args.batch_size, args.workers, args.backend, args.groups)
+    if failed:
+        print(f"shards {failed} failed, run again to resume")
+        sys.exit(1)
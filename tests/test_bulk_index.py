@@ -0,0 +1,124 @@
+import json
+
+import pytest
+from langchain_core.documents import Document
+
+from chat_app.bulk_index import BulkIndexer, upsert_embeddings, with_retry
+
+
+class FakeEmbeddings:
+
+    def __init__(self):
+        self.calls = 0
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        return [[float(len(text)), 1.0] for text in texts]
+
+
+class FakeIndex:
+    """Stands in for the pinecone Index client, fails the upserts listed."""
+
+    def __init__(self, fail_on=()):
+        self.vectors = {}
+        self.upserts = 0
+        self.fail_on = set(fail_on)
+
+    def upsert(self, vectors):
+        self.upserts += 1
+        if self.upserts in self.fail_on:
+            raise ValueError("upsert rejected")
+        for vector_id, values, metadata in vectors:
+            self.vectors[vector_id] = (values, metadata)
+
+
+def _docs(n):
+    docs = [Document(page_content=f"chunk {i}", metadata={"source": "a.txt"}) for i in range(n)]
+    return docs, [f"id-{i}" for i in range(n)]
+
+
+def _indexer(embed_model, index, checkpoint_path, generation="gen-1"):
+    return BulkIndexer(embed_model, index, batch_size=2, workers=1, embed_rps=1000,
+                       upsert_rps=1000, checkpoint_path=str(checkpoint_path), max_retries=0,
+                       generation=generation)
+
+
+def test_upsert_keeps_the_text_in_the_metadata():
+    index = FakeIndex()
+    upsert_embeddings(index, ["a", "b", "c"], [[1.0], [2.0], [3.0]], [{"page": 1}] * 3,
+                      ["x", "y", "z"], batch_size=2)
+    assert index.upserts == 2
+    assert index.vectors["z"] == ([3.0], {"page": 1, "text": "c"})
+
+
+def test_resume_after_failure(tmp_path):
+    docs, ids = _docs(5)
+    checkpoint = tmp_path / "checkpoint.json"
+
+    index = FakeIndex(fail_on={2})
+    with pytest.raises(ValueError):
+        _indexer(FakeEmbeddings(), index, checkpoint).index(docs, ids)
+    assert sorted(index.vectors) == ["id-0", "id-1"]
+    assert len(json.loads(checkpoint.read_text())["committed"]) == 1
+
+    # the rerun only writes the batches missing
+    embed_model = FakeEmbeddings()
+    resumed = FakeIndex()
+    written, skipped = _indexer(embed_model, resumed, checkpoint).index(docs, ids)
+    assert (written, skipped) == (3, 2)
+    assert embed_model.calls == 2
+    assert sorted(resumed.vectors) == ["id-2", "id-3", "id-4"]
+
+    assert _indexer(FakeEmbeddings(), FakeIndex(), checkpoint).index(docs, ids) == (0, 5)
+
+
+def test_checkpoint_of_another_generation_is_ignored(tmp_path):
+    docs, ids = _docs(4)
+    checkpoint = tmp_path / "checkpoint.json"
+    _indexer(FakeEmbeddings(), FakeIndex(), checkpoint).index(docs, ids)
+
+    index = FakeIndex()
+    assert _indexer(FakeEmbeddings(), index, checkpoint, generation="gen-2").index(docs, ids) == (4, 0)
+    assert len(index.vectors) == 4
+
+
+def test_reset_forgets_the_committed_batches(tmp_path):
+    docs, ids = _docs(2)
+    checkpoint = tmp_path / "checkpoint.json"
+    indexer = _indexer(FakeEmbeddings(), FakeIndex(), checkpoint)
+    indexer.index(docs, ids)
+    indexer.reset()
+    assert not checkpoint.exists()
+    assert _indexer(FakeEmbeddings(), FakeIndex(), checkpoint).index(docs, ids) == (2, 0)
+
+
+def test_concurrent_workers_write_every_batch(tmp_path):
+    docs, ids = _docs(9)
+    index = FakeIndex()
+    indexer = BulkIndexer(FakeEmbeddings(), index, batch_size=2, workers=3, embed_rps=1000,
+                          upsert_rps=1000, checkpoint_path=str(tmp_path / "checkpoint.json"))
+    assert indexer.index(docs, ids) == (9, 0)
+    assert sorted(index.vectors) == sorted(ids)
+
+
+def test_retry_only_retryable_errors(monkeypatch):
+    monkeypatch.setattr("chat_app.bulk_index.time.sleep", lambda seconds: None)
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise TimeoutError("slow")
+        return "ok"
+
+    assert with_retry(flaky, max_retries=3) == "ok"
+    assert len(attempts) == 3
+
+    def rejected():
+        attempts.append(1)
+        raise ValueError("bad request")
+
+    attempts.clear()
+    with pytest.raises(ValueError):
+        with_retry(rejected, max_retries=3)
+    assert len(attempts) == 1
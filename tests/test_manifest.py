@@ -0,0 +1,89 @@
+import os, json
+
+from langchain_core.documents import Document
+
+from chat_app.manifest import IngestManifest, MANIFEST_NAME, chunk_records
+
+
+def _write(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+    return str(path)
+
+
+def _ingest(manifest, path):
+    changed, _ = manifest.diff([path])
+    for source, digest in changed:
+        manifest.update(source, digest, chunk_records(manifest.key(source), [Document(page_content="x")]))
+
+
+def test_diff_new_changed_and_removed(tmp_path):
+    a = _write(tmp_path / "a.txt", "first")
+    b = _write(tmp_path / "b.txt", "second")
+    manifest = IngestManifest(str(tmp_path / MANIFEST_NAME))
+
+    changed, removed = manifest.diff([a, b])
+    assert [path for path, _ in changed] == [a, b]
+    assert removed == []
+    for path, digest in changed:
+        manifest.update(path, digest, [])
+
+    assert manifest.diff([a, b]) == ([], [])
+
+    _write(a, "first, edited")
+    changed, removed = manifest.diff([b])
+    assert changed == []
+    assert removed == [a]
+
+    changed, _ = manifest.diff([a, b])
+    assert [path for path, _ in changed] == [a]
+
+
+def test_diff_touched_file_with_same_content(tmp_path):
+    a = _write(tmp_path / "a.txt", "same")
+    manifest = IngestManifest(str(tmp_path / MANIFEST_NAME))
+    _ingest(manifest, a)
+
+    os.utime(a, (1, 1))
+    assert manifest.diff([a]) == ([], [])
+    # the stat info was refreshed, the next diff does not hash again
+    assert manifest.files["a.txt"]["mtime"] == 1
+
+
+def test_keys_relative_to_docs_path(tmp_path, monkeypatch):
+    a = _write(tmp_path / "a.txt", "content")
+    manifest = IngestManifest(str(tmp_path / MANIFEST_NAME))
+    _ingest(manifest, a)
+    manifest.save()
+
+    # the same docs reached through a relative path
+    monkeypatch.chdir(tmp_path.parent)
+    relative = IngestManifest.load(os.path.join(tmp_path.name, MANIFEST_NAME))
+    assert relative.diff([os.path.join(tmp_path.name, "a.txt")]) == ([], [])
+    assert relative.chunk_ids(os.path.join(tmp_path.name, "a.txt")) == manifest.chunk_ids(a)
+
+
+def test_load_migrates_old_keys(tmp_path):
+    a = _write(tmp_path / "a.txt", "content")
+    manifest = IngestManifest(str(tmp_path / MANIFEST_NAME))
+    _ingest(manifest, a)
+    with open(manifest.path, "w") as f:
+        json.dump({"generation": manifest.generation, "files": {a: manifest.files["a.txt"]}}, f)
+
+    loaded = IngestManifest.load(manifest.path)
+    assert list(loaded.files) == ["a.txt"]
+    assert loaded.generation == manifest.generation
+    assert loaded.diff([a]) == ([], [])
+
+
+def test_chunk_ids_stable_across_edits():
+    kept = Document(page_content="kept paragraph")
+    before = chunk_records("a.txt", [kept, Document(page_content="old")])
+    after = chunk_records("a.txt", [Document(page_content="new"), kept])
+    assert before[0]["id"] == after[1]["id"]
+    assert before[1]["id"] != after[0]["id"]
+
+
+def test_chunk_records_number_repeated_text():
+    records = chunk_records("a.txt", [Document(page_content="same")] * 2)
+    assert records[0]["id"] != records[1]["id"]
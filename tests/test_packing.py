@@ -0,0 +1,61 @@
+import pytest
+from langchain_core.documents import Document
+
+from chat_app import packing
+from chat_app.packing import pack_documents
+
+
+@pytest.fixture(autouse=True)
+def token_estimate(monkeypatch):
+    # ~4 characters per token, tiktoken would download its encoding
+    monkeypatch.setattr(packing, "_encoding", False)
+
+
+def _doc(text, **metadata):
+    return Document(page_content=text, metadata=metadata)
+
+
+def test_adjacent_chunks_of_a_page_are_merged():
+    text = "Students must submit the I-20 form. The EAD card arrives by mail."
+    first = _doc(text[:40], source="opt.pdf", page=1, start_index=0)
+    second = _doc(text[30:], source="opt.pdf", page=1, start_index=30)
+    packed = pack_documents([second, first])
+    assert [doc.page_content for doc in packed] == [text]
+
+
+def test_overlapping_chunks_without_offsets_are_merged():
+    text = "Orientation starts on Monday, bring your passport and the admission letter."
+    packed = pack_documents([_doc(text[:50], source="a.txt"), _doc(text[25:], source="a.txt")])
+    assert [doc.page_content for doc in packed] == [text]
+
+
+def test_other_pages_are_kept_apart():
+    docs = [_doc("Housing applications open in March for all students.", source="a.txt", page=1),
+            _doc("Parking permits are sold online at the start of term.", source="a.txt", page=2)]
+    assert len(pack_documents(docs)) == 2
+
+
+def test_near_duplicates_are_dropped():
+    text = "The library is open from 8am to midnight on weekdays and 10am to 8pm on weekends."
+    docs = [_doc(text, source="a.txt"), _doc(text + " Thanks.", source="b.txt")]
+    packed = pack_documents(docs)
+    assert len(packed) == 1
+    assert packed[0].metadata["source"] == "a.txt"
+
+
+def test_budget_keeps_the_best_scored_passages():
+    docs = [_doc("a" * 400, source="low.txt", rerank_score=0.1),
+            _doc("b " * 200, source="high.txt", rerank_score=0.9),
+            _doc("c " * 20, source="small.txt", rerank_score=0.2)]
+    packed = pack_documents(docs, max_tokens=120)
+    # the low scored passage does not fit, the smaller one still does
+    assert [doc.metadata["source"] for doc in packed] == ["high.txt", "small.txt"]
+
+
+def test_first_passage_is_truncated_to_the_budget():
+    packed = pack_documents([_doc("x" * 1000)], max_tokens=10)
+    assert packed[0].page_content == "x" * 40
+
+
+def test_nothing_to_pack():
+    assert pack_documents([]) == []
@@ -0,0 +1,72 @@
+import asyncio
+from typing import List
+
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from chat_app.retrievers import BM25Index, HybridRetriever, reciprocal_rank_fusion, tokenize
+
+
+DOCS = [
+    Document(page_content="ISM 6251 Data Science Programming is offered in the fall."),
+    Document(page_content="The OPT application needs the I-20 and the EAD card."),
+    Document(page_content="Housing on campus: apply early, housing fills up fast."),
+    Document(page_content="Orientation week starts before the fall semester."),
+]
+
+
+class FakeDense(BaseRetriever):
+    """Returns fixed documents whatever the query."""
+
+    docs: List[Document]
+
+    def _get_relevant_documents(self, query, *, run_manager) -> List[Document]:
+        return self.docs
+
+
+def test_tokenize_joins_course_codes():
+    assert "ism6251" in tokenize("What is ISM 6251?")
+    assert "ism6251" in tokenize("ism-6251 syllabus")
+
+
+def test_bm25_ranks_matching_documents():
+    index = BM25Index(DOCS)
+    results = index.search("on campus housing", k=2)
+    assert results[0][0] is DOCS[2]
+    assert all(score > 0 for _, score in results)
+
+    assert index.search("ISM6251")[0][0] is DOCS[0]
+    # "fall" is in two documents, the shorter one scores higher
+    assert [doc for doc, _ in index.search("fall", k=5)] == [DOCS[3], DOCS[0]]
+
+
+def test_bm25_without_matches():
+    assert BM25Index(DOCS).search("visa interview") == []
+    assert BM25Index([]).search("housing") == []
+
+
+def test_rrf_rewards_documents_in_both_rankings():
+    a, b, c = DOCS[:3]
+    fused = reciprocal_rank_fusion([[a, b], [c, b]], k=60)
+    assert fused[0][0] is b
+    assert fused[0][1] == 1 / 62 + 1 / 62
+    assert [doc for doc, _ in fused[1:]] == [a, c]
+
+
+def test_rrf_dedupes_by_content():
+    copy = Document(page_content=DOCS[0].page_content, metadata={"source": "copy"})
+    fused = reciprocal_rank_fusion([[DOCS[0]], [copy]])
+    assert len(fused) == 1
+    assert fused[0][0] is DOCS[0]
+
+
+def test_hybrid_retriever_fuses_both_searches():
+    retriever = HybridRetriever(dense_retriever=FakeDense(docs=[DOCS[3], DOCS[2]]),
+                                bm25=BM25Index(DOCS), k=2)
+    docs = retriever.invoke("campus housing")
+    assert docs[0].page_content == DOCS[2].page_content
+    assert "rrf_score" in docs[0].metadata
+    assert len(docs) == 2
+
+    async_docs = asyncio.run(retriever.ainvoke("campus housing"))
+    assert [doc.page_content for doc in async_docs] == [doc.page_content for doc in docs]
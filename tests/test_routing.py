@@ -0,0 +1,27 @@
+from chat_app.routing import is_standalone, needs_condense, token_overlap
+
+
+HISTORY = [("human", "Which documents do I need for OPT?"), ("ai", "The I-20 and the EAD card.")]
+
+
+def test_first_turn_is_never_condensed():
+    assert not needs_condense("is it online?", [])
+    assert not needs_condense("is it online?", None)
+
+
+def test_follow_ups_are_condensed():
+    assert needs_condense("is it online?", HISTORY)
+    assert needs_condense("what about the spring term deadlines for students?", HISTORY)
+    assert needs_condense("how long does it take to get the card approved?", HISTORY)
+
+
+def test_standalone_questions_skip_condense():
+    question = "When does the fall orientation week start for new graduate students?"
+    assert is_standalone(question)
+    assert not needs_condense(question, HISTORY)
+
+
+def test_token_overlap():
+    assert token_overlap("is it online?", "is ISM 6251 online?") == 2 / 4
+    assert token_overlap("housing deadlines", "Housing deadlines") == 1.0
+    assert token_overlap("it", "housing") == 0.0
@@ -0,0 +1,39 @@
+import asyncio
+
+from chat_app.streaming import coalesce_tokens
+
+
+async def _tokens(tokens, delay=0.0):
+    for token in tokens:
+        if delay:
+            await asyncio.sleep(delay)
+        yield token
+
+
+def _collect(tokens, **kwargs):
+    async def collect():
+        return [piece async for piece in coalesce_tokens(tokens, **kwargs)]
+    return asyncio.run(collect())
+
+
+def test_zero_interval_emits_every_token():
+    assert _collect(_tokens(["a", "b", "c"]), interval=0) == ["a", "b", "c"]
+
+
+def test_first_token_right_away_then_grouped():
+    pieces = _collect(_tokens(["The", " answer", " is", " 42"]), interval=60)
+    assert pieces == ["The", " answer is 42"]
+
+
+def test_max_chars_flushes_early():
+    pieces = _collect(_tokens(["a", "bb", "cc", "dd", "e"]), interval=60, max_chars=4)
+    assert pieces == ["a", "bbcc", "dde"]
+
+
+def test_slow_tokens_are_not_held_back():
+    pieces = _collect(_tokens(["a", "b", "c"], delay=0.02), interval=0.01)
+    assert pieces == ["a", "b", "c"]
+
+
+def test_no_tokens():
+    assert _collect(_tokens([])) == []
@@ -0,0 +1,95 @@
+import os, sys
+
+import pandas as pd
+import pytest
+from langchain_core.documents import Document
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"))
+import test_data_gen
+from test_data_gen import generate_testset, plan_shards
+
+
+SENTENCE = "International students have to report their address change within ten days. "
+
+
+def _sources(tmp_path, sizes):
+    paths = []
+    for i, size in enumerate(sizes):
+        path = tmp_path / f"doc_{i}.txt"
+        path.write_text(SENTENCE * size)
+        paths.append(str(path))
+    return paths
+
+
+def test_plan_covers_every_question_and_document(tmp_path):
+    sources = _sources(tmp_path, [8, 1, 4, 2, 2, 1])
+    shards = plan_shards(sources, test_size=50, batch_size=10)
+    assert sum(shard["test_size"] for shard in shards) == 50
+    assert all(0 < shard["test_size"] <= 10 for shard in shards)
+    assert sorted({source for shard in shards for source in shard["sources"]}) == sorted(sources)
+    assert [shard["id"] for shard in shards] == list(range(len(shards)))
+
+
+def test_groups_are_balanced_by_size(tmp_path):
+    sources = _sources(tmp_path, [4, 3, 2, 1, 1, 1])
+    shards = plan_shards(sources, test_size=20, batch_size=10, n_groups=2)
+    assert len(shards) == 2
+    sizes = [sum(os.path.getsize(source) for source in shard["sources"]) for shard in shards]
+    assert abs(sizes[0] - sizes[1]) <= os.path.getsize(sources[-1])
+
+
+def test_more_groups_than_documents(tmp_path):
+    sources = _sources(tmp_path, [1, 1])
+    shards = plan_shards(sources, test_size=9, batch_size=2, n_groups=5)
+    assert {tuple(shard["sources"]) for shard in shards} == {(source,) for source in sources}
+    assert sum(shard["test_size"] for shard in shards) == 9
+
+
+def test_empty_files_still_get_questions(tmp_path):
+    sources = _sources(tmp_path, [0, 0, 0])
+    shards = plan_shards(sources, test_size=6, batch_size=2)
+    assert len(shards) == 3
+    assert all(len(shard["sources"]) == 1 for shard in shards)
+
+
+def test_nothing_to_plan(tmp_path):
+    assert plan_shards([], test_size=10, batch_size=5) == []
+    assert plan_shards(_sources(tmp_path, [1]), test_size=0, batch_size=5) == []
+
+
+def test_generation_resumes_failed_shards(tmp_path, monkeypatch):
+    sources = _sources(tmp_path, [6, 6, 6])
+    broken = {sources[1]}
+
+    def load_file(path):
+        if path in broken:
+            raise OSError("unreadable")
+        return [Document(page_content=open(path).read(), metadata={"source": path})]
+
+    generated = []
+    make_generator = test_data_gen.make_generator
+
+    def counting_generator(backend, seed=0):
+        generated.append(seed)
+        return make_generator(backend, seed)
+
+    monkeypatch.setattr(test_data_gen, "list_source_files", lambda docs_path: sources)
+    monkeypatch.setattr(test_data_gen, "load_file", load_file)
+    monkeypatch.setattr(test_data_gen, "make_generator", counting_generator)
+    shards_dir, output = str(tmp_path / "shards"), str(tmp_path / "testset.csv")
+
+    failed = generate_testset("data", shards_dir, output, test_size=6, batch_size=2,
+                              workers=2, backend="fake", n_groups=3)
+    assert len(failed) == 1
+    assert len(generated) == 2
+
+    broken.clear()
+    generated.clear()
+    assert generate_testset("data", shards_dir, output, test_size=6, batch_size=2,
+                            workers=2, backend="fake", n_groups=3) == []
+    # only the failed shard was generated again
+    assert generated == failed
+    assert len(pd.read_csv(output)) > 0
+
+    with pytest.raises(SystemExit):
+        generate_testset("data", shards_dir, output, test_size=8, batch_size=2, backend="fake")